@@ -0,0 +1,655 @@
+import asyncio
+import json
+import logging
+import math
+import os
+import statistics
+import time
+from collections import deque
+import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+from cache_manager import get_or_analyze
+from image_manager import preprocess_image
+from metrics_manager import Counter, Gauge, Histogram, register_collector
+from nutrition_manager import lookup_nutrition, remember_nutrition
+
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.0-flash-lite-001")
+
+# Сколько запросов к Gemini может выполняться одновременно
+MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+# Сколько запросов может ждать своей очереди, прежде чем отвечаем 429
+MAX_QUEUE = int(os.getenv("GEMINI_MAX_QUEUE", "32"))
+# Таймаут на весь запрос (ожидание в очереди + генерация), секунды
+REQUEST_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "30"))
+# Значение заголовка Retry-After при переполненной очереди, секунды
+RETRY_AFTER = int(os.getenv("GEMINI_RETRY_AFTER", "5"))
+# Сколько текстовых позиций упаковываем в один запрос к Gemini
+MAX_TEXT_ITEMS_PER_PROMPT = int(os.getenv("GEMINI_TEXT_BATCH_SIZE", "10"))
+
+# Запасные модели через запятую; используются, когда основная медленнее или недоступна
+FALLBACK_MODELS = [
+    name.strip()
+    for name in os.getenv("GEMINI_FALLBACK_MODELS", "gemini-2.0-flash-001,gemini-2.5-flash-lite").split(",")
+    if name.strip()
+]
+# Сколько последних вызовов каждой модели учитываем в статистике
+HEALTH_WINDOW = int(os.getenv("GEMINI_HEALTH_WINDOW", "100"))
+# Пока у модели меньше замеров, считаем её задержку типичной (медиана по остальным моделям)
+MIN_LATENCY_SAMPLES = 5
+# Типичная задержка, пока замеров нет ни у одной модели, секунды
+DEFAULT_LATENCY = 1.0
+# Нижняя граница доли успешных вызовов в оценке: модель, которая только падает, в 100 раз "медленнее"
+MIN_SUCCESS_RATE = 0.01
+# После стольких ошибок подряд модель выключается на BREAKER_COOLDOWN секунд
+BREAKER_FAILURES = int(os.getenv("GEMINI_BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN = float(os.getenv("GEMINI_BREAKER_COOLDOWN", "30"))
+# Сколько ждём одну модель, прежде чем переключиться на следующую, секунды
+ATTEMPT_TIMEOUT = float(os.getenv("GEMINI_ATTEMPT_TIMEOUT", str(REQUEST_TIMEOUT * 2 / 3)))
+
+# Ошибки, при которых имеет смысл повторить запрос на другой модели
+FAILOVER_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.NotFound,
+)
+
+# Схема ответа для пакетного анализа текста: массив объектов в порядке запроса
+BATCH_TEXT_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "product_name": {"type": "string"},
+            "calories": {"type": "number"},
+            "protein": {"type": "number"},
+            "carbs": {"type": "number"},
+            "fats": {"type": "number"},
+        },
+        "required": ["product_name", "calories", "protein", "carbs", "fats"],
+    },
+}
+
+# name -> GenerativeModel
+_models = {}
+# name -> ModelHealth, в порядке предпочтения
+_health = {}
+_semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+# Запросы в работе + в очереди
+_pending = 0
+
+GEMINI_LATENCY = Histogram("diet_gemini_request_seconds", "Gemini call attempts by model and outcome", ("model", "outcome"))
+GEMINI_ERRORS = Counter("diet_gemini_errors_total", "Failed Gemini call attempts by model and error", ("model", "error"))
+GEMINI_TOKENS = Counter("diet_gemini_tokens_total", "Gemini tokens by model and kind", ("model", "kind"))
+INFERENCE_REJECTED = Counter("diet_inference_rejected_total", "Analysis calls rejected because the queue was full")
+INFERENCE_PENDING = Gauge("diet_inference_pending", "Analysis calls running or waiting for a slot")
+MODEL_AVAILABLE = Gauge("diet_gemini_model_available", "1 if the circuit breaker lets calls through", ("model",))
+
+
+class InferenceBusyError(Exception):
+    """Raised when the inference wait queue is full."""
+
+    def __init__(self, retry_after: int = RETRY_AFTER):
+        super().__init__("Too many analysis requests, try again later")
+        self.retry_after = retry_after
+
+
+class ModelsUnavailableError(InferenceBusyError):
+    """Raised when the circuit breakers of all models are open."""
+
+    def __init__(self, retry_after: int = RETRY_AFTER):
+        Exception.__init__(self, "Analysis is temporarily unavailable, try again later")
+        self.retry_after = retry_after
+
+
+class ModelHealth:
+    """Rolling latency and error statistics plus a circuit breaker for one model."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies = deque(maxlen=HEALTH_WINDOW)
+        # "ok", "error" или "throttled" для последних вызовов
+        self.outcomes = deque(maxlen=HEALTH_WINDOW)
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        # После паузы пропускаем один пробный запрос (half-open)
+        self.half_open = False
+        self.probing = False
+
+    def percentile(self, q: float):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def rate(self, outcome: str) -> float:
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(outcome) / len(self.outcomes)
+
+    def available(self, now: float) -> bool:
+        if now < self.open_until:
+            return False
+        return not (self.half_open and self.probing)
+
+    def score(self, prior: float) -> float:
+        """
+        Expected time to a successful answer, used for routing (lower is better):
+        median latency (prior until MIN_LATENCY_SAMPLES calls succeeded) divided by
+        the recent success rate.
+        """
+        latency = self.percentile(0.5) if len(self.latencies) >= MIN_LATENCY_SAMPLES else prior
+        if not self.outcomes:
+            return latency
+        return latency / max(MIN_SUCCESS_RATE, self.rate("ok"))
+
+    def record_success(self, latency: float):
+        self.latencies.append(latency)
+        self.outcomes.append("ok")
+        self.consecutive_failures = 0
+        self.half_open = self.probing = False
+
+    def record_failure(self, throttled: bool):
+        self.outcomes.append("throttled" if throttled else "error")
+        self.consecutive_failures += 1
+        self.probing = False
+        # 429 выключает модель сразу: квота не восстановится за секунды
+        if throttled or self.half_open or self.consecutive_failures >= BREAKER_FAILURES:
+            self.open_until = time.monotonic() + BREAKER_COOLDOWN
+            self.half_open = True
+            logging.warning(f"⚠️ Model {self.name} disabled for {BREAKER_COOLDOWN:.0f}s")
+
+    def snapshot(self) -> dict:
+        return {
+            "model": self.name,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "error_rate": self.rate("error"),
+            "throttle_rate": self.rate("throttled"),
+            "available": self.available(time.monotonic()),
+        }
+
+
+def list_generation_models():
+    """
+    Names of the models available to the API key that support generateContent.
+    Blocking call, requires genai.configure.
+    """
+    return [
+        m.name.removeprefix("models/")
+        for m in genai.list_models()
+        if 'generateContent' in m.supported_generation_methods
+    ]
+
+
+def _set_candidates(names: list):
+    _health.clear()
+    for name in dict.fromkeys(names):
+        _health[name] = ModelHealth(name)
+
+
+async def init_models():
+    """
+    Keep the configured models that the API key can actually use.
+    Falls back to the configured list if discovery fails.
+    """
+    candidates = [GEMINI_MODEL] + FALLBACK_MODELS
+    try:
+        available = set(await asyncio.to_thread(list_generation_models))
+    except Exception as e:
+        logging.warning(f"⚠️ Model discovery failed, using configured models: {e}")
+        _set_candidates(candidates)
+        return
+    eligible = [name for name in candidates if name in available]
+    _set_candidates(eligible or [GEMINI_MODEL])
+    logging.info(f"✅ Gemini models: {', '.join(_health)}")
+
+
+def model_stats():
+    """Per-model routing statistics, in preference order."""
+    if not _health:
+        _set_candidates([GEMINI_MODEL] + FALLBACK_MODELS)
+    return [health.snapshot() for health in _health.values()]
+
+
+def get_model(name: str = GEMINI_MODEL):
+    """
+    Return the shared GenerativeModel instance for a model name.
+    Models are built on first use (after genai.configure) and reused afterwards.
+    """
+    model = _models.get(name)
+    if model is None:
+        model = _models[name] = genai.GenerativeModel(name)
+    return model
+
+
+def _route():
+    """
+    Models to try for the next call, best score first; models with an open breaker are skipped.
+
+    Raises:
+        ModelsUnavailableError: Every model is disabled
+    """
+    if not _health:
+        _set_candidates([GEMINI_MODEL] + FALLBACK_MODELS)
+    now = time.monotonic()
+    order = list(_health.values())
+    healthy = [h for h in order if h.available(now)]
+    if not healthy:
+        raise ModelsUnavailableError(max(1, math.ceil(min(h.open_until for h in order) - now)))
+    sampled = [h.percentile(0.5) for h in order if len(h.latencies) >= MIN_LATENCY_SAMPLES]
+    prior = statistics.median(sampled) if sampled else DEFAULT_LATENCY
+    return sorted(healthy, key=lambda h: (h.score(prior), order.index(h)))
+
+
+async def _call_with_failover(call):
+    """
+    Run call(model) on the best model, failing over to the next one on throttling or upstream errors.
+
+    Args:
+        call: Coroutine function call(model, on_started) returning the result;
+            after on_started() is called the request is not retried elsewhere
+    """
+    last_error = None
+    for health in _route():
+        started = time.monotonic()
+        committed = False
+
+        def on_started():
+            nonlocal committed
+            committed = True
+
+        if health.half_open:
+            health.probing = True
+        try:
+            result = await asyncio.wait_for(call(get_model(health.name), on_started), timeout=ATTEMPT_TIMEOUT)
+        except (*FAILOVER_ERRORS, asyncio.TimeoutError) as e:
+            throttled = isinstance(e, google_exceptions.ResourceExhausted)
+            health.record_failure(throttled)
+            GEMINI_LATENCY.observe(time.monotonic() - started, health.name, "throttled" if throttled else "error")
+            GEMINI_ERRORS.inc(health.name, type(e).__name__)
+            if committed:
+                raise
+            logging.warning(f"⚠️ Model {health.name} failed ({type(e).__name__}), trying next")
+            last_error = e
+            continue
+        except BaseException as e:
+            # Отмена или ошибка запроса: модель не виновата, пробный слот освобождаем
+            health.probing = False
+            if isinstance(e, Exception):
+                GEMINI_ERRORS.inc(health.name, type(e).__name__)
+            raise
+        latency = time.monotonic() - started
+        health.record_success(latency)
+        GEMINI_LATENCY.observe(latency, health.name, "ok")
+        return result
+    raise last_error
+
+
+def _record_usage(model, response):
+    """Add the token counts of a finished response to GEMINI_TOKENS."""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    name = model.model_name.removeprefix("models/")
+    GEMINI_TOKENS.inc(name, "prompt", amount=usage.prompt_token_count)
+    GEMINI_TOKENS.inc(name, "output", amount=usage.candidates_token_count)
+
+
+async def _generate(contents, generation_config=None):
+    async def call(model, on_started):
+        response = await model.generate_content_async(contents, generation_config=generation_config)
+        _record_usage(model, response)
+        return response
+
+    async with _semaphore:
+        return await _call_with_failover(call)
+
+
+async def _generate_stream(contents, on_text):
+    async def call(model, on_started):
+        response = await model.generate_content_async(contents, stream=True)
+        chunks = []
+        async for chunk in response:
+            try:
+                text = chunk.text
+            except ValueError:
+                # Служебный чанк без текста (например, только finish_reason)
+                continue
+            if not chunks:
+                # Клиент уже получает ответ этой модели, переключаться поздно
+                on_started()
+            chunks.append(text)
+            await on_text(text)
+        # После последнего чанка usage_metadata содержит итог по всему ответу
+        _record_usage(model, response)
+        return "".join(chunks)
+
+    async with _semaphore:
+        return await _call_with_failover(call)
+
+
+async def _bounded(call):
+    global _pending
+    if _pending >= MAX_CONCURRENCY + MAX_QUEUE:
+        call.close()
+        INFERENCE_REJECTED.inc()
+        logging.warning(f"⚠️ Inference queue is full ({_pending} pending)")
+        raise InferenceBusyError()
+    try:
+        # Все модели выключены: отвечаем сразу, а не после ожидания в очереди
+        _route()
+    except ModelsUnavailableError:
+        call.close()
+        raise
+    _pending += 1
+    try:
+        return await asyncio.wait_for(call, timeout=REQUEST_TIMEOUT)
+    finally:
+        _pending -= 1
+
+
+async def generate(contents, generation_config=None):
+    """
+    Run a Gemini generation without blocking the event loop.
+
+    At most MAX_CONCURRENCY calls run at once, up to MAX_QUEUE more wait
+    for a free slot. The whole call is bounded by REQUEST_TIMEOUT.
+
+    Args:
+        contents: Prompt or list of prompt parts for generate_content
+        generation_config: Optional GenerationConfig dict (e.g. structured output)
+
+    Returns:
+        GenerateContentResponse from Gemini
+
+    Raises:
+        InferenceBusyError: The wait queue is full (ModelsUnavailableError: every model is disabled)
+        asyncio.TimeoutError: The call did not finish in REQUEST_TIMEOUT
+    """
+    return await _bounded(_generate(contents, generation_config))
+
+
+async def generate_stream(contents, on_text):
+    """
+    Streaming variant of generate() under the same limits.
+
+    Args:
+        contents: Prompt or list of prompt parts for generate_content
+        on_text: Coroutine function called with every text chunk as it arrives
+
+    Returns:
+        str: Full reply text
+    """
+    return await _bounded(_generate_stream(contents, on_text))
+
+
+def _collect_metrics():
+    INFERENCE_PENDING.set(_pending)
+    now = time.monotonic()
+    for health in _health.values():
+        MODEL_AVAILABLE.set(int(health.available(now)), health.name)
+
+
+register_collector(_collect_metrics)
+
+
+class JsonExtractor:
+    """
+    Incremental extractor of the JSON value in a model reply.
+
+    Text is fed as it streams in; prose around the JSON is skipped. A value in
+    a markdown code fence wins over bare brackets in the prose (e.g.
+    "[note] ```json {...}```"); a bare value is used only if it parses and no
+    fenced one follows. Top-level string fields (e.g. product_name) are
+    reported as soon as their value is complete.
+    """
+
+    def __init__(self):
+        self.fields = {}
+        self._chars = []
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._key = None
+        self._expect_value = False
+        # Разметка между значениями: подряд идущие ` и открыт ли блок ```
+        self._ticks = 0
+        self._in_fence = False
+        # Разобранное значение вне блока ``` (None - ещё не было)
+        self._bare = None
+        self._fenced = None
+        # Найдено значение в блоке ```: дальше ответ не читаем
+        self.complete = False
+
+    def feed(self, text: str) -> dict:
+        """
+        Consume the next chunk of the reply.
+
+        Returns:
+            dict: Top-level string fields completed by this chunk
+        """
+        new_fields = {}
+        for char in text:
+            if self.complete:
+                break
+            if self._depth == 0:
+                if not self._opens_value(char):
+                    continue
+                self._chars = []
+                self._key, self._expect_value = None, False
+            self._chars.append(char)
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        self._string_done(new_fields)
+                continue
+
+            if char == '"':
+                self._in_string = True
+                self._string_start = len(self._chars) - 1
+            elif char in "{[":
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._value_done()
+            elif self._depth == 1 and char == ":":
+                self._expect_value = True
+            elif self._depth == 1 and char == ",":
+                self._key, self._expect_value = None, False
+        return new_fields
+
+    def _opens_value(self, char: str) -> bool:
+        """Track code fences between values; True if char starts a value worth parsing."""
+        if char == "`":
+            self._ticks += 1
+            if self._ticks == 3:
+                self._ticks = 0
+                self._in_fence = not self._in_fence
+            return False
+        self._ticks = 0
+        return char in "{[" and (self._in_fence or self._bare is None)
+
+    def _value_done(self):
+        try:
+            value = json.loads("".join(self._chars))
+        except ValueError:
+            # Например, "[note]" в тексте вокруг JSON: ищем дальше
+            return
+        if self._in_fence:
+            self._fenced = value
+            self.complete = True
+        else:
+            self._bare = value
+
+    def _string_done(self, new_fields: dict):
+        try:
+            value = json.loads("".join(self._chars[self._string_start:]))
+        except ValueError:
+            return
+        if not self._expect_value:
+            self._key = value
+        elif self._key is not None:
+            self.fields[self._key] = new_fields[self._key] = value
+            self._key, self._expect_value = None, False
+
+    def result(self):
+        """
+        Parsed JSON value.
+
+        Raises:
+            ValueError: The reply has no complete JSON value
+        """
+        value = self._fenced if self.complete else self._bare
+        if value is None:
+            raise ValueError("Incomplete JSON")
+        return value
+
+
+def parse_result(text: str):
+    """
+    Parse the JSON payload from a Gemini reply, skipping markdown fences and prose.
+    Falls back to {"raw_text": ...} if the reply is not valid JSON.
+    """
+    extractor = JsonExtractor()
+    extractor.feed(text)
+    try:
+        return extractor.result()
+    except ValueError:
+        # Fallback if Gemini fails to return clean JSON
+        return {"raw_text": text}
+
+
+async def analyze_image(image_data: bytes, mime_type: str, prompt: str, on_partial=None):
+    """
+    Analyze a food photo, answering repeats from the analysis cache.
+
+    Args:
+        image_data: Decoded image bytes
+        mime_type: MIME type of the image
+        prompt: Instruction for the model
+        on_partial: Optional coroutine function called with top-level fields
+            (e.g. {"product_name": ...}) while the reply streams in; not called on cache hits
+
+    Returns:
+        dict: Parsed model reply
+    """
+    async def analyze():
+        # Уменьшаем фото только при промахе кэша; ключ кэша считается по исходным байтам
+        data, data_mime_type = await preprocess_image(image_data, mime_type)
+        contents = [
+            prompt,
+            {'mime_type': data_mime_type, 'data': data}
+        ]
+        if on_partial is None:
+            response = await generate(contents)
+            return parse_result(response.text)
+
+        extractor = JsonExtractor()
+
+        async def on_text(text):
+            fields = extractor.feed(text)
+            if fields:
+                await on_partial(fields)
+
+        text = await generate_stream(contents, on_text)
+        return parse_result(text)
+
+    return await get_or_analyze(image_data, prompt, GEMINI_MODEL, analyze)
+
+
+async def analyze_text(text_query: str, prompt: str, use_index: bool = True):
+    """
+    Estimate nutrition facts for a text description of a product.
+
+    Args:
+        text_query: Product description, e.g. "гречка 100г"
+        prompt: Instruction for the model
+        use_index: Answer from the local nutrition index when possible
+
+    Returns:
+        dict: Parsed model reply
+    """
+    if use_index:
+        result = lookup_nutrition(text_query)
+        if result is not None:
+            return result
+
+    result = await _ask_text(text_query, prompt)
+    if use_index:
+        await remember_nutrition(text_query, result)
+    return result
+
+
+async def _ask_text(text_query: str, prompt: str):
+    full_prompt = f"Определи КБЖУ для продукта: {text_query}. {prompt}"
+    response = await generate(full_prompt)
+    return parse_result(response.text)
+
+
+async def _ask_texts(text_queries: list, prompt: str):
+    """One Gemini call for several products; falls back to one call per product."""
+    if len(text_queries) == 1:
+        return [await _ask_text(text_queries[0], prompt)]
+
+    products = "\n".join(f"{number}. {query}" for number, query in enumerate(text_queries, 1))
+    full_prompt = (
+        f"Определи КБЖУ для каждого продукта из списка:\n{products}\n{prompt}\n"
+        f"Верни JSON-массив из {len(text_queries)} объектов в том же порядке, по одному на продукт."
+    )
+    response = await generate(full_prompt, generation_config={
+        "response_mime_type": "application/json",
+        "response_schema": BATCH_TEXT_SCHEMA,
+    })
+    results = parse_result(response.text)
+    if isinstance(results, list) and len(results) == len(text_queries) and all(isinstance(r, dict) for r in results):
+        return results
+
+    logging.warning(f"⚠️ Batch reply does not match {len(text_queries)} items, asking one by one")
+    return await asyncio.gather(*(_ask_text(query, prompt) for query in text_queries), return_exceptions=True)
+
+
+async def analyze_texts(text_queries: list, prompt: str, use_index: bool = True):
+    """
+    Estimate nutrition facts for several products at once.
+
+    Index hits are answered locally, the rest are packed into structured-output
+    prompts of up to MAX_TEXT_ITEMS_PER_PROMPT products that run concurrently.
+
+    Args:
+        text_queries: Product descriptions
+        prompt: Instruction for the model
+        use_index: Answer from the local nutrition index when possible
+
+    Returns:
+        list: Parsed reply or exception for every query, in the same order
+    """
+    results = [None] * len(text_queries)
+    missing = []
+    for i, text_query in enumerate(text_queries):
+        result = lookup_nutrition(text_query) if use_index else None
+        if result is None:
+            missing.append(i)
+        else:
+            results[i] = result
+
+    chunks = [missing[i:i + MAX_TEXT_ITEMS_PER_PROMPT] for i in range(0, len(missing), MAX_TEXT_ITEMS_PER_PROMPT)]
+    replies = await asyncio.gather(
+        *(_ask_texts([text_queries[i] for i in chunk], prompt) for chunk in chunks),
+        return_exceptions=True
+    )
+    for chunk, reply in zip(chunks, replies):
+        for position, i in enumerate(chunk):
+            results[i] = reply if isinstance(reply, BaseException) else reply[position]
+            if use_index and not isinstance(results[i], BaseException):
+                await remember_nutrition(text_queries[i], results[i])
+    return results
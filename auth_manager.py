@@ -0,0 +1,137 @@
+import hashlib
+import hmac
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qs
+from aiohttp import web
+
+# Сколько секунд initData считается свежим (по полю auth_date)
+INIT_DATA_MAX_AGE = int(os.getenv("INIT_DATA_MAX_AGE", str(24 * 3600)))
+# Сколько секунд помним уже проверенный initData
+INIT_DATA_CACHE_TTL = int(os.getenv("INIT_DATA_CACHE_TTL", "600"))
+INIT_DATA_CACHE_SIZE = int(os.getenv("INIT_DATA_CACHE_SIZE", "10000"))
+
+# Эндпоинты, которые без валидного initData не работают
+PROTECTED_PREFIXES = ("/api/sync/", "/api/settings/", "/api/stats")
+
+_secret_key = None
+# sha256(initData) -> (user_id, expires_at)
+_verified = OrderedDict()
+
+
+def configure_auth(bot_token: str):
+    """Derive the WebAppData secret once at startup."""
+    global _secret_key
+    _secret_key = hmac.new(
+        "WebAppData".encode(),
+        bot_token.encode(),
+        hashlib.sha256
+    ).digest()
+    _verified.clear()
+
+
+def _verify(init_data_string: str):
+    """
+    Check the initData signature and freshness.
+
+    Returns:
+        tuple: (user_id, auth_date)
+    """
+    parsed = parse_qs(init_data_string)
+
+    received_hash = parsed.get('hash', [''])[0]
+    if not received_hash:
+        raise ValueError("No hash in initData")
+
+    # Create data check string (all params except hash, sorted alphabetically)
+    data_check_string = '\n'.join(
+        f"{key}={parsed[key][0]}" for key in sorted(parsed.keys()) if key != 'hash'
+    )
+    calculated_hash = hmac.new(
+        _secret_key,
+        data_check_string.encode(),
+        hashlib.sha256
+    ).hexdigest()
+    if not hmac.compare_digest(calculated_hash, received_hash):
+        raise ValueError("Invalid hash")
+
+    try:
+        auth_date = int(parsed.get('auth_date', ['0'])[0])
+    except ValueError:
+        raise ValueError("Invalid auth_date")
+    if time.time() - auth_date > INIT_DATA_MAX_AGE:
+        raise ValueError("initData expired")
+
+    user_json = parsed.get('user', [''])[0]
+    if not user_json:
+        raise ValueError("No user data in initData")
+    user_id = json.loads(user_json).get('id')
+    if not user_id:
+        raise ValueError("No user id in initData")
+    return user_id, auth_date
+
+
+def validate_init_data(init_data_string: str):
+    """
+    Validate Telegram WebApp initData and extract user_id.
+    Verified initData is remembered, so repeated requests cost one dict lookup.
+    Returns user_id if valid, raises ValueError if invalid.
+    """
+    now = time.time()
+    digest = hashlib.sha256(init_data_string.encode()).digest()
+    cached = _verified.get(digest)
+    if cached is not None:
+        user_id, expires_at = cached
+        if now < expires_at:
+            return user_id
+        del _verified[digest]
+
+    try:
+        user_id, auth_date = _verify(init_data_string)
+    except Exception as e:
+        logging.error(f"initData validation failed: {e}")
+        raise ValueError(f"Invalid initData: {e}")
+
+    _verified[digest] = (user_id, min(now + INIT_DATA_CACHE_TTL, auth_date + INIT_DATA_MAX_AGE))
+    if len(_verified) > INIT_DATA_CACHE_SIZE:
+        _verified.popitem(last=False)
+    return user_id
+
+
+@web.middleware
+async def auth_middleware(request, handler):
+    """
+    Attach the Telegram user to the request as request["user_id"].
+
+    initData is required for PROTECTED_PREFIXES and optional elsewhere
+    (request["user_id"] is None when it is missing or invalid).
+    """
+    if request.method == "OPTIONS":
+        return await handler(request)
+
+    protected = request.path.startswith(PROTECTED_PREFIXES)
+    init_data = request.headers.get('X-Telegram-Init-Data', '')
+    request["user_id"] = None
+
+    if not init_data:
+        if protected:
+            return web.json_response(
+                {"error": "Missing initData"},
+                status=401,
+                headers={"Access-Control-Allow-Origin": "*"}
+            )
+        return await handler(request)
+
+    try:
+        request["user_id"] = validate_init_data(init_data)
+    except ValueError as e:
+        if protected:
+            return web.json_response(
+                {"error": str(e)},
+                status=401,
+                headers={"Access-Control-Allow-Origin": "*"}
+            )
+    return await handler(request)
@@ -0,0 +1,124 @@
+import asyncio
+import gzip
+import logging
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from db_manager import snapshot_database
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Куда складывать плановые бэкапы и сколько последних хранить
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
+# Интервал плановых бэкапов в часах (0 - выключены)
+BACKUP_INTERVAL_HOURS = float(os.getenv("BACKUP_INTERVAL_HOURS", "0"))
+# Бот может отправить файл до 50 МБ, режем архив на части с запасом
+PART_SIZE = int(os.getenv("BACKUP_PART_SIZE", str(45 * 1024 * 1024)))
+
+BACKUP_PREFIX = "diet-"
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def _compress(source: str, target_base: str) -> str:
+    """Compress a file with zstd (if installed) or gzip. Returns the archive path."""
+    if zstandard is not None:
+        target = target_base + ".zst"
+        with open(source, "rb") as src, open(target, "wb") as dst:
+            zstandard.ZstdCompressor(level=10, threads=-1).copy_stream(src, dst)
+    else:
+        target = target_base + ".gz"
+        with open(source, "rb") as src, gzip.open(target, "wb", compresslevel=6) as dst:
+            shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+    return target
+
+
+def _split(path: str, part_size: int) -> list:
+    """Split a file into numbered parts of at most part_size bytes (no-op if it fits)."""
+    if os.path.getsize(path) <= part_size:
+        return [path]
+    parts = []
+    with open(path, "rb") as src:
+        while True:
+            part = f"{path}.part{len(parts) + 1:02d}"
+            written = 0
+            with open(part, "wb") as dst:
+                while written < part_size:
+                    chunk = src.read(min(COPY_CHUNK_SIZE, part_size - written))
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    written += len(chunk)
+            if not written:
+                os.remove(part)
+                break
+            parts.append(part)
+    os.remove(path)
+    return parts
+
+
+async def create_backup(directory: str, part_size: int = None) -> list:
+    """
+    Make a consistent compressed snapshot of the database.
+
+    The snapshot is taken with VACUUM INTO on a read connection, so
+    /api/sync/save and other writers are not blocked; compression and
+    splitting run in a worker thread.
+
+    Args:
+        directory: Where to put the archive
+        part_size: Split the archive into parts of this size (None - keep one file)
+
+    Returns:
+        list: Paths of the archive or its parts, in order
+
+    Raises:
+        RuntimeError: The snapshot could not be taken
+    """
+    os.makedirs(directory, exist_ok=True)
+    name = BACKUP_PREFIX + datetime.now().strftime("%Y%m%d-%H%M%S") + ".db"
+    with tempfile.TemporaryDirectory() as tmp:
+        snapshot = os.path.join(tmp, name)
+        if not await snapshot_database(snapshot):
+            raise RuntimeError("Database snapshot failed")
+        size = os.path.getsize(snapshot)
+        archive = await asyncio.to_thread(_compress, snapshot, os.path.join(directory, name))
+    compressed = os.path.getsize(archive)
+    files = await asyncio.to_thread(_split, archive, part_size) if part_size else [archive]
+    logging.info(
+        f"💾 Backup {os.path.basename(archive)}: {size // 1024} KB -> {compressed // 1024} KB"
+        f"{f' in {len(files)} parts' if len(files) > 1 else ''}"
+    )
+    return files
+
+
+def _rotate(directory: str, keep: int):
+    """Delete all but the newest keep backups (with all their parts)."""
+    names = sorted(name for name in os.listdir(directory) if name.startswith(BACKUP_PREFIX))
+    stamps = sorted({name.split(".")[0] for name in names})
+    for stamp in stamps[:-keep] if keep > 0 else []:
+        for name in names:
+            if name.split(".")[0] == stamp:
+                os.remove(os.path.join(directory, name))
+
+
+async def run_scheduled_backup():
+    """Scheduled job: write a backup to BACKUP_DIR and keep the newest BACKUP_KEEP."""
+    try:
+        await create_backup(BACKUP_DIR)
+        await asyncio.to_thread(_rotate, BACKUP_DIR, BACKUP_KEEP)
+    except Exception as e:
+        logging.error(f"❌ Scheduled backup failed: {e}")
+
+
+def restore_hint(files: list) -> str:
+    """How to turn the sent files back into diet.db."""
+    archive = os.path.basename(files[0]).split(".part")[0]
+    unpack = f"zstd -d {archive}" if archive.endswith(".zst") else f"gunzip {archive}"
+    if len(files) > 1:
+        return f"cat {archive}.part* > {archive} && {unpack}"
+    return unpack
@@ -0,0 +1,480 @@
+"""
+Offline load test of the bot backend.
+
+The app runs in a child process, created by main.create_app() and served by
+main.start_web(), against a temporary database. Gemini is replaced by fake
+models with configurable latency, and the Bot API by a local fake server.
+The load generator runs in this process. Every scenario reports throughput and
+p50/p95/p99 latency as JSON; pass --baseline to compare with a previous report.
+
+    python benchmarks/bench.py --output report.json
+    python benchmarks/bench.py --baseline report.json --max-regression 10
+"""
+import argparse
+import asyncio
+import base64
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import aiohttp
+from benchmarks.fakes import FakeTelegramServer, TimedSession, install_fake_gemini
+
+SCENARIOS = ("analyze", "sync_save", "sync_load", "sync_load_cached", "reminders")
+BOT_TOKEN = "123456:BENCHMARKbenchmarkBENCHMARKbench"
+FOOD_NAMES = ("Овсянка", "Плов", "Борщ", "Гречка с курицей", "Салат", "Творог", "Банан", "Омлет")
+
+
+def percentile(ordered: list, q: float):
+    """Nearest-rank percentile of a sorted list."""
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered))) - 1))]
+
+
+def summarize(latencies: list, seconds: float, statuses: Counter = None, **extra) -> dict:
+    ordered = sorted(latencies)
+    ms = lambda value: round(value * 1000, 2) if value is not None else None
+    ok = sum(n for status, n in (statuses or {}).items() if status in ("200", "304"))
+    return {
+        "requests": len(ordered),
+        "errors": len(ordered) - ok if statuses is not None else 0,
+        "statuses": dict(statuses or {}),
+        "seconds": round(seconds, 3),
+        "throughput_rps": round(len(ordered) / seconds, 1) if seconds else None,
+        "latency_ms": {
+            "mean": ms(sum(ordered) / len(ordered)) if ordered else None,
+            "p50": ms(percentile(ordered, 0.50)),
+            "p95": ms(percentile(ordered, 0.95)),
+            "p99": ms(percentile(ordered, 0.99)),
+            "max": ms(ordered[-1] if ordered else None),
+        },
+        **extra,
+    }
+
+
+def init_data(user_id: int) -> str:
+    """Signed Telegram WebApp initData for a user, as the web app sends it."""
+    import hashlib
+    import hmac
+    from urllib.parse import urlencode
+
+    fields = {"auth_date": str(int(time.time())), "user": json.dumps({"id": user_id})}
+    check_string = "\n".join(f"{key}={value}" for key, value in sorted(fields.items()))
+    secret = hmac.new(b"WebAppData", BOT_TOKEN.encode(), hashlib.sha256).digest()
+    fields["hash"] = hmac.new(secret, check_string.encode(), hashlib.sha256).hexdigest()
+    return urlencode(fields)
+
+
+def day_payload(rng: random.Random, day: str, items: int, thumbnail_bytes: int) -> dict:
+    """A synced day the way script.js stores it: totals plus foodHistory with thumbnails."""
+    history = []
+    for index in range(items):
+        history.append({
+            "id": str(rng.randrange(10 ** 12)),
+            "name": rng.choice(FOOD_NAMES),
+            "calories": rng.randint(80, 900),
+            "protein": rng.randint(1, 60),
+            "carbs": rng.randint(0, 120),
+            "fats": rng.randint(0, 50),
+            "time": f"{8 + index * 3 % 14:02d}:{rng.randrange(60):02d}",
+            "thumbnail": "data:image/jpeg;base64," + base64.b64encode(rng.randbytes(thumbnail_bytes)).decode(),
+            "date": day,
+        })
+    totals = {key: sum(item[key] for item in history) for key in ("calories", "protein", "carbs", "fats")}
+    return {**totals, "foodHistory": history}
+
+
+def make_photos(count: int, size: tuple, seed: int) -> list:
+    """Distinct JPEG "meal photos" (so every request misses the analysis cache)."""
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(seed)
+    photos = []
+    for _ in range(count):
+        img = Image.new("RGB", size, tuple(rng.randrange(256) for _ in range(3)))
+        draw = ImageDraw.Draw(img)
+        for _ in range(40):
+            x, y = rng.randrange(size[0]), rng.randrange(size[1])
+            r = rng.randrange(20, size[0] // 4)
+            draw.ellipse((x - r, y - r, x + r, y + r), fill=tuple(rng.randrange(256) for _ in range(3)))
+        noise = Image.effect_noise(size, 30).convert("RGB")
+        img = Image.blend(img, noise, 0.15)
+        out = io.BytesIO()
+        img.save(out, "JPEG", quality=90)
+        photos.append(out.getvalue())
+    return photos
+
+
+# --- Процесс приложения ---
+
+def app_process(config: dict, conn):
+    # stdout занят JSON-отчётом, логи и print приложения уходят в stderr
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    os.environ.update(config["env"])
+    asyncio.run(_serve(config, conn))
+
+
+async def _seed_history(config: dict) -> dict:
+    """Fill the database with `users` x `history_days` synced days through the regular write path."""
+    import db_manager
+
+    rng = random.Random(config["seed"])
+    started = time.perf_counter()
+    today = date.today()
+    rows = 0
+    for user_id in range(1, config["users"] + 1):
+        for offset in range(config["history_days"]):
+            day = (today - timedelta(days=offset)).isoformat()
+            payload = day_payload(rng, day, config["items_per_day"], config["thumbnail_bytes"])
+            await db_manager.queue_food_data(user_id, day, json.dumps(payload), durable=False)
+            rows += 1
+            if rows % 5000 == 0:
+                await db_manager.flush_food_data()
+    await db_manager.flush_food_data()
+    compacted = 0
+    if config["cold_storage"]:
+        compacted = (await db_manager.compact_food_logs())[0]
+    # Свежие строки лежат в -wal, пока их не перенесёт checkpoint
+    async with db_manager._write() as db:
+        await db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    wal_path = config["db_path"] + "-wal"
+    return {
+        "rows": rows,
+        "cold_rows": compacted,
+        "db_bytes": os.path.getsize(config["db_path"]) + (os.path.getsize(wal_path) if os.path.exists(wal_path) else 0),
+        "seconds": round(time.perf_counter() - started, 1),
+    }
+
+
+async def _fanout(main, session, count: int) -> dict:
+    """Send one meal reminder to `count` users through main.send_meal_reminder."""
+    from db_manager import mark_reminders_sent
+
+    user_ids = list(range(10 ** 6, 10 ** 6 + count))
+    today = date.today().isoformat()
+
+    async def on_sent(sent_ids):
+        await mark_reminders_sent("breakfast", today, sent_ids)
+
+    session.durations.clear()
+    started = time.perf_counter()
+    await main.send_meal_reminder("breakfast", user_ids, on_sent)
+    return {"durations": list(session.durations), "seconds": time.perf_counter() - started}
+
+
+async def _serve(config: dict, conn):
+    import ai_manager
+    import broadcast_manager
+    import db_manager
+    import image_manager
+    import main
+    from aiogram.client.telegram import TelegramAPIServer
+
+    db_manager.DB_PATH = config["db_path"]
+    install_fake_gemini(config["gemini_latency"], config["gemini_jitter"], config["seed"])
+    session = TimedSession(api=TelegramAPIServer.from_base(config["telegram_url"]))
+    main.bot.session = session
+    if config["send_rate"]:
+        broadcast_manager.bucket = broadcast_manager.TokenBucket(config["send_rate"], config["send_rate"])
+
+    image_manager.init_image_pool()
+    await db_manager.init_database()
+    await main.init_nutrition_index()
+    await ai_manager.init_models()
+    await main.init_quotas()
+    runner = None
+    try:
+        seeded = await _seed_history(config)
+        runner = await main.start_web(main.create_app(), config["port"])
+        conn.send(("ready", seeded))
+        while True:
+            command, argument = await asyncio.to_thread(conn.recv)
+            if command == "reminders":
+                conn.send(await _fanout(main, session, argument))
+            else:
+                break
+    except Exception as e:
+        conn.send(("error", repr(e)))
+        raise
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+        await main.bot.session.close()
+        await db_manager.close_database()
+        image_manager.shutdown_image_pool()
+
+
+# --- Генератор нагрузки ---
+
+async def closed_loop(count: int, concurrency: int, request) -> dict:
+    """Run request(i) for i in range(count) with `concurrency` requests in flight."""
+    latencies = []
+    statuses = Counter()
+    indexes = iter(range(count))
+
+    async def worker():
+        for index in indexes:
+            started = time.perf_counter()
+            try:
+                status = await request(index)
+            except Exception as e:
+                status = type(e).__name__
+            latencies.append(time.perf_counter() - started)
+            statuses[str(status)] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, time.perf_counter() - started, statuses)
+
+
+async def run_analyze(http, base: str, args):
+    photos = make_photos(min(args.requests, args.distinct_photos), args.photo_size, args.seed)
+
+    async def request(index):
+        form = aiohttp.FormData()
+        form.add_field("image", photos[index % len(photos)], filename="meal.jpg", content_type="image/jpeg")
+        headers = {"X-Telegram-Init-Data": init_data(index % args.users + 1)}
+        async with http.post(f"{base}/api/analyze", data=form, headers=headers) as response:
+            await response.read()
+            return response.status
+
+    return await closed_loop(args.requests, args.concurrency, request)
+
+
+async def run_sync_save(http, base: str, args):
+    rng = random.Random(args.seed)
+    today = date.today()
+    bodies = [
+        json.dumps({
+            "date": (today - timedelta(days=rng.randrange(3))).isoformat(),
+            "foodData": day_payload(rng, today.isoformat(), args.items_per_day, args.thumbnail_bytes),
+            "durable": args.durable,
+        })
+        for _ in range(min(args.requests, 500))
+    ]
+
+    async def request(index):
+        headers = {"X-Telegram-Init-Data": init_data(index % args.users + 1), "Content-Type": "application/json"}
+        async with http.post(f"{base}/api/sync/save", data=bodies[index % len(bodies)], headers=headers) as response:
+            await response.read()
+            return response.status
+
+    return await closed_loop(args.requests, args.concurrency, request)
+
+
+async def run_sync_load(http, base: str, args, conditional: bool = False):
+    etags = {}
+    received = []
+
+    async def request(index):
+        user_id = index % args.users + 1
+        headers = {"X-Telegram-Init-Data": init_data(user_id), "Accept-Encoding": "gzip, deflate, br"}
+        if conditional and user_id in etags:
+            headers["If-None-Match"] = etags[user_id]
+        async with http.get(f"{base}/api/sync/load", headers=headers, auto_decompress=False) as response:
+            body = await response.read()
+            received.append(len(body))
+            etags[user_id] = response.headers.get("ETag")
+            return response.status
+
+    if conditional:
+        # Сначала каждый пользователь получает ETag, дальше меряем повторные загрузки
+        await closed_loop(args.users, args.concurrency, request)
+        received.clear()
+    result = await closed_loop(args.requests, args.concurrency, request)
+    result["mean_response_bytes"] = round(sum(received) / len(received)) if received else 0
+    return result
+
+
+async def run_reminders(conn, args):
+    conn.send(("reminders", args.fanout_users))
+    result = await asyncio.to_thread(conn.recv)
+    return summarize(result["durations"], result["seconds"], sent=len(result["durations"]))
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args) -> dict:
+    telegram = FakeTelegramServer(args.telegram_latency)
+    telegram_url = await telegram.start()
+    port = free_port()
+    workdir = tempfile.mkdtemp(prefix="diet-bench-")
+    config = {
+        "db_path": os.path.join(workdir, "diet.db"),
+        "port": port,
+        "telegram_url": telegram_url,
+        "seed": args.seed,
+        "users": args.users,
+        "history_days": args.history_days,
+        "items_per_day": args.items_per_day,
+        "thumbnail_bytes": args.thumbnail_bytes,
+        "cold_storage": not args.no_cold_storage,
+        "gemini_latency": args.gemini_latency,
+        "gemini_jitter": args.gemini_jitter,
+        "send_rate": args.send_rate,
+        "env": {
+            "BOT_TOKEN": BOT_TOKEN,
+            "GOOGLE_API_KEY": "benchmark",
+            "WORKERS": "1",
+            "WEBHOOK_URL": "",
+            "IMAGE_WORKERS": str(args.image_workers),
+            # Лимиты не должны влиять на замер
+            **{f"QUOTA_{name}": "1000000000" for name in (
+                "USER_PER_MINUTE", "USER_BURST", "IP_PER_MINUTE", "IP_BURST",
+                "USER_DAILY", "IP_DAILY", "GLOBAL_PER_MINUTE", "GLOBAL_BURST",
+            )},
+        },
+    }
+
+    context = multiprocessing.get_context("spawn")
+    conn, child_conn = context.Pipe()
+    process = context.Process(target=app_process, args=(config, child_conn), name="bench-app")
+    process.start()
+    status, seeded = await asyncio.to_thread(conn.recv)
+    if status != "ready":
+        process.join()
+        raise RuntimeError(f"App process failed: {seeded}")
+
+    base = f"http://127.0.0.1:{port}"
+    results = {}
+    try:
+        connector = aiohttp.TCPConnector(limit=0)
+        async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=120)) as http:
+            for name in args.scenarios:
+                print(f"▶ {name}", file=sys.stderr)
+                if name == "analyze":
+                    results[name] = await run_analyze(http, base, args)
+                elif name == "sync_save":
+                    results[name] = await run_sync_save(http, base, args)
+                elif name == "sync_load":
+                    results[name] = await run_sync_load(http, base, args)
+                elif name == "sync_load_cached":
+                    results[name] = await run_sync_load(http, base, args, conditional=True)
+                elif name == "reminders":
+                    results[name] = await run_reminders(conn, args)
+    finally:
+        conn.send(("stop", None))
+        await asyncio.to_thread(process.join, 60)
+        await telegram.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "meta": {
+            "revision": git_revision(),
+            "timestamp": int(time.time()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "args": {key: value for key, value in vars(args).items() if key not in ("baseline", "output")},
+            "dataset": seeded,
+            "telegram_calls": telegram.calls,
+        },
+        "scenarios": results,
+    }
+
+
+def compare(report: dict, baseline: dict, max_regression: float = None) -> bool:
+    """
+    Print the change against a baseline report.
+
+    Returns:
+        bool: False if throughput dropped or p99 grew by more than max_regression percent
+    """
+    ok = True
+    print(f"{'scenario':<18}{'rps':>12}{'p50 ms':>14}{'p95 ms':>14}{'p99 ms':>14}", file=sys.stderr)
+    for name, current in report["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if not previous:
+            continue
+
+        def change(new, old):
+            return (new - old) / old * 100 if new is not None and old else 0.0
+
+        rps = change(current["throughput_rps"], previous["throughput_rps"])
+        latency = {q: change(current["latency_ms"][q], previous["latency_ms"][q]) for q in ("p50", "p95", "p99")}
+        print(
+            f"{name:<18}{rps:>+11.1f}%" + "".join(f"{latency[q]:>+13.1f}%" for q in ("p50", "p95", "p99")),
+            file=sys.stderr
+        )
+        if max_regression is not None and (rps < -max_regression or latency["p99"] > max_regression):
+            ok = False
+    return ok
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", type=lambda value: value.split(","), default=list(SCENARIOS),
+                        help=f"Comma-separated subset of: {', '.join(SCENARIOS)}")
+    parser.add_argument("--requests", type=int, default=1000, help="Requests per HTTP scenario")
+    parser.add_argument("--concurrency", type=int, default=32, help="Requests in flight")
+    parser.add_argument("--users", type=int, default=200, help="Users with synced history")
+    parser.add_argument("--history-days", type=int, default=180, help="Synced days per user")
+    parser.add_argument("--items-per-day", type=int, default=5, help="Meals per synced day")
+    parser.add_argument("--thumbnail-bytes", type=int, default=3000, help="Size of every meal thumbnail")
+    parser.add_argument("--no-cold-storage", action="store_true", help="Do not compact old days after seeding")
+    parser.add_argument("--durable", action="store_true", help="Send durable /api/sync/save requests")
+    parser.add_argument("--distinct-photos", type=int, default=200, help="Distinct photos for analyze (cache misses)")
+    parser.add_argument("--photo-size", type=lambda value: tuple(map(int, value.split("x"))), default=(1600, 1200))
+    parser.add_argument("--image-workers", type=int, default=2, help="IMAGE_WORKERS of the app")
+    parser.add_argument("--gemini-latency", type=float, default=0.8, help="Mean fake Gemini latency, seconds")
+    parser.add_argument("--gemini-jitter", type=float, default=0.2, help="Standard deviation of the latency")
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="Fake Bot API latency, seconds")
+    parser.add_argument("--fanout-users", type=int, default=100_000, help="Recipients of the reminder fan-out")
+    parser.add_argument("--send-rate", type=float, default=1_000_000,
+                        help="Broadcast rate limit for the fan-out (0 keeps BROADCAST_RATE)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", help="Previous report to compare with")
+    parser.add_argument("--max-regression", type=float, help="Exit with 1 if p99 or throughput regress by more percent")
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.baseline:
+        with open(args.baseline) as f:
+            if not compare(report, json.load(f), args.max_regression):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
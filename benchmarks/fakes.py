@@ -0,0 +1,133 @@
+import asyncio
+import json
+import random
+import time
+from types import SimpleNamespace
+from aiohttp import web
+from aiogram.client.session.aiohttp import AiohttpSession
+
+# Ответ "модели" на фото: такой же JSON, как просит DEFAULT_ANALYZE_PROMPT
+FOOD_REPLY = json.dumps({
+    "product_name": "Плов с курицей",
+    "calories": 610,
+    "protein": 24,
+    "carbs": 72,
+    "fats": 25,
+}, ensure_ascii=False)
+
+
+class FakeGeminiModel:
+    """
+    Stand-in for genai.GenerativeModel: answers after a random delay
+    (normal around latency, never below 0) and reports token usage.
+    """
+
+    def __init__(self, name: str, latency: float, jitter: float, rng: random.Random):
+        self.model_name = f"models/{name}"
+        self.latency = latency
+        self.jitter = jitter
+        self.rng = rng
+        self.calls = 0
+
+    def _delay(self) -> float:
+        return max(0.0, self.rng.gauss(self.latency, self.jitter))
+
+    async def generate_content_async(self, contents, generation_config=None, stream=False):
+        self.calls += 1
+        usage = SimpleNamespace(prompt_token_count=1290, candidates_token_count=60)
+        if stream:
+            return _FakeStream(FOOD_REPLY, self._delay(), usage)
+        await asyncio.sleep(self._delay())
+        return SimpleNamespace(text=FOOD_REPLY, usage_metadata=usage)
+
+
+class _FakeStream:
+    """Async iterator of reply chunks, spread over the response time."""
+
+    def __init__(self, text: str, delay: float, usage, chunks: int = 4):
+        size = -(-len(text) // chunks)
+        self.parts = [text[i:i + size] for i in range(0, len(text), size)]
+        self.delay = delay
+        self.usage_metadata = usage
+
+    async def __aiter__(self):
+        for part in self.parts:
+            await asyncio.sleep(self.delay / len(self.parts))
+            yield SimpleNamespace(text=part)
+
+
+def install_fake_gemini(latency: float, jitter: float, seed: int = 0):
+    """
+    Route ai_manager to fake models. Call before ai_manager.init_models().
+
+    Returns:
+        dict: Model name -> FakeGeminiModel
+    """
+    import ai_manager
+
+    rng = random.Random(seed)
+    names = [ai_manager.GEMINI_MODEL] + ai_manager.FALLBACK_MODELS
+    models = {name: FakeGeminiModel(name, latency, jitter, rng) for name in names}
+    ai_manager.list_generation_models = lambda: list(models)
+    ai_manager.get_model = lambda name=ai_manager.GEMINI_MODEL: models[name]
+    return models
+
+
+class FakeTelegramServer:
+    """
+    Minimal Bot API on localhost: every method succeeds after `latency` seconds,
+    sendMessage returns a Message so aiogram can parse it.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = {}
+        self._runner = None
+        self.url = None
+
+    async def _handle(self, request):
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        result = True
+        if method == "sendMessage":
+            data = await request.post() if request.content_type != "application/json" else await request.json()
+            result = {
+                "message_id": self.calls[method],
+                "date": int(time.time()),
+                "chat": {"id": int(data.get("chat_id", 0)), "type": "private"},
+                "text": data.get("text", ""),
+            }
+        elif method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench"}
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self, port: int = 0):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", port)
+        await site.start()
+        self.url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+class TimedSession(AiohttpSession):
+    """aiogram session that keeps the duration of every Bot API call."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.durations = []
+
+    async def make_request(self, bot, method, timeout=None):
+        started = time.perf_counter()
+        try:
+            return await super().make_request(bot, method, timeout)
+        finally:
+            self.durations.append(time.perf_counter() - started)
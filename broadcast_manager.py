@@ -0,0 +1,221 @@
+import asyncio
+import logging
+import os
+import time
+from aiogram.exceptions import (
+    TelegramRetryAfter, TelegramNetworkError, TelegramServerError, TelegramForbiddenError, TelegramBadRequest
+)
+from db_manager import record_deliveries
+from metrics_manager import Counter, Histogram
+
+# Глобальный лимит Telegram ~30 сообщений в секунду на бота, держим запас
+RATE_LIMIT = float(os.getenv("BROADCAST_RATE", "25"))
+# Сколько отправок выполняется одновременно
+CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+# Повторы при сетевых ошибках и 5xx от Telegram
+MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))
+# Как часто сообщать о прогрессе, секунды
+PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "5"))
+# Результаты доставки пишем в БД пачками такого размера или не реже раза в RECORD_INTERVAL секунд:
+# после сбоя повторно получат сообщение не больше пачки пользователей
+RECORD_BATCH_SIZE = 50
+RECORD_INTERVAL = 1.0
+
+
+class TokenBucket:
+    """
+    Token bucket shared by every sender of the bot.
+    The bucket is per process: bulk sends (broadcasts, reminders) run only on the leader worker.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Stop handing out tokens (Telegram flood control applies to the whole bot)."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class BroadcastStats:
+    def __init__(self, total=None, on_done=None):
+        self.total = total
+        self.on_done = on_done
+        self.sent = 0
+        self.failed = 0
+        self.blocked = 0
+        self.started = time.monotonic()
+        # Ещё не записанные в БД исходы доставки
+        self.outcomes = {"sent": [], "failed": [], "blocked": []}
+        self.recorded_at = self.started
+
+    @property
+    def done(self) -> int:
+        return self.sent + self.failed + self.blocked
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    async def record(self, user_id: int, outcome: str):
+        self.outcomes[outcome].append(user_id)
+        if (sum(len(ids) for ids in self.outcomes.values()) >= RECORD_BATCH_SIZE
+                or time.monotonic() - self.recorded_at >= RECORD_INTERVAL):
+            await self.flush()
+
+    async def flush(self):
+        """Store pending outcomes and report recipients with a final outcome to on_done."""
+        outcomes = self.outcomes
+        self.outcomes = {"sent": [], "failed": [], "blocked": []}
+        self.recorded_at = time.monotonic()
+        if any(outcomes.values()):
+            await record_deliveries(outcomes["sent"], outcomes["failed"], outcomes["blocked"])
+        done = outcomes["sent"] + outcomes["failed"] + outcomes["blocked"]
+        if self.on_done is not None and done:
+            await self.on_done(done)
+
+
+bucket = TokenBucket(RATE_LIMIT, RATE_LIMIT)
+
+MESSAGES = Counter("diet_messages_total", "Bot messages by kind (broadcast, reminder) and outcome", ("kind", "outcome"))
+SEND_LATENCY = Histogram("diet_message_send_seconds", "Bot API send calls including retries", ("kind",))
+FLOOD_PAUSES = Counter("diet_telegram_flood_pauses_total", "Pauses imposed by Telegram flood control")
+
+
+async def _send_one(user_id: int, send, stats: BroadcastStats) -> str:
+    """
+    Deliver to one user, retrying flood control and transient errors.
+
+    Returns:
+        str: "sent", "blocked", "failed" (recipient-side error) or "error" (our side or transient)
+    """
+    attempt = 0
+    while True:
+        await bucket.acquire()
+        try:
+            await send(user_id)
+            stats.sent += 1
+            return "sent"
+        except TelegramRetryAfter as e:
+            logging.warning(f"⏳ Flood control, pausing for {e.retry_after}s")
+            FLOOD_PAUSES.inc()
+            bucket.pause(e.retry_after)
+        except TelegramForbiddenError:
+            # Пользователь заблокировал бота или удалил аккаунт
+            stats.blocked += 1
+            return "blocked"
+        except (TelegramNetworkError, TelegramServerError) as e:
+            attempt += 1
+            if attempt > MAX_RETRIES:
+                logging.error(f"❌ Ошибка отправки пользователю {user_id}: {e}")
+                stats.failed += 1
+                return "error"
+            await asyncio.sleep(2 ** attempt)
+        except TelegramBadRequest as e:
+            # Например, "chat not found"
+            logging.error(f"❌ Ошибка отправки пользователю {user_id}: {e}")
+            stats.failed += 1
+            return "failed"
+        except Exception as e:
+            logging.error(f"❌ Ошибка отправки пользователю {user_id}: {e}")
+            stats.failed += 1
+            return "error"
+
+
+async def _feed(user_ids, queue: asyncio.Queue):
+    if hasattr(user_ids, "__aiter__"):
+        async for user_id in user_ids:
+            await queue.put(user_id)
+    else:
+        for user_id in user_ids:
+            await queue.put(user_id)
+    for _ in range(CONCURRENCY):
+        await queue.put(None)
+
+
+async def _worker(queue: asyncio.Queue, send, stats: BroadcastStats, kind: str):
+    while True:
+        user_id = await queue.get()
+        if user_id is None:
+            return
+        started = time.monotonic()
+        outcome = await _send_one(user_id, send, stats)
+        SEND_LATENCY.observe(time.monotonic() - started, kind)
+        MESSAGES.inc(kind, outcome)
+        # Сбой на нашей стороне (сеть, 5xx) не считаем проблемой получателя
+        if outcome != "error":
+            await stats.record(user_id, outcome)
+
+
+async def _report(on_progress, stats: BroadcastStats):
+    try:
+        await on_progress(stats)
+    except Exception as e:
+        logging.warning(f"⚠️ Failed to report broadcast progress: {e}")
+
+
+async def broadcast(user_ids, send, on_progress=None, total=None, on_done=None, kind="broadcast") -> BroadcastStats:
+    """
+    Send a message to many users under the global rate limit.
+    Delivery outcomes are stored in the users table every RECORD_BATCH_SIZE
+    messages or RECORD_INTERVAL seconds.
+
+    Args:
+        user_ids: List or async iterator of Telegram user IDs
+        send: Coroutine function send(user_id) performing one Bot API call
+        on_progress: Optional coroutine function called with BroadcastStats
+            every PROGRESS_INTERVAL seconds and once at the end
+        total: Number of recipients, if user_ids has no len()
+        on_done: Optional coroutine function called with batches of user IDs whose delivery
+            is settled (sent, failed or blocked); users hit by a transient error on our
+            side are not included, so the caller can retry them
+        kind: Label of the messages in metrics ("broadcast", "reminder")
+
+    Returns:
+        BroadcastStats: Delivery counters
+    """
+    stats = BroadcastStats(len(user_ids) if hasattr(user_ids, "__len__") else total, on_done)
+    queue = asyncio.Queue(maxsize=CONCURRENCY * 2)
+    workers = [asyncio.create_task(_worker(queue, send, stats, kind)) for _ in range(CONCURRENCY)]
+    feeder = asyncio.create_task(_feed(user_ids, queue))
+    try:
+        if on_progress is None:
+            await asyncio.gather(feeder, *workers)
+        else:
+            finished = asyncio.gather(feeder, *workers)
+            while True:
+                try:
+                    await asyncio.wait_for(asyncio.shield(finished), timeout=PROGRESS_INTERVAL)
+                    break
+                except asyncio.TimeoutError:
+                    await _report(on_progress, stats)
+            await _report(on_progress, stats)
+    finally:
+        feeder.cancel()
+        for worker in workers:
+            worker.cancel()
+        await stats.flush()
+    logging.info(
+        f"📢 Broadcast finished in {stats.elapsed:.1f}s: "
+        f"{stats.sent} sent, {stats.failed} failed, {stats.blocked} blocked"
+    )
+    return stats
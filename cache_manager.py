@@ -0,0 +1,190 @@
+import asyncio
+import hashlib
+import io
+import logging
+import os
+import time
+from collections import OrderedDict
+from metrics_manager import Counter
+from db_manager import get_cached_analysis, find_cached_analysis_by_phash, save_cached_analysis, prune_analysis_cache
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Сколько результатов держим в памяти
+MEMORY_CACHE_SIZE = int(os.getenv("ANALYSIS_CACHE_SIZE", "512"))
+# Время жизни результата, секунды (по умолчанию неделя)
+CACHE_TTL = int(os.getenv("ANALYSIS_CACHE_TTL", str(7 * 24 * 3600)))
+# Максимум записей в SQLite
+MAX_PERSISTENT_ENTRIES = int(os.getenv("ANALYSIS_CACHE_MAX_ROWS", "20000"))
+# Искать почти одинаковые фото по перцептивному хэшу (нужен Pillow)
+NEAR_DUPLICATES = os.getenv("ANALYSIS_CACHE_NEAR_DUPLICATES", "0") == "1"
+# Максимальное расстояние Хэмминга между хэшами для "того же" фото (в SQLite ищутся расстояния до 7)
+PHASH_MAX_DISTANCE = int(os.getenv("ANALYSIS_CACHE_PHASH_DISTANCE", "4"))
+# Чистим SQLite-кэш после каждых N новых записей
+PRUNE_EVERY = 100
+
+# key -> (created_at, scope, phash, result)
+_memory = OrderedDict()
+# key -> Future с результатом запроса, который уже выполняется
+_inflight = {}
+_inserts_since_prune = 0
+
+CACHE_REQUESTS = Counter(
+    "diet_analysis_cache_requests_total",
+    "Photo analysis lookups by result: memory, db, similar (near-duplicate), joined (in-flight) or miss",
+    ("result",)
+)
+
+
+class _LeaderCancelled(Exception):
+    """The call computing a shared result was cancelled; waiting callers retry."""
+
+
+def make_scope(prompt: str, model: str) -> str:
+    """Hash of everything except the image that influences the result."""
+    return hashlib.sha256(f"{model}\0{prompt}".encode()).hexdigest()
+
+
+def make_key(image_data: bytes, scope: str) -> str:
+    """Content address of an analysis request."""
+    digest = hashlib.sha256(scope.encode())
+    digest.update(image_data)
+    return digest.hexdigest()
+
+
+def image_phash(image_data: bytes):
+    """
+    64-bit difference hash of the image, stored as a signed integer for SQLite.
+    Returns None if Pillow is not installed or the image cannot be decoded.
+    """
+    if Image is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(image_data)) as img:
+            img.draft("L", (64, 64))
+            pixels = list(img.convert("L").resize((9, 8)).getdata())
+    except Exception:
+        return None
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (left > right)
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def _distance(a: int, b: int) -> int:
+    return bin((a ^ b) & 0xFFFFFFFFFFFFFFFF).count("1")
+
+
+def _memory_get(key: str, scope: str, phash, now: float):
+    entry = _memory.get(key)
+    if entry and entry[0] >= now - CACHE_TTL:
+        _memory.move_to_end(key)
+        return entry[3]
+    if phash is None:
+        return None
+    for other_key, (created_at, other_scope, other_phash, result) in reversed(_memory.items()):
+        if (other_scope == scope and other_phash is not None and created_at >= now - CACHE_TTL
+                and _distance(phash, other_phash) <= PHASH_MAX_DISTANCE):
+            _memory.move_to_end(other_key)
+            return result
+    return None
+
+
+def _memory_put(key: str, scope: str, phash, result: dict, created_at: float):
+    _memory[key] = (created_at, scope, phash, result)
+    _memory.move_to_end(key)
+    while len(_memory) > MEMORY_CACHE_SIZE:
+        _memory.popitem(last=False)
+
+
+async def _lookup(key: str, scope: str, phash, now: float):
+    result = _memory_get(key, scope, phash, now)
+    if result is not None:
+        CACHE_REQUESTS.inc("memory")
+        return result
+    result = await get_cached_analysis(key, now - CACHE_TTL)
+    source = "db"
+    if result is None and phash is not None:
+        result = await find_cached_analysis_by_phash(scope, phash, now - CACHE_TTL, PHASH_MAX_DISTANCE)
+        source = "similar"
+    if result is not None:
+        CACHE_REQUESTS.inc(source)
+        _memory_put(key, scope, phash, result, now)
+    return result
+
+
+async def _store(key: str, scope: str, phash, result: dict):
+    global _inserts_since_prune
+    now = time.time()
+    _memory_put(key, scope, phash, result, now)
+    await save_cached_analysis(key, scope, phash, result, now)
+    _inserts_since_prune += 1
+    if _inserts_since_prune >= PRUNE_EVERY:
+        _inserts_since_prune = 0
+        deleted = await prune_analysis_cache(now - CACHE_TTL, MAX_PERSISTENT_ENTRIES)
+        if deleted:
+            logging.info(f"🧹 Pruned {deleted} analysis cache entries")
+
+
+async def get_or_analyze(image_data: bytes, prompt: str, model: str, analyze):
+    """
+    Return a cached analysis result or compute it once.
+
+    Concurrent calls for the same image/prompt/model wait for a single
+    upstream call instead of starting their own. If the call that started it
+    is cancelled (e.g. its client disconnected), the first waiting call takes over.
+
+    Args:
+        image_data: Decoded image bytes
+        prompt: Prompt sent along with the image
+        model: Model name the result is produced with
+        analyze: Coroutine function returning the result dict
+
+    Returns:
+        dict: Analysis result
+    """
+    scope = make_scope(prompt, model)
+    key = make_key(image_data, scope)
+
+    while True:
+        pending = _inflight.get(key)
+        if pending is None:
+            break
+        CACHE_REQUESTS.inc("joined")
+        try:
+            return await asyncio.shield(pending)
+        except _LeaderCancelled:
+            # Ключ уже убран из _inflight: первый проснувшийся станет новым ведущим
+            continue
+
+    future = asyncio.get_running_loop().create_future()
+    _inflight[key] = future
+    try:
+        phash = await asyncio.to_thread(image_phash, image_data) if NEAR_DUPLICATES else None
+        result = await _lookup(key, scope, phash, time.time())
+        if result is None:
+            CACHE_REQUESTS.inc("miss")
+            result = await analyze()
+            # Не кэшируем ответы, которые не удалось разобрать как JSON
+            if not (isinstance(result, dict) and "raw_text" in result):
+                await _store(key, scope, phash, result)
+        future.set_result(result)
+        return result
+    except asyncio.CancelledError:
+        # Ожидающие не должны падать из-за отмены чужого запроса
+        future.set_exception(_LeaderCancelled())
+        future.exception()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        # Ошибку получат ожидающие; здесь просто помечаем её как прочитанную
+        future.exception()
+        raise
+    finally:
+        del _inflight[key]
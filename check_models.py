@@ -1,6 +1,7 @@
 import os
 import google.generativeai as genai
 from dotenv import load_dotenv
+from ai_manager import list_generation_models
 
 # 1. Загружаем ключ
 load_dotenv()
@@ -19,12 +20,11 @@ print("\n📡 Стучимся в Google, спрашиваем список мо
 
 try:
     # 3. Получаем список
+    # Нам нужны только те, которые умеют генерировать текст/контент (тот же список видит бот)
     found_any = False
-    for m in genai.list_models():
-        # Нам нужны только те, которые умеют генерировать текст/контент
-        if 'generateContent' in m.supported_generation_methods:
-            print(f"✅ Доступна модель: {m.name}")
-            found_any = True
+    for name in list_generation_models():
+        print(f"✅ Доступна модель: {name}")
+        found_any = True
             
     if not found_any:
         print("⚠️ Список пуст. Возможно, ключ неверный или нет прав.")
@@ -1,14 +1,273 @@
 import aiosqlite
+import asyncio
 import json
 import logging
-from datetime import datetime
+import os
+import re
+import time
+import zlib
+from collections import Counter
+from contextlib import asynccontextmanager
+from datetime import datetime, date as date_type, timedelta, timezone
+from metrics_manager import Histogram, timed, DB_BUCKETS
+from food_cache_manager import get_day, put_day, invalidate_user
 
 DB_PATH = "diet.db"
 
+# Number of read-only connections kept open next to the single writer
+READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", "4"))
+# Per-connection cache of compiled statements (sqlite3 reuses them by SQL text)
+STATEMENT_CACHE_SIZE = 256
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-16000",
+)
+
+# Users with this many consecutive failed deliveries are skipped by broadcasts
+MAX_DELIVERY_FAILURES = int(os.getenv("MAX_DELIVERY_FAILURES", "5"))
+
+# Write-behind buffer for /api/sync/save: flush interval (seconds) and size threshold
+FLUSH_INTERVAL = float(os.getenv("SYNC_FLUSH_INTERVAL", "0.5"))
+FLUSH_THRESHOLD = int(os.getenv("SYNC_FLUSH_THRESHOLD", "200"))
+
+# Daily totals extracted from food_json into their own columns (and rolled up by week/month)
+NUTRIENT_COLUMNS = ("calories", "protein", "carbs", "fats")
+ROLLUP_PERIODS = ("week", "month")
+
+# Cold storage: days older than this are kept zlib-compressed with a shared dictionary
+COLD_STORAGE_DAYS = int(os.getenv("COLD_STORAGE_DAYS", "30"))
+COMPACT_BATCH_SIZE = 500
+# zlib uses at most 32 KB of a preset dictionary
+DICTIONARY_SIZE = 32 * 1024
+DICTIONARY_SAMPLE_ROWS = 2000
+_JSON_FRAGMENT_RE = re.compile(r'"[^"\\]{1,40}"\s*:\s*|"[^"\\]{1,40}"|[\d.]+')
+
+# Near-duplicate photos: the 64-bit perceptual hash is indexed as 8 one-byte bands, so any
+# hash within Hamming distance 7 shares at least one band; at most this many candidates are compared
+PHASH_BANDS = 8
+PHASH_CANDIDATES = 256
+
+DB_LATENCY = Histogram("diet_db_query_seconds", "Duration of db_manager calls", ("function",), buckets=DB_BUCKETS)
+
+_writer = None
+_write_lock = asyncio.Lock()
+_readers = None
+_reader_conns = []
+
+# (user_id, date) -> (food_json, updated_at); only the latest version per day is kept
+_pending_food = {}
+# Rows of the flush in progress: still visible to readers until the transaction commits
+_flushing = {}
+# (user_id, date), future resolved with the result of the next flush (durable saves)
+_flush_waiters = []
+# Newest updated_at handed out or seen in the database; versions never go below it
+_last_version = ""
+_flush_wakeup = asyncio.Event()
+_flush_task = None
+_flush_stopping = False
+# dict_id -> zlib preset dictionary
+_dictionaries = {}
+
+
+class StaleWriteError(Exception):
+    """Raised for a durable save when the database already has a newer version of the day."""
+
+
+def _timed(func):
+    """Observe the duration of a db_manager function in DB_LATENCY, labelled with its name."""
+    return timed(DB_LATENCY, func.__name__)(func)
+
+
+async def _connect():
+    """Open a connection with the shared pragmas applied."""
+    db = await aiosqlite.connect(DB_PATH, cached_statements=STATEMENT_CACHE_SIZE)
+    db.row_factory = aiosqlite.Row
+    for pragma in PRAGMAS:
+        await db.execute(pragma)
+    return db
+
+
+@asynccontextmanager
+async def _write():
+    """
+    Borrow the writer connection.
+    Writes are serialized; the transaction is committed on success and rolled back on error.
+    """
+    async with _write_lock:
+        try:
+            yield _writer
+            await _writer.commit()
+        except BaseException:
+            await _writer.rollback()
+            raise
+
+
+@asynccontextmanager
+async def _read():
+    """Borrow a connection from the read pool."""
+    db = await _readers.get()
+    try:
+        yield db
+    finally:
+        _readers.put_nowait(db)
+
+
+async def _add_missing_columns(db, table: str, columns: dict):
+    """Add columns introduced after the table was first created."""
+    async with db.execute(f"PRAGMA table_info({table})") as cursor:
+        existing = {row['name'] for row in await cursor.fetchall()}
+    for name, definition in columns.items():
+        if name not in existing:
+            await db.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+
+
+def _compress_food(food_json: str, dictionary: bytes) -> bytes:
+    compressor = zlib.compressobj(level=9, zdict=dictionary)
+    return compressor.compress(food_json.encode()) + compressor.flush()
+
+
+def _decompress_food(blob: bytes, dictionary: bytes) -> str:
+    decompressor = zlib.decompressobj(zdict=dictionary)
+    return (decompressor.decompress(blob) + decompressor.flush()).decode()
+
+
+def _build_dictionary(samples: list) -> bytes:
+    """
+    zlib preset dictionary from sample rows: their most frequent JSON fragments
+    (keys, repeated names, numbers). zlib finds matches near the end of the
+    dictionary cheapest, so the most frequent fragments go last.
+    """
+    counts = Counter()
+    for food_json in samples:
+        counts.update(_JSON_FRAGMENT_RE.findall(food_json))
+    fragments = []
+    size = 0
+    for fragment, count in counts.most_common():
+        if count < 2:
+            break
+        encoded = fragment.encode()
+        if size + len(encoded) > DICTIONARY_SIZE:
+            break
+        fragments.append(encoded)
+        size += len(encoded)
+    return b"".join(reversed(fragments))
+
+
+async def _food_texts(db, rows) -> list:
+    """food_json text of rows selected with food_json, food_blob and dict_id (cold rows are decompressed)."""
+    for dict_id in {row['dict_id'] for row in rows if row['food_blob'] is not None} - set(_dictionaries):
+        async with db.execute("SELECT data FROM compression_dicts WHERE dict_id = ?", (dict_id,)) as cursor:
+            _dictionaries[dict_id] = (await cursor.fetchone())['data']
+    return [
+        row['food_json'] if row['food_blob'] is None else _decompress_food(row['food_blob'], _dictionaries[row['dict_id']])
+        for row in rows
+    ]
+
+
+def _day_totals(food_json: str):
+    """
+    Daily (calories, protein, carbs, fats) of a synced day.
+    Uses the day totals sent by the web app, or sums foodHistory if they are missing.
+    """
+    try:
+        data = json.loads(food_json)
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        return (0.0,) * len(NUTRIENT_COLUMNS)
+    history = [food for food in data.get("foodHistory") or [] if isinstance(food, dict)]
+    totals = []
+    for name in NUTRIENT_COLUMNS:
+        try:
+            totals.append(float(data[name]))
+            continue
+        except (KeyError, TypeError, ValueError):
+            pass
+        total = 0.0
+        for food in history:
+            try:
+                total += float(food.get(name, food.get("fat")) if name == "fats" else food.get(name))
+            except (TypeError, ValueError):
+                continue
+        totals.append(total)
+    return tuple(totals)
+
+
+def _period_bounds(date: str):
+    """[(period, first day, last day)] of the week (Monday-based) and month containing date."""
+    try:
+        day = date_type.fromisoformat(date)
+    except ValueError:
+        return []
+    week_start = day - timedelta(days=day.weekday())
+    month_start = day.replace(day=1)
+    month_end = (month_start + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    return [
+        ("week", week_start.isoformat(), (week_start + timedelta(days=6)).isoformat()),
+        ("month", month_start.isoformat(), month_end.isoformat()),
+    ]
+
+
+async def _refresh_rollups(db, days):
+    """
+    Recompute the week and month rollups that contain the given days.
+
+    Args:
+        days: Iterable of (user_id, date) that changed
+    """
+    periods = {
+        (user_id, period, start, end)
+        for user_id, date in days
+        for period, start, end in _period_bounds(date)
+    }
+    # Дни без записей (calories = 0) не учитываются в средних
+    await db.executemany("""
+        INSERT OR REPLACE INTO food_rollups (user_id, period, period_start, days, calories, protein, carbs, fats)
+        SELECT ?, ?, ?, COUNT(*), COALESCE(SUM(calories), 0), COALESCE(SUM(protein), 0),
+               COALESCE(SUM(carbs), 0), COALESCE(SUM(fats), 0)
+        FROM food_logs
+        WHERE user_id = ? AND date BETWEEN ? AND ? AND calories > 0
+    """, [(user_id, period, start, user_id, start, end) for user_id, period, start, end in periods])
+
+
+async def _backfill_nutrition_columns(db, batch_size: int = 1000):
+    """Fill nutrient columns and rollups for rows saved before they existed."""
+    filled = 0
+    while True:
+        async with db.execute(
+            "SELECT user_id, date, food_json FROM food_logs WHERE calories IS NULL LIMIT ?", (batch_size,)
+        ) as cursor:
+            rows = await cursor.fetchall()
+        if not rows:
+            break
+        await db.executemany(
+            "UPDATE food_logs SET calories = ?, protein = ?, carbs = ?, fats = ? WHERE user_id = ? AND date = ?",
+            [(*_day_totals(row['food_json']), row['user_id'], row['date']) for row in rows]
+        )
+        await _refresh_rollups(db, [(row['user_id'], row['date']) for row in rows])
+        filled += len(rows)
+    if filled:
+        logging.info(f"✅ Nutrient columns filled for {filled} food log rows")
+
+
 async def init_database():
-    """Initialize the database and create tables if they don't exist."""
+    """
+    Initialize the database, create tables if they don't exist
+    and open the long-lived writer connection and read pool.
+    """
+    global _writer, _readers, _flush_task
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        _writer = await _connect()
+        # Действует только для новой БД: освобождённые страницы возвращаются через incremental_vacuum
+        await _writer.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        async with _write() as db:
+            # Воркеры стартуют одновременно: миграции выполняет один, остальные ждут его коммита
+            await db.execute("BEGIN IMMEDIATE")
             await db.execute("""
                 CREATE TABLE IF NOT EXISTS food_logs (
                     user_id INTEGER NOT NULL,
@@ -18,134 +277,1193 @@ async def init_database():
                     PRIMARY KEY (user_id, date)
                 )
             """)
+            await db.execute(
+                "CREATE INDEX IF NOT EXISTS idx_food_logs_user_updated ON food_logs (user_id, updated_at)"
+            )
+            await _add_missing_columns(db, "food_logs", {name: "REAL" for name in NUTRIENT_COLUMNS})
+            # Холодные строки: food_json пустой, данные в food_blob (zlib со словарём dict_id)
+            await _add_missing_columns(db, "food_logs", {"food_blob": "BLOB", "dict_id": "INTEGER"})
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS compression_dicts (
+                    dict_id INTEGER PRIMARY KEY,
+                    data BLOB NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            """)
+            await db.execute(
+                "CREATE INDEX IF NOT EXISTS idx_food_logs_date ON food_logs (date, calories)"
+            )
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS food_rollups (
+                    user_id INTEGER NOT NULL,
+                    period TEXT NOT NULL,
+                    period_start TEXT NOT NULL,
+                    days INTEGER NOT NULL,
+                    calories REAL NOT NULL,
+                    protein REAL NOT NULL,
+                    carbs REAL NOT NULL,
+                    fats REAL NOT NULL,
+                    PRIMARY KEY (user_id, period, period_start)
+                )
+            """)
+            await _backfill_nutrition_columns(db)
             await db.execute("""
                 CREATE TABLE IF NOT EXISTS users (
                     user_id INTEGER PRIMARY KEY,
                     joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             """)
-            await db.commit()
-            logging.info("✅ Database initialized successfully")
+            await _add_missing_columns(db, "users", {
+                "last_success_at": "TIMESTAMP",
+                "last_failure_at": "TIMESTAMP",
+                "fail_count": "INTEGER NOT NULL DEFAULT 0",
+                "is_blocked": "INTEGER NOT NULL DEFAULT 0",
+            })
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS reminder_slots (
+                    user_id INTEGER NOT NULL,
+                    meal TEXT NOT NULL,
+                    timezone TEXT NOT NULL,
+                    local_minute INTEGER NOT NULL,
+                    PRIMARY KEY (user_id, meal)
+                )
+            """)
+            await db.execute(
+                "CREATE INDEX IF NOT EXISTS idx_reminder_slots_bucket ON reminder_slots (timezone, local_minute)"
+            )
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS reminder_deliveries (
+                    user_id INTEGER NOT NULL,
+                    meal TEXT NOT NULL,
+                    local_date TEXT NOT NULL,
+                    PRIMARY KEY (user_id, meal, local_date)
+                )
+            """)
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS app_state (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                )
+            """)
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS analysis_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    scope TEXT NOT NULL,
+                    phash INTEGER,
+                    result_json TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            """)
+            # Replaced by analysis_phash_bands (exact hash matches missed near-duplicates)
+            await db.execute("DROP INDEX IF EXISTS idx_analysis_cache_phash")
+            await db.execute(
+                "CREATE INDEX IF NOT EXISTS idx_analysis_cache_created ON analysis_cache (created_at)"
+            )
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS analysis_phash_bands (
+                    cache_key TEXT NOT NULL,
+                    band INTEGER NOT NULL,
+                    scope TEXT NOT NULL,
+                    PRIMARY KEY (cache_key, band)
+                ) WITHOUT ROWID
+            """)
+            await db.execute(
+                "CREATE INDEX IF NOT EXISTS idx_analysis_phash_bands ON analysis_phash_bands (scope, band)"
+            )
+            # Entries cached before the bands existed (band = index * 256 + byte value)
+            band_indexes = ", ".join(f"({index})" for index in range(PHASH_BANDS))
+            await db.execute(f"""
+                INSERT OR IGNORE INTO analysis_phash_bands (cache_key, band, scope)
+                SELECT cache_key, i.column1 * 256 + ((phash >> (i.column1 * 8)) & 255), scope
+                FROM analysis_cache, (VALUES {band_indexes}) AS i
+                WHERE phash IS NOT NULL AND NOT EXISTS (SELECT 1 FROM analysis_phash_bands)
+            """)
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS nutrition_index (
+                    product TEXT NOT NULL,
+                    unit TEXT NOT NULL,
+                    base_qty REAL,
+                    result_json TEXT NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (product, unit)
+                )
+            """)
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS quota_counters (
+                    key TEXT PRIMARY KEY,
+                    day TEXT NOT NULL,
+                    used INTEGER NOT NULL DEFAULT 0,
+                    tokens REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS leases (
+                    name TEXT PRIMARY KEY,
+                    holder TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            """)
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                    job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id INTEGER NOT NULL,
+                    text TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            """)
+
+        _readers = asyncio.Queue()
+        for _ in range(READ_POOL_SIZE):
+            reader = await _connect()
+            _reader_conns.append(reader)
+            _readers.put_nowait(reader)
+        async with _read() as db:
+            async with db.execute("SELECT MAX(updated_at) FROM food_logs") as cursor:
+                _observe_version((await cursor.fetchone())[0])
+        _flush_task = asyncio.create_task(_flush_loop())
+        logging.info("✅ Database initialized successfully")
     except Exception as e:
         logging.error(f"❌ Database initialization failed: {e}")
         raise
 
-async def save_food_data(user_id: int, date: str, food_json: str):
+async def close_database():
+    """Drain the write-behind buffer, then close the writer and all pooled read connections."""
+    global _writer, _readers, _flush_task, _flush_stopping
+    if _flush_task is not None:
+        _flush_stopping = True
+        _flush_wakeup.set()
+        await _flush_task
+        _flush_task = None
+        _flush_stopping = False
+    if _writer is not None:
+        await flush_food_data()
+    for reader in _reader_conns:
+        await reader.close()
+    _reader_conns.clear()
+    _readers = None
+    if _writer is not None:
+        async with _write_lock:
+            await _writer.close()
+        _writer = None
+    logging.info("✅ Database connections closed")
+
+@_timed
+async def snapshot_database(target_path: str):
     """
-    Save or update food data for a specific user and date.
-    
+    Write a consistent, compacted copy of the database (VACUUM INTO).
+    Buffered food logs are flushed first. Runs on a read connection,
+    so with WAL writers keep working while the copy is made.
+
+    Args:
+        target_path: Path of the new database file (must not exist)
+    """
+    await flush_food_data()
+    try:
+        async with _read() as db:
+            await db.execute("VACUUM INTO ?", (target_path,))
+            return True
+    except Exception as e:
+        logging.error(f"❌ Failed to snapshot database: {e}")
+        return False
+
+def _observe_version(version):
+    global _last_version
+    if version and version > _last_version:
+        _last_version = version
+
+def _next_version() -> str:
+    """
+    updated_at for a new save: UTC time, but always above every version seen so far,
+    so a clock stepping back cannot make a new save lose to an older one.
+    """
+    global _last_version
+    version = datetime.now(timezone.utc).replace(tzinfo=None).isoformat(timespec="microseconds")
+    if version <= _last_version:
+        version = (datetime.fromisoformat(_last_version) + timedelta(microseconds=1)).isoformat(timespec="microseconds")
+    _last_version = version
+    return version
+
+@_timed
+async def queue_food_data(user_id: int, date: str, food_json: str, durable: bool = False):
+    """
+    Buffer food data for a specific user and date; it is written by the next flush.
+    Repeated saves of the same day before the flush are coalesced into one row write.
+
     Args:
         user_id: Telegram user ID
         date: Date in YYYY-MM-DD format
         food_json: JSON string containing food data
+        durable: Wait until the data is committed to the database
+
+    Returns:
+        bool: True if buffered (or, with durable, committed)
+
+    Raises:
+        StaleWriteError: With durable, if another worker already stored a newer version of the day
+    """
+    updated_at = _next_version()
+    _pending_food[(user_id, date)] = (food_json, updated_at)
+    put_day(user_id, date, food_json, updated_at, written=True)
+    if len(_pending_food) >= FLUSH_THRESHOLD:
+        _flush_wakeup.set()
+    if not durable:
+        return True
+    waiter = asyncio.get_running_loop().create_future()
+    _flush_waiters.append(((user_id, date), waiter))
+    return await waiter
+
+@_timed
+async def flush_food_data():
+    """
+    Write all buffered food data in one transaction.
+    On failure the rows are kept in the buffer for the next attempt.
+    A row is not written over a newer version of the day (saved by another worker);
+    such rows are logged and fail their durable saves with StaleWriteError.
+
+    Returns:
+        int: Number of rows written
     """
+    global _pending_food, _flush_waiters
+    if not _pending_food and not _flush_waiters:
+        return 0
+    batch, _pending_food = _pending_food, {}
+    _flushing.update(batch)
+    waiters, _flush_waiters = _flush_waiters, []
+    success = True
+    # (user_id, date) -> newer updated_at already in the database
+    stale = {}
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute("""
-                INSERT INTO food_logs (user_id, date, food_json, updated_at)
-                VALUES (?, ?, ?, ?)
-                ON CONFLICT(user_id, date) 
-                DO UPDATE SET food_json = ?, updated_at = ?
-            """, (user_id, date, food_json, datetime.now().isoformat(), 
-                  food_json, datetime.now().isoformat()))
-            await db.commit()
-            logging.info(f"✅ Saved food data for user {user_id}, date {date}")
-            return True
+        async with _write() as db:
+            written = await db.executemany("""
+                INSERT INTO food_logs (user_id, date, food_json, updated_at, calories, protein, carbs, fats)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(user_id, date)
+                DO UPDATE SET food_json = excluded.food_json, updated_at = excluded.updated_at,
+                              calories = excluded.calories, protein = excluded.protein,
+                              carbs = excluded.carbs, fats = excluded.fats,
+                              food_blob = NULL, dict_id = NULL
+                WHERE excluded.updated_at > food_logs.updated_at
+            """, [(user_id, date, food_json, updated_at, *_day_totals(food_json))
+                  for (user_id, date), (food_json, updated_at) in batch.items()])
+            if written.rowcount < len(batch):
+                for key, (_, updated_at) in batch.items():
+                    async with db.execute(
+                        "SELECT updated_at FROM food_logs WHERE user_id = ? AND date = ?", key
+                    ) as cursor:
+                        stored = (await cursor.fetchone())[0]
+                    if stored != updated_at:
+                        stale[key] = stored
+            await _refresh_rollups(db, batch.keys())
+        if batch:
+            logging.info(f"✅ Flushed {len(batch)} food log rows")
+        for (user_id, date), stored in stale.items():
+            logging.warning(f"⚠️ Save of user {user_id}, date {date} skipped: a newer version ({stored}) is already stored")
+            _observe_version(stored)
+            # Кэш этого процесса держит отклонённую версию дня
+            invalidate_user(user_id)
     except Exception as e:
-        logging.error(f"❌ Failed to save food data: {e}")
-        return False
+        logging.error(f"❌ Failed to flush food data: {e}")
+        success = False
+        stale = {}
+        # Newer saves made during the flush win over the failed batch
+        for key, value in batch.items():
+            if _flushing.get(key) is value:
+                _pending_food.setdefault(key, value)
+    for key, value in batch.items():
+        if _flushing.get(key) is value:
+            del _flushing[key]
+    for key, waiter in waiters:
+        if waiter.done():
+            continue
+        if key in stale:
+            waiter.set_exception(StaleWriteError(f"A newer version of {key[1]} is already saved"))
+        else:
+            waiter.set_result(success)
+    return len(batch) - len(stale) if success else 0
+
+async def _flush_loop():
+    while not _flush_stopping:
+        try:
+            await asyncio.wait_for(_flush_wakeup.wait(), timeout=FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _flush_wakeup.clear()
+        await flush_food_data()
+
+def _pending_for_user(user_id: int):
+    """
+    Buffered, not yet committed days of a user: date -> (food_json, updated_at).
+    Take it before awaiting a read: a flush may commit the rows while the read runs.
+    """
+    pending = {date: value for (uid, date), value in _flushing.items() if uid == user_id}
+    pending.update((date, value) for (uid, date), value in _pending_food.items() if uid == user_id)
+    return pending
 
-async def get_food_data(user_id: int, date: str):
+def _pending_row(user_id: int, date: str):
+    return _pending_food.get((user_id, date)) or _flushing.get((user_id, date))
+
+def _merge_pending(rows, pending: dict):
     """
-    Retrieve food data for a specific user and date.
-    
+    Overlay buffered days on rows (date, food_json, updated_at) read from the database.
+    The newer version of a day wins: the buffer snapshot may predate a commit the read saw.
+
+    Returns:
+        dict: date -> (date, food_json, updated_at)
+    """
+    merged = {row[0]: row for row in rows}
+    for date, (food_json, updated_at) in pending.items():
+        if date not in merged or updated_at > merged[date][2]:
+            merged[date] = (date, food_json, updated_at)
+    return merged
+
+@_timed
+async def get_food_json(user_id: int, date: str):
+    """
+    Retrieve stored food JSON for a specific user and date without parsing it.
+    Recent days are served from the in-process cache (food_cache_manager).
+
     Args:
         user_id: Telegram user ID
         date: Date in YYYY-MM-DD format
-        
+
     Returns:
-        dict: Food data or None if not found
+        str: Food JSON text or None if not found
     """
+    pending = _pending_row(user_id, date)
+    if pending:
+        return pending[0]
+    hit, food_json = get_day(user_id, date)
+    if hit:
+        return food_json
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            db.row_factory = aiosqlite.Row
+        async with _read() as db:
             async with db.execute(
-                "SELECT food_json FROM food_logs WHERE user_id = ? AND date = ?",
+                "SELECT food_json, food_blob, dict_id, updated_at FROM food_logs WHERE user_id = ? AND date = ?",
                 (user_id, date)
             ) as cursor:
                 row = await cursor.fetchone()
-                if row:
-                    return json.loads(row['food_json'])
-                return None
+                food_json = (await _food_texts(db, [row]))[0] if row else None
+        put_day(user_id, date, food_json, row['updated_at'] if row else None)
+        return food_json
     except Exception as e:
         logging.error(f"❌ Failed to get food data: {e}")
         return None
 
-async def get_all_food_data(user_id: int):
+@_timed
+async def get_all_food_json(user_id: int):
     """
-    Retrieve all food data for a specific user.
-    
+    Retrieve all stored food JSON for a specific user without parsing it.
+
     Args:
         user_id: Telegram user ID
-        
+
     Returns:
-        dict: Dictionary with dates as keys and food data as values
+        list: Tuples (date, food_json text, updated_at), newest date first
     """
+    pending = _pending_for_user(user_id)
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            db.row_factory = aiosqlite.Row
+        async with _read() as db:
             async with db.execute(
-                "SELECT date, food_json FROM food_logs WHERE user_id = ? ORDER BY date DESC",
+                "SELECT date, food_json, food_blob, dict_id, updated_at FROM food_logs WHERE user_id = ? ORDER BY date DESC",
                 (user_id,)
             ) as cursor:
                 rows = await cursor.fetchall()
-                result = {}
-                for row in rows:
-                    result[row['date']] = json.loads(row['food_json'])
-                return result
+                rows = [
+                    (row['date'], food_json, row['updated_at'])
+                    for row, food_json in zip(rows, await _food_texts(db, rows))
+                ]
+        if pending:
+            rows = sorted(_merge_pending(rows, pending).values(), reverse=True)
+        return rows
     except Exception as e:
-        logging.error(f"❌ Failed to get all food data: {e}")
-        return {}
+        logging.error(f"❌ Failed to get all food json: {e}")
+        return []
+
+@_timed
+async def get_food_json_since(user_id: int, since: str):
+    """
+    Retrieve stored food JSON changed after a sync cursor, without parsing it.
+
+    Args:
+        user_id: Telegram user ID
+        since: Cursor (updated_at of the newest row the client has seen)
 
+    Returns:
+        tuple: (list of tuples (date, food_json text, updated_at), new cursor: updated_at of the last row)
+    """
+    pending = {date: value for date, value in _pending_for_user(user_id).items() if value[1] > since}
+    try:
+        async with _read() as db:
+            async with db.execute(
+                "SELECT date, food_json, food_blob, dict_id, updated_at FROM food_logs "
+                "WHERE user_id = ? AND updated_at > ? ORDER BY updated_at",
+                (user_id, since)
+            ) as cursor:
+                rows = await cursor.fetchall()
+                rows = [
+                    (row['date'], food_json, row['updated_at'])
+                    for row, food_json in zip(rows, await _food_texts(db, rows))
+                ]
+        if pending:
+            rows = sorted(_merge_pending(rows, pending).values(), key=lambda row: row[2])
+        return rows, (rows[-1][2] if rows else since)
+    except Exception as e:
+        logging.error(f"❌ Failed to get food json since {since}: {e}")
+        return [], since
+
+@_timed
+async def get_food_log_version(user_id: int):
+    """
+    Cheap fingerprint of a user's history, served from the (user_id, updated_at) index.
+    Equals the newest updated_at and length of what get_all_food_json() returns.
+
+    Returns:
+        tuple: (newest updated_at or None, number of days)
+    """
+    pending = _pending_for_user(user_id)
+    try:
+        stored = "0"
+        if pending:
+            # Buffered days already in the table are counted once (same statement, same snapshot)
+            stored = "COALESCE(SUM(date IN (" + ",".join("?" * len(pending)) + ")), 0)"
+        async with _read() as db:
+            async with db.execute(
+                f"SELECT MAX(updated_at), COUNT(*), {stored} FROM food_logs WHERE user_id = ?",
+                (*pending, user_id)
+            ) as cursor:
+                row = await cursor.fetchone()
+                latest, count, buffered_stored = row[0], row[1], row[2]
+        if pending:
+            latest = max([latest or ""] + [updated_at for _, updated_at in pending.values()])
+            count += len(pending) - buffered_stored
+        return latest, count
+    except Exception as e:
+        logging.error(f"❌ Failed to get food log version: {e}")
+        return None, 0
+
+async def _current_dictionary():
+    """Newest compression dictionary, built from recent rows if there is none yet."""
+    async with _read() as db:
+        async with db.execute("SELECT dict_id, data FROM compression_dicts ORDER BY dict_id DESC LIMIT 1") as cursor:
+            row = await cursor.fetchone()
+        if row:
+            _dictionaries[row['dict_id']] = row['data']
+            return row['dict_id'], row['data']
+        async with db.execute(
+            "SELECT food_json FROM food_logs WHERE food_blob IS NULL ORDER BY updated_at DESC LIMIT ?",
+            (DICTIONARY_SAMPLE_ROWS,)
+        ) as cursor:
+            samples = [row['food_json'] for row in await cursor.fetchall()]
+    if not samples:
+        return None, None
+    data = await asyncio.to_thread(_build_dictionary, samples)
+    async with _write() as db:
+        cursor = await db.execute(
+            "INSERT INTO compression_dicts (data, created_at) VALUES (?, ?)", (data, datetime.now().timestamp())
+        )
+        dict_id = cursor.lastrowid
+    _dictionaries[dict_id] = data
+    logging.info(f"✅ Compression dictionary {dict_id} built from {len(samples)} rows ({len(data)} bytes)")
+    return dict_id, data
+
+@_timed
+async def compact_food_logs(min_age_days: int = COLD_STORAGE_DAYS, batch_size: int = COMPACT_BATCH_SIZE):
+    """
+    Move days older than min_age_days into compressed cold storage.
+
+    Rows are compressed outside the write lock and written in small batches;
+    a row saved again meanwhile is left as is (and becomes hot again on every save).
+    updated_at is not touched, so sync cursors and ETags stay valid.
+
+    Returns:
+        tuple: (rows compacted, bytes before, bytes after)
+    """
+    cutoff = (date_type.today() - timedelta(days=min_age_days)).isoformat()
+    compacted = before = after = 0
+    try:
+        dict_id, dictionary = await _current_dictionary()
+        if dict_id is None:
+            return 0, 0, 0
+        last_rowid = 0
+        while True:
+            async with _read() as db:
+                async with db.execute("""
+                    SELECT rowid, food_json, updated_at FROM food_logs
+                    WHERE rowid > ? AND date < ? AND food_blob IS NULL
+                    ORDER BY rowid LIMIT ?
+                """, (last_rowid, cutoff, batch_size)) as cursor:
+                    rows = [tuple(row) for row in await cursor.fetchall()]
+            if not rows:
+                break
+            last_rowid = rows[-1][0]
+            blobs = await asyncio.to_thread(
+                lambda: [_compress_food(food_json, dictionary) for _, food_json, _ in rows]
+            )
+            updates = [
+                (blob, rowid, updated_at, len(food_json.encode()))
+                for (rowid, food_json, updated_at), blob in zip(rows, blobs)
+                if len(blob) < len(food_json.encode())
+            ]
+            async with _write() as db:
+                for blob, rowid, updated_at, size in updates:
+                    cursor = await db.execute("""
+                        UPDATE food_logs SET food_blob = ?, dict_id = ?, food_json = ''
+                        WHERE rowid = ? AND updated_at = ? AND food_blob IS NULL
+                    """, (blob, dict_id, rowid, updated_at))
+                    # Строку пересохранили во время сжатия - она снова горячая
+                    if cursor.rowcount:
+                        compacted += 1
+                        before += size
+                        after += len(blob)
+        async with _write() as db:
+            # Без auto_vacuum=INCREMENTAL (старые БД) это no-op, свободные страницы просто переиспользуются
+            await db.execute("PRAGMA incremental_vacuum")
+        return compacted, before, after
+    except Exception as e:
+        logging.error(f"❌ Failed to compact food logs: {e}")
+        return compacted, before, after
+
+@_timed
+async def get_daily_totals(user_id: int, start: str, end: str):
+    """
+    Nutrient totals of the logged days in a date range.
+
+    Returns:
+        list: Tuples (date, calories, protein, carbs, fats), oldest first
+    """
+    if _pending_for_user(user_id):
+        await flush_food_data()
+    try:
+        async with _read() as db:
+            async with db.execute("""
+                SELECT date, calories, protein, carbs, fats FROM food_logs
+                WHERE user_id = ? AND date BETWEEN ? AND ? AND calories > 0
+                ORDER BY date
+            """, (user_id, start, end)) as cursor:
+                return [tuple(row) for row in await cursor.fetchall()]
+    except Exception as e:
+        logging.error(f"❌ Failed to get daily totals: {e}")
+        return []
+
+@_timed
+async def get_rollups(user_id: int, period: str, start: str, end: str):
+    """
+    Weekly or monthly rollups whose period starts in a date range.
+
+    Args:
+        period: "week" or "month"
+
+    Returns:
+        list: Tuples (period_start, days, calories, protein, carbs, fats), oldest first
+    """
+    if _pending_for_user(user_id):
+        await flush_food_data()
+    try:
+        async with _read() as db:
+            async with db.execute("""
+                SELECT period_start, days, calories, protein, carbs, fats FROM food_rollups
+                WHERE user_id = ? AND period = ? AND period_start BETWEEN ? AND ? AND days > 0
+                ORDER BY period_start
+            """, (user_id, period, start, end)) as cursor:
+                return [tuple(row) for row in await cursor.fetchall()]
+    except Exception as e:
+        logging.error(f"❌ Failed to get rollups: {e}")
+        return []
+
+@_timed
+async def get_logged_dates(user_id: int, until: str, limit: int = 366):
+    """
+    Most recent days with logged food up to a date, newest first (for streaks).
+    """
+    try:
+        async with _read() as db:
+            async with db.execute("""
+                SELECT date FROM food_logs
+                WHERE user_id = ? AND date <= ? AND calories > 0
+                ORDER BY date DESC LIMIT ?
+            """, (user_id, until, limit)) as cursor:
+                return [row['date'] for row in await cursor.fetchall()]
+    except Exception as e:
+        logging.error(f"❌ Failed to get logged dates: {e}")
+        return []
+
+@_timed
+async def get_daily_overview(date: str):
+    """
+    Service-wide totals for one day.
+
+    Returns:
+        tuple: (users who logged food, average calories)
+    """
+    try:
+        async with _read() as db:
+            async with db.execute(
+                "SELECT COUNT(*), AVG(calories) FROM food_logs WHERE date = ? AND calories > 0", (date,)
+            ) as cursor:
+                count, average = await cursor.fetchone()
+                return count, average or 0
+    except Exception as e:
+        logging.error(f"❌ Failed to get daily overview: {e}")
+        return 0, 0
+
+@_timed
 async def add_user(user_id: int):
     """
     Add a new user to the database if they don't exist.
+    A returning user (e.g. after unblocking the bot) becomes active again.
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute(
-                "INSERT OR IGNORE INTO users (user_id) VALUES (?)",
-                (user_id,)
-            )
-            await db.commit()
+        async with _write() as db:
+            await db.execute("""
+                INSERT INTO users (user_id) VALUES (?)
+                ON CONFLICT(user_id) DO UPDATE SET is_blocked = 0, fail_count = 0
+            """, (user_id,))
             logging.info(f"✅ User {user_id} handled (added or already exists)")
             return True
     except Exception as e:
         logging.error(f"❌ Failed to add user: {e}")
         return False
 
-async def get_all_users():
+async def iter_active_users(batch_size: int = 1000):
+    """
+    Stream IDs of users that can receive messages: not blocked and
+    below MAX_DELIVERY_FAILURES consecutive failures.
+    Reads in keyset-paginated batches so the pool connection is not held
+    for the whole broadcast.
+    """
+    last_id = None
+    while True:
+        try:
+            async with _read() as db:
+                async with db.execute("""
+                    SELECT user_id FROM users
+                    WHERE user_id > ? AND is_blocked = 0 AND fail_count < ?
+                    ORDER BY user_id LIMIT ?
+                """, (last_id if last_id is not None else -2**63, MAX_DELIVERY_FAILURES, batch_size)) as cursor:
+                    batch = [row[0] for row in await cursor.fetchall()]
+        except Exception as e:
+            logging.error(f"❌ Failed to get active users: {e}")
+            return
+        for user_id in batch:
+            yield user_id
+        if len(batch) < batch_size:
+            return
+        last_id = batch[-1]
+
+@_timed
+async def record_deliveries(sent: list, failed: list, blocked: list):
     """
-    Retrieve all user IDs from the database.
+    Record message delivery outcomes.
+
+    Args:
+        sent: User IDs that received the message
+        failed: User IDs with a permanent delivery error
+        blocked: User IDs that blocked the bot or deleted their account
     """
+    now = datetime.now().isoformat()
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            async with db.execute("SELECT user_id FROM users") as cursor:
-                rows = await cursor.fetchall()
-                return [row[0] for row in rows]
+        async with _write() as db:
+            if sent:
+                await db.executemany(
+                    "UPDATE users SET last_success_at = ?, fail_count = 0 WHERE user_id = ?",
+                    [(now, user_id) for user_id in sent]
+                )
+            if failed:
+                await db.executemany(
+                    "UPDATE users SET last_failure_at = ?, fail_count = fail_count + 1 WHERE user_id = ?",
+                    [(now, user_id) for user_id in failed]
+                )
+            if blocked:
+                await db.executemany(
+                    "UPDATE users SET last_failure_at = ?, fail_count = fail_count + 1, is_blocked = 1 WHERE user_id = ?",
+                    [(now, user_id) for user_id in blocked]
+                )
+            return True
     except Exception as e:
-        logging.error(f"❌ Failed to get all users: {e}")
-        return []
+        logging.error(f"❌ Failed to record deliveries: {e}")
+        return False
 
+@_timed
 async def get_users_count():
     """
     Retrieve the count of users in the database.
     """
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with _read() as db:
             async with db.execute("SELECT COUNT(*) FROM users") as cursor:
                 row = await cursor.fetchone()
                 return row[0] if row else 0
     except Exception as e:
         logging.error(f"❌ Failed to get users count: {e}")
         return 0
+
+@_timed
+async def get_active_users_count():
+    """
+    Retrieve the count of users that can receive messages.
+    """
+    try:
+        async with _read() as db:
+            async with db.execute(
+                "SELECT COUNT(*) FROM users WHERE is_blocked = 0 AND fail_count < ?",
+                (MAX_DELIVERY_FAILURES,)
+            ) as cursor:
+                row = await cursor.fetchone()
+                return row[0] if row else 0
+    except Exception as e:
+        logging.error(f"❌ Failed to get active users count: {e}")
+        return 0
+
+@_timed
+async def save_reminder_slots(slots: list, only_missing: bool = False):
+    """
+    Save reminder delivery slots.
+
+    Args:
+        slots: List of tuples (user_id, meal, timezone, local_minute)
+        only_missing: Keep slots that already exist (used for defaults)
+    """
+    verb = "INSERT OR IGNORE" if only_missing else "INSERT OR REPLACE"
+    try:
+        async with _write() as db:
+            await db.executemany(
+                f"{verb} INTO reminder_slots (user_id, meal, timezone, local_minute) VALUES (?, ?, ?, ?)",
+                slots
+            )
+            return True
+    except Exception as e:
+        logging.error(f"❌ Failed to save reminder slots: {e}")
+        return False
+
+@_timed
+async def set_reminder_timezone(user_id: int, timezone: str):
+    """
+    Move all reminder slots of a user to another timezone, keeping local times.
+    """
+    try:
+        async with _write() as db:
+            await db.execute(
+                "UPDATE reminder_slots SET timezone = ? WHERE user_id = ?", (timezone, user_id)
+            )
+            return True
+    except Exception as e:
+        logging.error(f"❌ Failed to set reminder timezone: {e}")
+        return False
+
+@_timed
+async def get_users_without_reminder_slots():
+    """
+    Retrieve IDs of users that have no reminder slots yet.
+    """
+    try:
+        async with _read() as db:
+            async with db.execute("""
+                SELECT user_id FROM users
+                WHERE NOT EXISTS (SELECT 1 FROM reminder_slots s WHERE s.user_id = users.user_id)
+            """) as cursor:
+                return [row[0] for row in await cursor.fetchall()]
+    except Exception as e:
+        logging.error(f"❌ Failed to get users without reminder slots: {e}")
+        return []
+
+@_timed
+async def get_reminder_timezones():
+    """
+    Retrieve all distinct timezones that have reminder slots.
+    """
+    try:
+        async with _read() as db:
+            async with db.execute("SELECT DISTINCT timezone FROM reminder_slots") as cursor:
+                return [row[0] for row in await cursor.fetchall()]
+    except Exception as e:
+        logging.error(f"❌ Failed to get reminder timezones: {e}")
+        return []
+
+@_timed
+async def get_due_reminders(timezone: str, local_date: str, local_minutes: list):
+    """
+    Retrieve reminders due in per-minute buckets that were not delivered yet.
+    Only active users are returned.
+
+    Args:
+        timezone: IANA timezone name
+        local_date: Local date in YYYY-MM-DD format
+        local_minutes: Minutes of that local day (0-1439) whose buckets are due
+
+    Returns:
+        list: Tuples (user_id, meal)
+    """
+    try:
+        async with _read() as db:
+            async with db.execute(f"""
+                SELECT s.user_id, s.meal FROM reminder_slots s
+                JOIN users u ON u.user_id = s.user_id
+                WHERE s.timezone = ? AND s.local_minute IN ({",".join("?" * len(local_minutes))})
+                  AND u.is_blocked = 0 AND u.fail_count < ?
+                  AND NOT EXISTS (
+                      SELECT 1 FROM reminder_deliveries d
+                      WHERE d.user_id = s.user_id AND d.meal = s.meal AND d.local_date = ?
+                  )
+            """, (timezone, *local_minutes, MAX_DELIVERY_FAILURES, local_date)) as cursor:
+                return [(row[0], row[1]) for row in await cursor.fetchall()]
+    except Exception as e:
+        logging.error(f"❌ Failed to get due reminders: {e}")
+        return []
+
+@_timed
+async def mark_reminders_sent(meal: str, local_date: str, user_ids: list):
+    """
+    Remember reminders that were delivered (or failed for good) so they are not sent again.
+    """
+    try:
+        async with _write() as db:
+            await db.executemany(
+                "INSERT OR IGNORE INTO reminder_deliveries (user_id, meal, local_date) VALUES (?, ?, ?)",
+                [(user_id, meal, local_date) for user_id in user_ids]
+            )
+            return True
+    except Exception as e:
+        logging.error(f"❌ Failed to mark reminders sent: {e}")
+        return False
+
+@_timed
+async def prune_reminder_deliveries(before_date: str):
+    """
+    Delete delivery marks older than before_date (YYYY-MM-DD).
+    """
+    try:
+        async with _write() as db:
+            await db.execute("DELETE FROM reminder_deliveries WHERE local_date < ?", (before_date,))
+            return True
+    except Exception as e:
+        logging.error(f"❌ Failed to prune reminder deliveries: {e}")
+        return False
+
+@_timed
+async def get_state(key: str):
+    """
+    Retrieve a persisted application state value, or None.
+    """
+    try:
+        async with _read() as db:
+            async with db.execute("SELECT value FROM app_state WHERE key = ?", (key,)) as cursor:
+                row = await cursor.fetchone()
+                return row[0] if row else None
+    except Exception as e:
+        logging.error(f"❌ Failed to get state {key}: {e}")
+        return None
+
+@_timed
+async def set_state(key: str, value: str):
+    """
+    Persist an application state value.
+    """
+    try:
+        async with _write() as db:
+            await db.execute(
+                "INSERT OR REPLACE INTO app_state (key, value) VALUES (?, ?)", (key, value)
+            )
+            return True
+    except Exception as e:
+        logging.error(f"❌ Failed to set state {key}: {e}")
+        return False
+
+@_timed
+async def get_cached_analysis(cache_key: str, min_created_at: float):
+    """
+    Retrieve a cached analysis result by its content key.
+
+    Args:
+        cache_key: Hash of image bytes + prompt + model
+        min_created_at: Entries created before this unix time are treated as expired
+
+    Returns:
+        dict: Cached result or None if not found
+    """
+    try:
+        async with _read() as db:
+            async with db.execute(
+                "SELECT result_json FROM analysis_cache WHERE cache_key = ? AND created_at >= ?",
+                (cache_key, min_created_at)
+            ) as cursor:
+                row = await cursor.fetchone()
+                return json.loads(row['result_json']) if row else None
+    except Exception as e:
+        logging.error(f"❌ Failed to get cached analysis: {e}")
+        return None
+
+def _phash_bands(phash: int):
+    """Indexed bands of a perceptual hash: band index * 256 + byte value."""
+    return [index * 256 + ((phash >> (index * 8)) & 255) for index in range(PHASH_BANDS)]
+
+@_timed
+async def find_cached_analysis_by_phash(scope: str, phash: int, min_created_at: float, max_distance: int):
+    """
+    Retrieve a cached analysis result for a visually similar image.
+    Candidates sharing a hash band are compared by Hamming distance; the
+    closest one (the newest on a tie) within max_distance wins.
+
+    Args:
+        scope: Hash of prompt + model the result was produced with
+        phash: Signed 64-bit perceptual hash of the image
+        min_created_at: Entries created before this unix time are treated as expired
+        max_distance: Largest Hamming distance still treated as the same photo (up to PHASH_BANDS - 1)
+
+    Returns:
+        dict: Cached result or None if not found
+    """
+    bands = _phash_bands(phash)
+    try:
+        async with _read() as db:
+            async with db.execute(f"""
+                SELECT DISTINCT a.cache_key, a.phash, a.result_json, a.created_at
+                FROM analysis_phash_bands b JOIN analysis_cache a ON a.cache_key = b.cache_key
+                WHERE b.scope = ? AND b.band IN ({", ".join("?" * len(bands))}) AND a.created_at >= ?
+                ORDER BY a.created_at DESC LIMIT ?
+            """, (scope, *bands, min_created_at, PHASH_CANDIDATES)) as cursor:
+                rows = await cursor.fetchall()
+        best = None
+        for row in rows:
+            distance = bin((row['phash'] ^ phash) & 0xFFFFFFFFFFFFFFFF).count("1")
+            if distance <= max_distance and (best is None or distance < best[0]):
+                best = (distance, row['result_json'])
+        return json.loads(best[1]) if best else None
+    except Exception as e:
+        logging.error(f"❌ Failed to find cached analysis: {e}")
+        return None
+
+@_timed
+async def save_cached_analysis(cache_key: str, scope: str, phash, result: dict, created_at: float):
+    """
+    Store an analysis result in the persistent cache tier.
+    """
+    try:
+        async with _write() as db:
+            await db.execute("""
+                INSERT OR REPLACE INTO analysis_cache (cache_key, scope, phash, result_json, created_at)
+                VALUES (?, ?, ?, ?, ?)
+            """, (cache_key, scope, phash, json.dumps(result), created_at))
+            await db.execute("DELETE FROM analysis_phash_bands WHERE cache_key = ?", (cache_key,))
+            if phash is not None:
+                await db.executemany(
+                    "INSERT INTO analysis_phash_bands (cache_key, band, scope) VALUES (?, ?, ?)",
+                    [(cache_key, band, scope) for band in _phash_bands(phash)]
+                )
+            return True
+    except Exception as e:
+        logging.error(f"❌ Failed to save cached analysis: {e}")
+        return False
+
+@_timed
+async def prune_analysis_cache(min_created_at: float, max_rows: int):
+    """
+    Delete expired cache entries and keep at most max_rows newest ones.
+
+    Returns:
+        int: Number of deleted rows
+    """
+    try:
+        async with _write() as db:
+            cursor = await db.execute(
+                "DELETE FROM analysis_cache WHERE created_at < ?", (min_created_at,)
+            )
+            deleted = cursor.rowcount
+            cursor = await db.execute("""
+                DELETE FROM analysis_cache WHERE created_at < (
+                    SELECT created_at FROM analysis_cache ORDER BY created_at DESC LIMIT 1 OFFSET ?
+                )
+            """, (max_rows - 1,))
+            deleted += cursor.rowcount
+            if deleted:
+                await db.execute(
+                    "DELETE FROM analysis_phash_bands WHERE cache_key NOT IN (SELECT cache_key FROM analysis_cache)"
+                )
+            return deleted
+    except Exception as e:
+        logging.error(f"❌ Failed to prune analysis cache: {e}")
+        return 0
+
+@_timed
+async def load_nutrition_index():
+    """
+    Retrieve all nutrition index entries.
+
+    Returns:
+        list: Tuples (product, unit, base_qty, result dict, hits)
+    """
+    try:
+        async with _read() as db:
+            async with db.execute(
+                "SELECT product, unit, base_qty, result_json, hits FROM nutrition_index"
+            ) as cursor:
+                rows = await cursor.fetchall()
+                return [
+                    (row['product'], row['unit'], row['base_qty'], json.loads(row['result_json']), row['hits'])
+                    for row in rows
+                ]
+    except Exception as e:
+        logging.error(f"❌ Failed to load nutrition index: {e}")
+        return []
+
+@_timed
+async def save_nutrition_entry(product: str, unit: str, base_qty, result: dict, updated_at: float):
+    """
+    Save or replace the nutrition facts for a canonical product.
+    The accumulated hit counter is kept.
+    """
+    try:
+        async with _write() as db:
+            await db.execute("""
+                INSERT INTO nutrition_index (product, unit, base_qty, result_json, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(product, unit)
+                DO UPDATE SET base_qty = excluded.base_qty, result_json = excluded.result_json,
+                              updated_at = excluded.updated_at
+            """, (product, unit, base_qty, json.dumps(result), updated_at))
+            return True
+    except Exception as e:
+        logging.error(f"❌ Failed to save nutrition entry: {e}")
+        return False
+
+@_timed
+async def add_nutrition_hits(hits: list):
+    """
+    Increment hit counters of nutrition index entries.
+
+    Args:
+        hits: List of tuples (delta, product, unit)
+    """
+    try:
+        async with _write() as db:
+            await db.executemany(
+                "UPDATE nutrition_index SET hits = hits + ? WHERE product = ? AND unit = ?",
+                hits
+            )
+            return True
+    except Exception as e:
+        logging.error(f"❌ Failed to save nutrition hits: {e}")
+        return False
+
+@_timed
+async def load_quota_counters(day: str):
+    """
+    Retrieve quota counters saved for a day.
+
+    Returns:
+        list: Tuples (key, used, tokens, updated_at)
+    """
+    try:
+        async with _read() as db:
+            async with db.execute(
+                "SELECT key, used, tokens, updated_at FROM quota_counters WHERE day = ?", (day,)
+            ) as cursor:
+                rows = await cursor.fetchall()
+                return [(row['key'], row['used'], row['tokens'], row['updated_at']) for row in rows]
+    except Exception as e:
+        logging.error(f"❌ Failed to load quota counters: {e}")
+        return []
+
+@_timed
+async def save_quota_counters(day: str, counters: list):
+    """
+    Persist quota counters and drop counters of previous days.
+
+    Args:
+        day: Current day, YYYY-MM-DD (UTC)
+        counters: List of tuples (key, used, tokens, updated_at)
+    """
+    try:
+        async with _write() as db:
+            await db.executemany("""
+                INSERT INTO quota_counters (key, day, used, tokens, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(key)
+                DO UPDATE SET day = excluded.day, used = excluded.used,
+                              tokens = excluded.tokens, updated_at = excluded.updated_at
+            """, [(key, day, used, tokens, updated_at) for key, used, tokens, updated_at in counters])
+            await db.execute("DELETE FROM quota_counters WHERE day < ?", (day,))
+            return True
+    except Exception as e:
+        logging.error(f"❌ Failed to save quota counters: {e}")
+        return False
+
+@_timed
+async def acquire_lease(name: str, holder: str, ttl: float):
+    """
+    Take or renew a named lease shared by all processes using the database.
+    The lease is granted if it is free, expired or already held by holder.
+
+    Args:
+        name: Lease name
+        holder: Unique ID of the caller (host and PID)
+        ttl: Seconds until the lease expires unless renewed
+
+    Returns:
+        bool: True if holder owns the lease now
+    """
+    now = time.time()
+    try:
+        async with _write() as db:
+            cursor = await db.execute("""
+                INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(name)
+                DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+                WHERE leases.holder = excluded.holder OR leases.expires_at < ?
+            """, (name, holder, now + ttl, now))
+            return cursor.rowcount > 0
+    except Exception as e:
+        logging.error(f"❌ Failed to acquire lease {name}: {e}")
+        return False
+
+@_timed
+async def release_lease(name: str, holder: str):
+    """Give up a lease so another process can take it without waiting for expiry."""
+    try:
+        async with _write() as db:
+            await db.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder))
+            return True
+    except Exception as e:
+        logging.error(f"❌ Failed to release lease {name}: {e}")
+        return False
+
+@_timed
+async def queue_broadcast(chat_id: int, text: str):
+    """
+    Queue a broadcast for the leader process, which sends all bulk messages.
+
+    Args:
+        chat_id: Admin chat that gets progress reports
+        text: Message text
+    """
+    try:
+        async with _write() as db:
+            await db.execute(
+                "INSERT INTO broadcast_jobs (chat_id, text, created_at) VALUES (?, ?, ?)",
+                (chat_id, text, time.time())
+            )
+            return True
+    except Exception as e:
+        logging.error(f"❌ Failed to queue broadcast: {e}")
+        return False
+
+@_timed
+async def take_broadcast_jobs():
+    """
+    Remove and return all queued broadcasts, oldest first.
+    A job is taken once, so a crash mid-broadcast does not send it again.
+
+    Returns:
+        list: Tuples (chat_id, text)
+    """
+    try:
+        async with _write() as db:
+            async with db.execute("SELECT job_id, chat_id, text FROM broadcast_jobs ORDER BY job_id") as cursor:
+                rows = await cursor.fetchall()
+            if rows:
+                await db.execute("DELETE FROM broadcast_jobs WHERE job_id <= ?", (rows[-1][0],))
+            return [(row[1], row[2]) for row in rows]
+    except Exception as e:
+        logging.error(f"❌ Failed to take broadcast jobs: {e}")
+        return []
@@ -0,0 +1,197 @@
+import os
+import time
+from collections import OrderedDict
+from datetime import date as date_type, timedelta
+from metrics_manager import Counter, Gauge, register_collector
+
+# Сколько памяти занимает кэш дневника (дни и готовые ответы /api/sync/load), МБ
+CACHE_MAX_BYTES = int(float(os.getenv("FOOD_CACHE_MB", "64")) * 1024 * 1024)
+# Кэшируем только последние N дней: их приложение перечитывает постоянно
+CACHE_RECENT_DAYS = int(os.getenv("FOOD_CACHE_DAYS", "7"))
+# С несколькими воркерами запись могла прийти в другой процесс: столько секунд доверяем записи без перечитывания
+CACHE_TTL = float(os.getenv("FOOD_CACHE_TTL", "2"))
+
+# Одна запись не должна вытеснять весь кэш
+MAX_ENTRY_SHARE = 4
+# Примерные накладные расходы на запись, байты
+ENTRY_OVERHEAD = 200
+
+CACHE_REQUESTS = Counter("diet_food_cache_requests_total", "Food log cache lookups by kind and result", ("kind", "result"))
+CACHE_BYTES = Gauge("diet_food_cache_bytes", "Approximate size of the food log cache")
+
+
+class _UserEntry:
+    __slots__ = ("days", "history", "size", "generation")
+
+    def __init__(self):
+        # date -> (food_json or None, version (updated_at), stored_at)
+        self.days = {}
+        # (version, stored_at, {preferred encoding: (content encoding, body)}) or None
+        self.history = None
+        self.size = 0
+        # Растёт с каждой записью: ответ, собранный до записи, не должен попасть в кэш
+        self.generation = 0
+
+
+# user_id -> _UserEntry, давно не читанные пользователи в начале
+_users = OrderedDict()
+_bytes = 0
+# None - записи не устаревают (всё пишется через этот процесс)
+_ttl = None
+
+
+def init_food_cache(workers: int = 1):
+    """Entries expire after CACHE_TTL only when several worker processes write the same database."""
+    global _ttl
+    _ttl = CACHE_TTL if workers > 1 else None
+
+
+def _fresh(stored_at: float) -> bool:
+    return _ttl is None or time.monotonic() - stored_at < _ttl
+
+
+def is_recent(date: str) -> bool:
+    """Only the last CACHE_RECENT_DAYS days are cached."""
+    return date >= (date_type.today() - timedelta(days=CACHE_RECENT_DAYS)).isoformat()
+
+
+def _entry(user_id: int, create: bool = False):
+    entry = _users.get(user_id)
+    if entry is None and create:
+        entry = _users[user_id] = _UserEntry()
+        _resize(entry, ENTRY_OVERHEAD)
+    elif entry is not None:
+        _users.move_to_end(user_id)
+    return entry
+
+
+def _resize(entry: _UserEntry, delta: int):
+    global _bytes
+    entry.size += delta
+    _bytes += delta
+    while _bytes > CACHE_MAX_BYTES and len(_users) > 1:
+        _, evicted = _users.popitem(last=False)
+        _bytes -= evicted.size
+
+
+def _history_size(encodings: dict) -> int:
+    return sum(len(body) for _, body in encodings.values())
+
+
+def get_day(user_id: int, date: str):
+    """
+    Cached food JSON of a day.
+
+    Returns:
+        tuple: (True, food_json or None if the day has no data) on a hit, (False, None) on a miss
+    """
+    entry = _entry(user_id)
+    cached = entry.days.get(date) if entry is not None else None
+    if cached is None or not _fresh(cached[2]):
+        CACHE_REQUESTS.inc("day", "miss")
+        return False, None
+    CACHE_REQUESTS.inc("day", "hit")
+    return True, cached[0]
+
+
+def put_day(user_id: int, date: str, food_json, version, written: bool = False):
+    """
+    Remember a day read from or written to the database.
+
+    An older version never replaces a newer one, so a slow read cannot bring
+    back data overwritten in the meantime. A write (written=True) also drops
+    the user's cached full-history response.
+
+    Args:
+        user_id: Telegram user ID
+        date: Date in YYYY-MM-DD format
+        food_json: Stored JSON text or None if the day has no data
+        version: updated_at of the row (None if the day has no data)
+        written: The day was just saved
+    """
+    entry = _entry(user_id, create=is_recent(date))
+    if entry is None:
+        return
+    if written:
+        entry.generation += 1
+        if entry.history is not None:
+            _resize(entry, -_history_size(entry.history[2]))
+            entry.history = None
+    if not is_recent(date):
+        return
+    size = len(food_json or "") + ENTRY_OVERHEAD
+    if size > CACHE_MAX_BYTES // MAX_ENTRY_SHARE:
+        return
+    previous = entry.days.get(date)
+    if previous is not None:
+        if not written and (previous[1] or "") > (version or ""):
+            return
+        _resize(entry, -(len(previous[0] or "") + ENTRY_OVERHEAD))
+    entry.days[date] = (food_json, version, time.monotonic())
+    _resize(entry, size)
+
+
+def history_version(user_id: int):
+    """Version (newest updated_at, row count) of the cached full history, or None."""
+    entry = _entry(user_id)
+    if entry is None or entry.history is None or not _fresh(entry.history[1]):
+        return None
+    return entry.history[0]
+
+
+def get_history(user_id: int, version, encoding: str):
+    """
+    Cached /api/sync/load body of the full history.
+
+    Returns:
+        tuple: (content encoding or None, body bytes) or None on a miss
+    """
+    entry = _entry(user_id)
+    history = entry.history if entry is not None else None
+    if history is None or history[0] != version or not _fresh(history[1]) or encoding not in history[2]:
+        CACHE_REQUESTS.inc("history", "miss")
+        return None
+    CACHE_REQUESTS.inc("history", "hit")
+    return history[2][encoding]
+
+
+def history_token(user_id: int):
+    """Take before reading the history from the database and pass to put_history()."""
+    entry = _entry(user_id, create=True)
+    return entry, entry.generation
+
+
+def put_history(user_id: int, token, version, encoding: str, value: tuple):
+    """
+    Remember an encoded full-history body for the given history version.
+    Skipped if the user saved data (or was evicted) since history_token().
+    """
+    size = len(value[1])
+    entry = _users.get(user_id)
+    if entry is not token[0] or entry.generation != token[1] or size > CACHE_MAX_BYTES // MAX_ENTRY_SHARE:
+        return
+    if entry.history is not None and entry.history[0] == version and _fresh(entry.history[1]):
+        encodings = entry.history[2]
+        if encoding in encodings:
+            size -= len(encodings[encoding][1])
+    else:
+        if entry.history is not None:
+            _resize(entry, -_history_size(entry.history[2]))
+        entry.history = (version, time.monotonic(), {})
+    entry.history[2][encoding] = value
+    _resize(entry, size)
+
+
+def invalidate_user(user_id: int):
+    """Forget everything cached for a user."""
+    global _bytes
+    entry = _users.pop(user_id, None)
+    if entry is not None:
+        _bytes -= entry.size
+
+
+def _collect_metrics():
+    CACHE_BYTES.set(_bytes)
+
+
+register_collector(_collect_metrics)
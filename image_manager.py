@@ -0,0 +1,166 @@
+import asyncio
+import io
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from metrics_manager import Counter, Histogram
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# Максимальный размер загружаемого фото, байты
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", str(15 * 1024 * 1024)))
+
+READ_CHUNK_SIZE = 64 * 1024
+
+# Предобработка перед отправкой в Gemini: длинная сторона, формат и качество
+PREPROCESS_ENABLED = os.getenv("IMAGE_PREPROCESS", "1") == "1"
+MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "1024"))
+OUTPUT_FORMAT = os.getenv("IMAGE_FORMAT", "JPEG").upper()
+OUTPUT_QUALITY = int(os.getenv("IMAGE_QUALITY", "80"))
+PREPROCESS_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+
+OUTPUT_MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+_pool = None
+
+PREPROCESS_LATENCY = Histogram("diet_image_preprocess_seconds", "Photo downscaling in the worker pool")
+PREPROCESS_FAILURES = Counter("diet_image_preprocess_failures_total", "Photos sent without preprocessing because it failed")
+PREPROCESS_BYTES = Counter("diet_image_bytes_total", "Photo bytes before (in) and after (out) preprocessing", ("direction",))
+
+
+class ImageTooLargeError(Exception):
+    """Raised when an upload exceeds MAX_IMAGE_BYTES."""
+
+    def __init__(self, limit: int = MAX_IMAGE_BYTES):
+        super().__init__(f"Image is larger than {limit // (1024 * 1024)} MB")
+        self.limit = limit
+
+
+class UnsupportedImageError(Exception):
+    """Raised when uploaded bytes are not a supported image format."""
+
+    def __init__(self):
+        super().__init__("Unsupported image format")
+
+
+def sniff_mime_type(data: bytes):
+    """
+    Detect the image type from its magic bytes.
+
+    Returns:
+        str: MIME type or None if the data is not a supported image
+    """
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if data[4:8] == b"ftyp":
+        brand = data[8:12]
+        if brand in (b"heic", b"heix", b"hevc", b"hevx", b"heim", b"heis"):
+            return "image/heic"
+        if brand in (b"mif1", b"msf1", b"heif"):
+            return "image/heif"
+        if brand in (b"avif", b"avis"):
+            return "image/avif"
+    return None
+
+
+async def read_limited(read_chunk, limit: int = MAX_IMAGE_BYTES) -> bytes:
+    """
+    Read a stream chunk by chunk, failing as soon as it exceeds the limit.
+
+    Args:
+        read_chunk: Coroutine function returning the next chunk (b"" at the end)
+        limit: Maximum total size in bytes
+
+    Raises:
+        ImageTooLargeError: The stream is larger than limit
+    """
+    chunks = []
+    size = 0
+    while True:
+        chunk = await read_chunk()
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > limit:
+            raise ImageTooLargeError(limit)
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def _prepare(data: bytes):
+    """
+    Decode, apply EXIF orientation, downscale and re-encode without metadata.
+    Runs in a worker process.
+    """
+    with Image.open(io.BytesIO(data)) as img:
+        # Для JPEG декодер сразу уменьшает картинку в 2/4/8 раз
+        img.draft("RGB", (MAX_EDGE, MAX_EDGE))
+        img = ImageOps.exif_transpose(img)
+        img = img.convert("RGB")
+        img.thumbnail((MAX_EDGE, MAX_EDGE), Image.LANCZOS)
+        out = io.BytesIO()
+        img.save(out, OUTPUT_FORMAT, quality=OUTPUT_QUALITY)
+        return out.getvalue()
+
+
+def _warm_up():
+    return True
+
+
+def init_image_pool():
+    """
+    Start the preprocessing worker processes.
+    Call before other threads are started: workers are forked from this process.
+    """
+    global _pool
+    if Image is None or not PREPROCESS_ENABLED or _pool is not None:
+        return
+    context = multiprocessing.get_context("fork")
+    _pool = ProcessPoolExecutor(max_workers=PREPROCESS_WORKERS, mp_context=context)
+    for future in [_pool.submit(_warm_up) for _ in range(PREPROCESS_WORKERS)]:
+        future.result()
+    logging.info(f"🖼 Image preprocessing pool started ({PREPROCESS_WORKERS} workers, max edge {MAX_EDGE}px)")
+
+
+def shutdown_image_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(cancel_futures=True)
+        _pool = None
+
+
+async def preprocess_image(data: bytes, mime_type: str):
+    """
+    Shrink a photo before inference without blocking the event loop.
+    Falls back to the original bytes if preprocessing is off or the image cannot be decoded.
+
+    Returns:
+        tuple: (image bytes, MIME type)
+    """
+    if _pool is None:
+        return data, mime_type
+    started = time.perf_counter()
+    try:
+        prepared = await asyncio.get_running_loop().run_in_executor(_pool, _prepare, data)
+    except Exception as e:
+        PREPROCESS_FAILURES.inc()
+        logging.warning(f"⚠️ Image preprocessing failed, sending original: {e}")
+        return data, mime_type
+    elapsed = time.perf_counter() - started
+
+    PREPROCESS_LATENCY.observe(elapsed)
+    PREPROCESS_BYTES.inc("in", amount=len(data))
+    PREPROCESS_BYTES.inc("out", amount=len(prepared))
+    logging.info(f"🖼 Image {len(data) // 1024} KB -> {len(prepared) // 1024} KB in {elapsed * 1000:.0f} ms")
+    return prepared, OUTPUT_MIME_TYPES.get(OUTPUT_FORMAT, "image/jpeg")
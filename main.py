@@ -2,11 +2,15 @@ import asyncio
 import logging
 import os
 import base64
+import functools
+import gzip
 import json
 import random
-import hmac
+import signal
 import hashlib
-from urllib.parse import parse_qs
+import time
+import tempfile
+from datetime import date as date_type, timedelta
 from aiohttp import web
 import google.generativeai as genai
 from dotenv import load_dotenv
@@ -16,7 +20,23 @@ from aiogram.types import WebAppInfo, ReplyKeyboardMarkup, KeyboardButton, Inlin
 from aiogram.utils.keyboard import ReplyKeyboardBuilder, InlineKeyboardBuilder
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
-from db_manager import init_database, save_food_data, get_food_data, get_all_food_data, add_user, get_all_users, get_users_count
+try:
+    import brotli
+except ImportError:
+    brotli = None
+from db_manager import init_database, close_database, queue_food_data, StaleWriteError, get_food_json, get_all_food_json, get_food_json_since, get_food_log_version, add_user, iter_active_users, get_users_count, get_active_users_count, get_daily_totals, get_rollups, get_logged_dates, get_daily_overview, compact_food_logs, get_state, set_state, queue_broadcast, take_broadcast_jobs
+from ai_manager import init_models, model_stats, analyze_image, analyze_text, analyze_texts, InferenceBusyError
+from broadcast_manager import broadcast
+from image_manager import init_image_pool, shutdown_image_pool, ImageTooLargeError, UnsupportedImageError, MAX_IMAGE_BYTES, READ_CHUNK_SIZE, sniff_mime_type, read_limited
+from auth_manager import configure_auth, auth_middleware
+from backup_manager import create_backup, run_scheduled_backup, restore_hint, PART_SIZE, BACKUP_INTERVAL_HOURS
+from webhook_manager import setup_webhook, start_webhook, start_polling
+from worker_manager import run_workers, run_as_leader, WORKERS, SHUTDOWN_TIMEOUT
+from metrics_manager import configure_metrics, metrics_middleware, handle_metrics, monitor_event_loop, start_metrics_server, METRICS_PORT, METRICS_TOKEN
+from quota_manager import init_quotas, flush_quotas, quota_middleware, consume_for_request, QuotaExceededError
+from reminder_manager import init_reminders, ensure_reminder_slots, set_reminder_settings, run_due_reminders
+from food_cache_manager import init_food_cache, history_token, history_version, get_history, put_history
+from nutrition_manager import init_nutrition_index, flush_nutrition_hits, top_products, total_nutrients, stats as nutrition_stats
 
 # 1. Загружаем переменные из .env
 load_dotenv()
@@ -49,6 +69,7 @@ if GOOGLE_API_KEY:
     genai.configure(api_key=GOOGLE_API_KEY)
 
 bot = Bot(token=BOT_TOKEN)
+configure_auth(BOT_TOKEN)
 dp = Dispatcher()
 
 # --- УМНЫЕ НАПОМИНАНИЯ ---
@@ -77,6 +98,7 @@ DINNER_MESSAGES = [
 async def cmd_start(message: types.Message):
     # Добавляем пользователя в БД
     await add_user(message.from_user.id)
+    await ensure_reminder_slots([message.from_user.id])
     
     # Билдер для всех (Inline кнопки)
     inline_builder = InlineKeyboardBuilder()
@@ -98,9 +120,11 @@ async def cmd_start(message: types.Message):
 
 # --- Функции для работы с пользователями (удалены, теперь в db_manager) ---
 
-async def send_meal_reminder(meal_type):
-    """Отправляет напоминание о приеме пищи всем пользователям"""
-    users = await get_all_users()
+async def send_meal_reminder(meal_type, user_ids, on_done=None):
+    """
+    Отправляет напоминание о приеме пищи пользователям, у которых наступило их время.
+    on_done получает пачки ID, с которыми доставка решена (доставлено, ошибка получателя или блок).
+    """
     
     # Выбираем случайное сообщение в зависимости от типа приема пищи
     if meal_type == "breakfast":
@@ -120,14 +144,13 @@ async def send_meal_reminder(meal_type):
         )]
     ])
     
-    print(f"📢 Отправка {meal_type} напоминаний для {len(users)} пользователей...")
+    print(f"📢 Отправка {meal_type} напоминаний для {len(user_ids)} пользователей...")
     
-    # Отправляем сообщение каждому пользователю
-    for user_id in users:
-        try:
-            await bot.send_message(user_id, message, reply_markup=keyboard)
-        except Exception as e:
-            print(f"❌ Ошибка отправки пользователю {user_id}: {e}")
+    # Отправляем сообщение каждому пользователю (с общим лимитом скорости)
+    async def send(user_id):
+        await bot.send_message(user_id, message, reply_markup=keyboard)
+
+    await broadcast(user_ids, send, on_done=on_done, kind="reminder")
 
 # --- АДМИН-ПАНЕЛЬ ---
 
@@ -140,6 +163,7 @@ async def cmd_admin(message: types.Message):
     keyboard.button(text="📊 Статистика", callback_data="admin_stats")
     keyboard.button(text="💾 Скачать БД", callback_data="admin_export")
     keyboard.button(text="📢 Рассылка", callback_data="admin_broadcast_info")
+    keyboard.button(text="🍌 Топ запросов", callback_data="admin_nutrition_top")
     keyboard.adjust(1)
     
     await message.answer(
@@ -147,7 +171,7 @@ async def cmd_admin(message: types.Message):
         reply_markup=keyboard.as_markup()
     )
 
-@dp.callback_query(lambda c: c.data in ["admin_stats", "admin_export", "admin_broadcast_info"])
+@dp.callback_query(lambda c: c.data in ["admin_stats", "admin_export", "admin_broadcast_info", "admin_nutrition_top"])
 async def process_admin_callback(callback: CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("Доступ запрещен", show_alert=True)
@@ -155,14 +179,36 @@ async def process_admin_callback(callback: CallbackQuery):
 
     if callback.data == "admin_stats":
         count = await get_users_count()
+        active_count = await get_active_users_count()
         keyboard = InlineKeyboardBuilder()
         keyboard.button(text="📊 Статистика", callback_data="admin_stats")
         keyboard.button(text="💾 Скачать БД", callback_data="admin_export")
         keyboard.button(text="📢 Рассылка", callback_data="admin_broadcast_info")
+        keyboard.button(text="🍌 Топ запросов", callback_data="admin_nutrition_top")
         keyboard.adjust(1)
         
+        logged_today, avg_calories = await get_daily_overview(date_type.today().isoformat())
+        lines = [
+            f"Всего пользователей: {count}\nАктивных: {active_count}",
+            f"Вели дневник сегодня: {logged_today} (в среднем {avg_calories:.0f} ккал)",
+        ]
+        cold_report = await get_state(COLD_STORAGE_STATE_KEY)
+        if cold_report:
+            cold_report = json.loads(cold_report)
+            lines.append(
+                f"🧊 Последнее сжатие истории: {cold_report['rows']} дней, "
+                f"сэкономлено {cold_report['saved_bytes'] // 1024} КБ"
+            )
+        lines += ["", "🤖 Модели:"]
+        for stats in model_stats():
+            p50 = f"{stats['p50']:.1f}с" if stats["p50"] is not None else "—"
+            p95 = f"{stats['p95']:.1f}с" if stats["p95"] is not None else "—"
+            lines.append(
+                f"{'✅' if stats['available'] else '⛔'} {stats['model']}: p50 {p50}, p95 {p95}, "
+                f"ошибки {stats['error_rate']:.0%}, 429 {stats['throttle_rate']:.0%}"
+            )
         await callback.message.edit_text(
-            f"Всего пользователей: {count}",
+            "\n".join(lines),
             reply_markup=keyboard.as_markup()
         )
         await callback.answer()
@@ -170,8 +216,14 @@ async def process_admin_callback(callback: CallbackQuery):
     elif callback.data == "admin_export":
         await callback.answer("Отправляю...")
         try:
-            file = FSInputFile("diet.db")
-            await callback.message.answer_document(file, caption="Backup")
+            # Согласованный сжатый снимок вместо живого файла БД
+            with tempfile.TemporaryDirectory() as tmp:
+                files = await create_backup(tmp, PART_SIZE)
+                for i, path in enumerate(files, start=1):
+                    caption = "Backup" if len(files) == 1 else f"Backup, часть {i}/{len(files)}"
+                    if i == len(files):
+                        caption += f"\nРаспаковка: {restore_hint(files)}"
+                    await callback.message.answer_document(FSInputFile(path), caption=caption)
         except Exception as e:
             await callback.message.answer(f"Ошибка при отправке файла: {e}")
     
@@ -179,6 +231,21 @@ async def process_admin_callback(callback: CallbackQuery):
         await callback.message.answer("Чтобы сделать рассылку, введи команду:\n`/broadcast Текст сообщения`", parse_mode="Markdown")
         await callback.answer()
 
+    elif callback.data == "admin_nutrition_top":
+        hits = nutrition_stats["hits"]
+        misses = nutrition_stats["misses"]
+        total = hits + misses
+        lines = [
+            "🍌 Индекс КБЖУ",
+            f"Попаданий: {hits}, промахов: {misses}"
+            + (f" ({hits * 100 // total}% из индекса)" if total else ""),
+            "",
+        ]
+        for i, (product, count) in enumerate(top_products(10), start=1):
+            lines.append(f"{i}. {product} — {count}")
+        await callback.message.answer("\n".join(lines))
+        await callback.answer()
+
 @dp.message(Command("broadcast"))
 async def cmd_broadcast(message: types.Message):
     if message.from_user.id not in ADMIN_IDS:
@@ -189,156 +256,389 @@ async def cmd_broadcast(message: types.Message):
         await message.answer("Ошибка: введите текст рассылки.\nПример: `/broadcast Привет всем!`")
         return
 
-    text = parts[1]
-    users = await get_all_users()
-    
-    success_count = 0
-    fail_count = 0
+    # Рассылки и напоминания шлёт только лидер: у него одно ведро на лимит Telegram для всего бота
+    if await queue_broadcast(message.from_user.id, parts[1]):
+        await message.answer("Рассылка поставлена в очередь, скоро начнётся.")
+    else:
+        await message.answer("Не удалось поставить рассылку в очередь, попробуйте ещё раз.")
+
+async def run_broadcast(chat_id: int, text: str):
+    """Рассылка всем активным пользователям с отчётом о прогрессе в чат администратора."""
+    total = await get_active_users_count()
     
-    status_msg = await message.answer(f"Начинаю рассылку для {len(users)} пользователей...")
+    status_msg = await bot.send_message(chat_id, f"Начинаю рассылку для {total} пользователей...")
 
-    for user_id in users:
-        try:
-            await bot.send_message(user_id, text)
-            success_count += 1
-            await asyncio.sleep(0.05) 
-        except Exception:
-            fail_count += 1
-            continue
+    async def send(user_id):
+        await bot.send_message(user_id, text)
+
+    async def show_progress(stats):
+        await status_msg.edit_text(
+            f"Рассылка: {stats.done}/{stats.total}\n"
+            f"Успешно: {stats.sent}\n"
+            f"Не доставлено: {stats.failed + stats.blocked}"
+        )
+
+    stats = await broadcast(iter_active_users(), send, on_progress=show_progress, total=total)
 
     await bot.send_message(
-        message.from_user.id,
-        f"Рассылка завершена.\nУспешно: {success_count}\nНе доставлено: {fail_count}"
+        chat_id,
+        f"Рассылка завершена.\nУспешно: {stats.sent}\nНе доставлено: {stats.failed + stats.blocked}"
     )
 
 # --- Web Server (aiohttp) ---
 
+DEFAULT_ANALYZE_PROMPT = "Analyze this food. Return JSON: {\"product_name\": \"...\", \"calories\": 0, \"protein\": 0, \"carbs\": 0, \"fats\": 0}"
+# Максимальный размер текстового поля в multipart-запросе, байты
+MAX_FORM_FIELD_BYTES = 64 * 1024
+
+async def read_analyze_request(request):
+    """
+    Read an /api/analyze request in any of the supported formats:
+    - multipart/form-data: "image" file part + text fields (text, prompt, calories, mime_type)
+    - raw body with Content-Type image/* or application/octet-stream, fields in the query string
+    - JSON with a base64 "image" (kept for compatibility)
+    Binary uploads are streamed with a size limit and their type is taken from magic bytes.
+
+    Returns:
+        dict: image (bytes or None), mime_type, text, calories, prompt
+    """
+    content_type = request.content_type
+    fields = {}
+    image_data = None
+
+    if content_type == "multipart/form-data":
+        reader = await request.multipart()
+        async for part in reader:
+            if part.name in ("image", "file"):
+                image_data = await read_limited(lambda: part.read_chunk(), MAX_IMAGE_BYTES)
+            elif part.name:
+                value = await read_limited(lambda: part.read_chunk(), MAX_FORM_FIELD_BYTES)
+                fields[part.name] = value.decode(part.get_charset(default="utf-8"))
+    elif content_type.startswith("image/") or content_type == "application/octet-stream":
+        fields = dict(request.query)
+        image_data = await read_limited(lambda: request.content.read(READ_CHUNK_SIZE), MAX_IMAGE_BYTES)
+    else:
+        fields = await request.json()
+        if fields.get("image"):
+            image_data = base64.b64decode(fields["image"])
+
+    mime_type = fields.get("mime_type", "image/jpeg")
+    if image_data and content_type != "application/json":
+        mime_type = sniff_mime_type(image_data)
+        if mime_type is None:
+            raise UnsupportedImageError()
+
+    return {
+        "image": image_data or None,
+        "mime_type": mime_type,
+        "text": fields.get("text") or fields.get("query"),
+        # Если пользователь сам указал калории, ответ зависит не только от продукта
+        "calories": fields.get("calories"),
+        "prompt": fields.get("prompt", DEFAULT_ANALYZE_PROMPT),
+    }
+
 async def handle_analyze(request):
+    """
+    POST /api/analyze
+    Analyze a food photo or a text query. See read_analyze_request for the accepted formats.
+    """
     try:
-        data = await request.json()
-        image_base64 = data.get("image")
-        text_query = data.get("text") or data.get("query")
-        mime_type = data.get("mime_type", "image/jpeg")
-        prompt = data.get("prompt", "Analyze this food. Return JSON: {\"product_name\": \"...\", \"calories\": 0, \"protein\": 0, \"carbs\": 0, \"fats\": 0}")
-
-        model = genai.GenerativeModel('gemini-2.0-flash-lite-001')
-
-        if image_base64:
-            # Декодируем картинку
-            image_data = base64.b64decode(image_base64)
-            # Вызываем Gemini с картинкой
-            response = model.generate_content([
-                prompt,
-                {'mime_type': mime_type, 'data': image_data}
-            ])
+        try:
+            data = await read_analyze_request(request)
+        except ImageTooLargeError as e:
+            return web.json_response({"error": str(e)}, status=413, headers={"Access-Control-Allow-Origin": "*"})
+        except UnsupportedImageError as e:
+            return web.json_response({"error": str(e)}, status=415, headers={"Access-Control-Allow-Origin": "*"})
+        except ValueError as e:
+            return web.json_response({"error": f"Invalid request: {e}"}, status=400, headers={"Access-Control-Allow-Origin": "*"})
+        image_data = data["image"]
+        text_query = data["text"]
+        user_calories = data["calories"]
+        mime_type = data["mime_type"]
+        prompt = data["prompt"]
+
+        if image_data:
+            # Вызываем Gemini с картинкой (повторные фото отдаются из кэша)
+            result = await analyze_image(image_data, mime_type, prompt)
         elif text_query:
             # Вызываем Gemini только с текстом
-            full_prompt = f"Определи КБЖУ для продукта: {text_query}. {prompt}"
-            response = model.generate_content(full_prompt)
+            result = await analyze_text(text_query, prompt, use_index=not user_calories)
         else:
             return web.json_response({"error": "No image or text data provided"}, status=400, headers={"Access-Control-Allow-Origin": "*"})
 
-        # Парсим JSON из ответа Gemini
-        text = response.text
-        # Очистка от markdown блоков если есть
-        if "```json" in text:
-            text = text.split("```json")[1].split("```")[0].strip()
-        elif "```" in text:
-            text = text.split("```")[1].split("```")[0].strip()
-        
-        try:
-            result = json.loads(text)
-        except:
-            # Fallback if Gemini fails to return clean JSON
-            result = {"raw_text": response.text}
-
         return web.json_response(result, headers={
             "Access-Control-Allow-Origin": "*",
             "Access-Control-Allow-Methods": "POST, OPTIONS",
             "Access-Control-Allow-Headers": "Content-Type"
         })
 
+    except InferenceBusyError as e:
+        return web.json_response(
+            {"error": str(e)},
+            status=429,
+            headers={"Access-Control-Allow-Origin": "*", "Retry-After": str(e.retry_after)}
+        )
+    except asyncio.TimeoutError:
+        logging.error("Timeout in /api/analyze")
+        return web.json_response({"error": "Analysis timed out"}, status=504, headers={"Access-Control-Allow-Origin": "*"})
     except Exception as e:
         logging.error(f"Error in /api/analyze: {e}")
         return web.json_response({"error": str(e)}, status=500, headers={"Access-Control-Allow-Origin": "*"})
 
-async def handle_options(request):
-    return web.Response(headers={
+def sse_event(event, data):
+    """Encode one Server-Sent Event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode()
+
+async def start_event_stream(request):
+    response = web.StreamResponse(headers={
+        "Content-Type": "text/event-stream",
+        "Cache-Control": "no-cache",
+        # Не даём прокси (nginx, cloudflared) буферизовать поток
+        "X-Accel-Buffering": "no",
         "Access-Control-Allow-Origin": "*",
-        "Access-Control-Allow-Methods": "POST, GET, OPTIONS",
-        "Access-Control-Allow-Headers": "Content-Type, X-Telegram-Init-Data",
-        "Access-Control-Max-Age": "3600",
+        **request.get("quota_headers", {}),
     })
+    await response.prepare(request)
+    return response
 
-def validate_init_data(init_data_string):
+async def handle_analyze_stream(request):
     """
-    Validate Telegram WebApp initData and extract user_id.
-    Returns user_id if valid, raises ValueError if invalid.
+    POST /api/analyze/stream
+    Same input as /api/analyze, answered as Server-Sent Events while Gemini generates:
+    "partial" events with top-level fields as soon as they are known (product_name first),
+    then one "result" event with the full reply, or an "error" event.
+    Errors that happen before the first event get a plain JSON response with a status code.
     """
     try:
-        # Parse the init data
-        parsed = parse_qs(init_data_string)
-        
-        # Extract hash and other data
-        received_hash = parsed.get('hash', [''])[0]
-        if not received_hash:
-            raise ValueError("No hash in initData")
-        
-        # Create data check string (all params except hash, sorted alphabetically)
-        data_check_arr = []
-        for key in sorted(parsed.keys()):
-            if key != 'hash':
-                value = parsed[key][0]
-                data_check_arr.append(f"{key}={value}")
-        data_check_string = '\n'.join(data_check_arr)
-        
-        # Create secret key
-        secret_key = hmac.new(
-            "WebAppData".encode(),
-            BOT_TOKEN.encode(),
-            hashlib.sha256
-        ).digest()
-        
-        # Calculate hash
-        calculated_hash = hmac.new(
-            secret_key,
-            data_check_string.encode(),
-            hashlib.sha256
-        ).hexdigest()
-        
-        # Verify hash
-        if calculated_hash != received_hash:
-            raise ValueError("Invalid hash")
-        
-        # Extract user data
-        user_json = parsed.get('user', [''])[0]
-        if user_json:
-            user_data = json.loads(user_json)
-            return user_data.get('id')
-        
-        raise ValueError("No user data in initData")
+        data = await read_analyze_request(request)
+    except ImageTooLargeError as e:
+        return web.json_response({"error": str(e)}, status=413, headers={"Access-Control-Allow-Origin": "*"})
+    except UnsupportedImageError as e:
+        return web.json_response({"error": str(e)}, status=415, headers={"Access-Control-Allow-Origin": "*"})
+    except ValueError as e:
+        return web.json_response({"error": f"Invalid request: {e}"}, status=400, headers={"Access-Control-Allow-Origin": "*"})
+    if not data["image"] and not data["text"]:
+        return web.json_response({"error": "No image or text data provided"}, status=400, headers={"Access-Control-Allow-Origin": "*"})
+
+    events = asyncio.Queue()
+
+    async def on_partial(fields):
+        events.put_nowait(("partial", fields))
+
+    if data["image"]:
+        analysis = analyze_image(data["image"], data["mime_type"], data["prompt"], on_partial=on_partial)
+    else:
+        # Текстовые запросы короткие и часто отвечаются из индекса, их не стримим
+        analysis = analyze_text(data["text"], data["prompt"], use_index=not data["calories"])
+    task = asyncio.create_task(analysis)
+    task.add_done_callback(lambda _: events.put_nowait(("done", None)))
+    # Если клиент уйдёт раньше, ошибку анализа уже никто не прочитает
+    task.add_done_callback(lambda done: done.cancelled() or done.exception())
+
+    response = None
+    try:
+        while True:
+            event, payload = await events.get()
+            if event == "done":
+                break
+            try:
+                if response is None:
+                    response = await start_event_stream(request)
+                await response.write(sse_event(event, payload))
+            except ConnectionResetError:
+                # Клиент ушёл. Анализ не отменяем: его могут ждать такие же запросы других
+                # пользователей, а результат попадёт в кэш для повторной попытки
+                logging.info("Client disconnected from /api/analyze/stream")
+                return response if response is not None else web.Response(status=400)
+        result = task.result()
+    except InferenceBusyError as e:
+        if response is None:
+            return web.json_response(
+                {"error": str(e)},
+                status=429,
+                headers={"Access-Control-Allow-Origin": "*", "Retry-After": str(e.retry_after)}
+            )
+        result = e
+    except asyncio.TimeoutError:
+        logging.error("Timeout in /api/analyze/stream")
+        if response is None:
+            return web.json_response({"error": "Analysis timed out"}, status=504, headers={"Access-Control-Allow-Origin": "*"})
+        result = TimeoutError("Analysis timed out")
     except Exception as e:
-        logging.error(f"initData validation failed: {e}")
-        raise ValueError(f"Invalid initData: {e}")
+        logging.error(f"Error in /api/analyze/stream: {e}")
+        if response is None:
+            return web.json_response({"error": str(e)}, status=500, headers={"Access-Control-Allow-Origin": "*"})
+        result = e
+
+    try:
+        if response is None:
+            response = await start_event_stream(request)
+        if isinstance(result, BaseException):
+            await response.write(sse_event("error", {"error": str(result)}))
+        else:
+            await response.write(sse_event("result", result))
+        await response.write_eof()
+    except ConnectionResetError:
+        logging.info("Client disconnected from /api/analyze/stream")
+    return response if response is not None else web.Response(status=400)
+
+# Максимум позиций в одном запросе /api/analyze/batch
+MAX_BATCH_ITEMS = int(os.getenv("MAX_BATCH_ITEMS", "10"))
+
+async def read_batch_request(request):
+    """
+    Read an /api/analyze/batch request:
+    - multipart/form-data: any number of "image" file parts and "text" fields, plus prompt and calories
+    - JSON: {"items": [{"text": "..."} | {"image": "<base64>"}], "prompt": "..."}
+    Image types are detected from the bytes in both cases.
+
+    Returns:
+        tuple: (items as {"image", "mime_type", "text"} dicts in request order, prompt, calories)
+
+    Raises:
+        ValueError: Malformed body, no items or more than MAX_BATCH_ITEMS
+        ImageTooLargeError: An image is larger than MAX_IMAGE_BYTES
+        UnsupportedImageError: An image is not a supported format
+    """
+    items = []
+    fields = {}
+    if request.content_type == "multipart/form-data":
+        reader = await request.multipart()
+        async for part in reader:
+            if part.name in ("image", "file"):
+                image_data = await read_limited(lambda: part.read_chunk(), MAX_IMAGE_BYTES)
+                mime_type = sniff_mime_type(image_data)
+                if mime_type is None:
+                    raise UnsupportedImageError()
+                items.append({"image": image_data, "mime_type": mime_type, "text": None})
+            elif part.name:
+                value = await read_limited(lambda: part.read_chunk(), MAX_FORM_FIELD_BYTES)
+                value = value.decode(part.get_charset(default="utf-8"))
+                if part.name in ("text", "query"):
+                    items.append({"image": None, "mime_type": None, "text": value})
+                else:
+                    fields[part.name] = value
+            if len(items) > MAX_BATCH_ITEMS:
+                raise ValueError(f"At most {MAX_BATCH_ITEMS} items per request")
+    else:
+        fields = await request.json()
+        if not isinstance(fields, dict) or not isinstance(fields.get("items") or [], list):
+            raise ValueError('Expected {"items": [...]}')
+        for item in fields.get("items") or []:
+            if not isinstance(item, dict):
+                raise ValueError('Each item must be {"text": ...} or {"image": ...}')
+            if item.get("image"):
+                if not isinstance(item["image"], str):
+                    raise ValueError("Image must be a base64 string")
+                image_data = base64.b64decode(item["image"])
+                if len(image_data) > MAX_IMAGE_BYTES:
+                    raise ImageTooLargeError()
+                mime_type = sniff_mime_type(image_data)
+                if mime_type is None:
+                    raise UnsupportedImageError()
+                items.append({"image": image_data, "mime_type": mime_type, "text": None})
+            elif item.get("text"):
+                items.append({"image": None, "mime_type": None, "text": str(item["text"])})
+
+    if not items:
+        raise ValueError("No image or text items provided")
+    if len(items) > MAX_BATCH_ITEMS:
+        raise ValueError(f"At most {MAX_BATCH_ITEMS} items per request")
+    return items, fields.get("prompt", DEFAULT_ANALYZE_PROMPT), fields.get("calories")
+
+def batch_item(index, result):
+    """Per-item entry of the /api/analyze/batch response."""
+    if isinstance(result, InferenceBusyError):
+        return {"index": index, "status": "busy", "error": str(result)}
+    if isinstance(result, asyncio.TimeoutError):
+        return {"index": index, "status": "timeout", "error": "Analysis timed out"}
+    if isinstance(result, BaseException):
+        logging.error(f"Error in /api/analyze/batch item {index}: {result}")
+        return {"index": index, "status": "error", "error": str(result)}
+    return {"index": index, "status": "ok", "result": result}
+
+async def handle_analyze_batch(request):
+    """
+    POST /api/analyze/batch
+    Analyze several photos and/or text items of one meal in a single round trip.
+    Photos run concurrently, text items are packed into shared prompts.
+    Response: {"items": [{"index", "status", "result" | "error"}], "totals": {...}}
+    """
+    try:
+        items, prompt, user_calories = await read_batch_request(request)
+    except ImageTooLargeError as e:
+        return web.json_response({"error": str(e)}, status=413, headers={"Access-Control-Allow-Origin": "*"})
+    except UnsupportedImageError as e:
+        return web.json_response({"error": str(e)}, status=415, headers={"Access-Control-Allow-Origin": "*"})
+    except ValueError as e:
+        return web.json_response({"error": f"Invalid request: {e}"}, status=400, headers={"Access-Control-Allow-Origin": "*"})
+
+    # Одну единицу квоты уже списал quota_middleware, батч стоит по единице за позицию
+    if len(items) > 1:
+        try:
+            request["quota_headers"] = consume_for_request(request, len(items) - 1)
+        except QuotaExceededError as e:
+            return web.json_response({"error": str(e)}, status=429, headers={"Access-Control-Allow-Origin": "*", **e.headers})
+
+    text_indexes = [i for i, item in enumerate(items) if item["text"] and not item["image"]]
+    image_indexes = [i for i, item in enumerate(items) if item["image"]]
+
+    async def analyze_all_texts():
+        if not text_indexes:
+            return []
+        try:
+            return await analyze_texts([items[i]["text"] for i in text_indexes], prompt, use_index=not user_calories)
+        except Exception as e:
+            return [e] * len(text_indexes)
+
+    text_results, *image_results = await asyncio.gather(
+        analyze_all_texts(),
+        *(analyze_image(items[i]["image"], items[i]["mime_type"], prompt) for i in image_indexes),
+        return_exceptions=True
+    )
+    results = [None] * len(items)
+    for i, result in zip(text_indexes, text_results):
+        results[i] = result
+    for i, result in zip(image_indexes, image_results):
+        results[i] = result
+
+    entries = [batch_item(i, result) for i, result in enumerate(results)]
+    if all(entry["status"] == "busy" for entry in entries):
+        return web.json_response(
+            {"error": entries[0]["error"]},
+            status=429,
+            headers={"Access-Control-Allow-Origin": "*", "Retry-After": str(results[0].retry_after)}
+        )
+    return web.json_response({
+        "items": entries,
+        "totals": total_nutrients(entry["result"] for entry in entries if entry["status"] == "ok"),
+    }, headers={"Access-Control-Allow-Origin": "*"})
+
+async def handle_options(request):
+    return web.Response(headers={
+        "Access-Control-Allow-Origin": "*",
+        "Access-Control-Allow-Methods": "POST, GET, OPTIONS",
+        "Access-Control-Allow-Headers": "Content-Type, X-Telegram-Init-Data, If-None-Match",
+        "Access-Control-Max-Age": "3600",
+    })
+
+# Ждать ли записи в БД перед ответом на /api/sync/save, если клиент не указал сам.
+# С несколькими воркерами следующий /api/sync/load может попасть в другой процесс, поэтому по умолчанию ждём
+SYNC_DURABLE_DEFAULT = os.getenv("SYNC_DURABLE_DEFAULT", "1" if WORKERS > 1 else "0") == "1"
 
 async def handle_sync_save(request):
     """
     POST /api/sync/save
     Save food data to database.
     Headers: X-Telegram-Init-Data
-    Body: {"date": "YYYY-MM-DD", "foodData": {...}}
+    Body: {"date": "YYYY-MM-DD", "foodData": {...}, "durable": false}
+    Writes are buffered and flushed in batches; with "durable": true the
+    response is sent only after the data is committed, and is 409 if another
+    worker stored a newer version of the day first.
     """
     try:
-        # Validate initData
-        init_data = request.headers.get('X-Telegram-Init-Data', '')
-        if not init_data:
-            return web.json_response(
-                {"error": "Missing initData"},
-                status=401,
-                headers={"Access-Control-Allow-Origin": "*"}
-            )
-        
-        user_id = validate_init_data(init_data)
+        # initData уже проверен в auth_middleware
+        user_id = request["user_id"]
         
         # Parse request body
         data = await request.json()
@@ -352,9 +652,17 @@ async def handle_sync_save(request):
                 headers={"Access-Control-Allow-Origin": "*"}
             )
         
-        # Save to database
+        # Save to database (через буфер отложенной записи)
         food_json = json.dumps(food_data)
-        success = await save_food_data(user_id, date, food_json)
+        durable = bool(data.get('durable', SYNC_DURABLE_DEFAULT))
+        try:
+            success = await queue_food_data(user_id, date, food_json, durable=durable)
+        except StaleWriteError as e:
+            return web.json_response(
+                {"error": str(e)},
+                status=409,
+                headers={"Access-Control-Allow-Origin": "*"}
+            )
         
         if success:
             return web.json_response(
@@ -368,12 +676,6 @@ async def handle_sync_save(request):
                 headers={"Access-Control-Allow-Origin": "*"}
             )
     
-    except ValueError as e:
-        return web.json_response(
-            {"error": str(e)},
-            status=401,
-            headers={"Access-Control-Allow-Origin": "*"}
-        )
     except Exception as e:
         logging.error(f"Error in /api/sync/save: {e}")
         return web.json_response(
@@ -382,129 +684,397 @@ async def handle_sync_save(request):
             headers={"Access-Control-Allow-Origin": "*"}
         )
 
+# Ответы меньше этого размера не сжимаем
+COMPRESS_MIN_SIZE = 1024
+# Качество brotli для /api/sync/load: 11 (по умолчанию в brotli) сжимает историю за секунды, 5 - за миллисекунды
+BROTLI_QUALITY = int(os.getenv("SYNC_BROTLI_QUALITY", "5"))
+GZIP_LEVEL = 6
+
+def preferred_encoding(request):
+    """Best Content-Encoding the client accepts: br, gzip or identity."""
+    accept_encoding = request.headers.get("Accept-Encoding", "")
+    if brotli and "br" in accept_encoding:
+        return "br"
+    if "gzip" in accept_encoding:
+        return "gzip"
+    return "identity"
+
+async def encode_history(rows, cursor, encoding):
+    """
+    Build the /api/sync/load body by splicing stored food_json text as is,
+    without parsing and re-serializing it, and compress it with the given encoding.
+    Rows are (date, food_json text, updated_at) tuples.
+
+    Returns:
+        tuple: (Content-Encoding or None, body bytes)
+    """
+    body = (
+        '{"allData":{'
+        + ",".join(f'{json.dumps(date)}:{food_json}' for date, food_json, _ in rows)
+        + '},"cursor":' + json.dumps(cursor) + '}'
+    ).encode()
+    if len(body) < COMPRESS_MIN_SIZE or encoding == "identity":
+        return None, body
+    if encoding == "br":
+        compress = functools.partial(brotli.compress, quality=BROTLI_QUALITY)
+    else:
+        compress = functools.partial(gzip.compress, compresslevel=GZIP_LEVEL)
+    return encoding, await asyncio.get_running_loop().run_in_executor(None, compress, body)
+
+def sync_etag(user_id, since, version):
+    latest, count = version
+    return '"' + hashlib.sha1(f"{user_id}:{since or ''}:{latest}:{count}".encode()).hexdigest() + '"'
+
+def encoded_response(encoded, headers):
+    content_encoding, body = encoded
+    headers = {**headers, "Vary": "Accept-Encoding"}
+    if content_encoding:
+        headers["Content-Encoding"] = content_encoding
+    return web.Response(body=body, content_type="application/json", headers=headers)
+
 async def handle_sync_load(request):
     """
     GET /api/sync/load?date=YYYY-MM-DD
+    GET /api/sync/load?since=<cursor>
     Load food data from database.
-    If date is not provided, return all data.
+    If date is not provided, return all data, or only the days changed
+    after `since` (the cursor returned by the previous load).
+    Full and delta loads carry an ETag; a matching If-None-Match gets 304.
     Headers: X-Telegram-Init-Data
     """
     try:
-        # Validate initData
-        init_data = request.headers.get('X-Telegram-Init-Data', '')
-        if not init_data:
-            return web.json_response(
-                {"error": "Missing initData"},
-                status=401,
-                headers={"Access-Control-Allow-Origin": "*"}
-            )
-        
-        user_id = validate_init_data(init_data)
+        # initData уже проверен в auth_middleware
+        user_id = request["user_id"]
         
         # Get date parameter
         date = request.query.get('date')
+        since = request.query.get('since')
         
         if date:
-            # Load specific date
-            food_data = await get_food_data(user_id, date)
-            return web.json_response(
-                {"date": date, "foodData": food_data},
+            # Load specific date (свежие дни отдаются из кэша, JSON вставляется как есть)
+            food_json = await get_food_json(user_id, date)
+            return web.Response(
+                text='{"date":' + json.dumps(date) + ',"foodData":' + (food_json or "null") + '}',
+                content_type="application/json",
                 headers={"Access-Control-Allow-Origin": "*"}
             )
-        else:
-            # Load all data
-            all_data = await get_all_food_data(user_id)
+
+        # Токен берём до чтения: ответ, собранный во время записи, не попадёт в кэш
+        token = None if since else history_token(user_id)
+        version = None if since else history_version(user_id)
+        if version is None:
+            version = await get_food_log_version(user_id)
+        headers = {
+            "Access-Control-Allow-Origin": "*",
+            "Access-Control-Expose-Headers": "ETag",
+            "Cache-Control": "private, no-cache",
+            "ETag": sync_etag(user_id, since, version),
+        }
+        if request.headers.get('If-None-Match') == headers["ETag"]:
+            return web.Response(status=304, headers=headers)
+
+        encoding = preferred_encoding(request)
+        if since:
+            # Load only days changed after the cursor
+            rows, cursor = await get_food_json_since(user_id, since)
+            return encoded_response(await encode_history(rows, cursor, encoding), headers)
+
+        # Load all data: the encoded body is cached until the user saves again
+        encoded = get_history(user_id, version, encoding)
+        if encoded is None:
+            rows = await get_all_food_json(user_id)
+            # Курсор и ETag - по отданным строкам: пока шло чтение, могли сохранить ещё день
+            rows_version = (max((updated_at for _, _, updated_at in rows), default=None), len(rows))
+            headers["ETag"] = sync_etag(user_id, since, rows_version)
+            encoded = await encode_history(rows, rows_version[0], encoding)
+            if rows:
+                put_history(user_id, token, rows_version, encoding, encoded)
+        return encoded_response(encoded, headers)
+    
+    except Exception as e:
+        logging.error(f"Error in /api/sync/load: {e}")
+        return web.json_response(
+            {"error": str(e)},
+            status=500,
+            headers={"Access-Control-Allow-Origin": "*"}
+        )
+
+async def handle_reminder_settings(request):
+    """
+    POST /api/settings/reminders
+    Save the user's timezone and meal reminder windows.
+    Headers: X-Telegram-Init-Data
+    Body: {"timezone": "Europe/Moscow", "meals": {"breakfast": {"start": "08:00", "end": "09:00"}, ...}}
+    """
+    # initData уже проверен в auth_middleware
+    user_id = request["user_id"]
+
+    try:
+        data = await request.json()
+        tz_name = data.get('timezone')
+        if not tz_name:
             return web.json_response(
-                {"allData": all_data},
+                {"error": "Missing timezone"},
+                status=400,
                 headers={"Access-Control-Allow-Origin": "*"}
             )
-    
-    except ValueError as e:
+        await set_reminder_settings(user_id, tz_name, data.get('meals'))
+        return web.json_response(
+            {"success": True},
+            headers={"Access-Control-Allow-Origin": "*"}
+        )
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        return web.json_response(
+            {"error": f"Invalid settings: {e}"},
+            status=400,
+            headers={"Access-Control-Allow-Origin": "*"}
+        )
+    except Exception as e:
+        logging.error(f"Error in /api/settings/reminders: {e}")
         return web.json_response(
             {"error": str(e)},
-            status=401,
+            status=500,
             headers={"Access-Control-Allow-Origin": "*"}
         )
+
+# Сколько периодов отдаёт /api/stats, если диапазон не указан
+STATS_DEFAULT_RANGE = {"day": timedelta(days=29), "week": timedelta(weeks=11), "month": timedelta(days=334)}
+STATS_MAX_RANGE = timedelta(days=3 * 366)
+
+def count_streak(dates, today):
+    """Consecutive logged days ending today (or yesterday, if today is not logged yet)."""
+    streak = 0
+    expected = today
+    for logged in dates:
+        logged = date_type.fromisoformat(logged)
+        if streak == 0 and logged == today - timedelta(days=1):
+            expected = logged
+        if logged != expected:
+            break
+        streak += 1
+        expected -= timedelta(days=1)
+    return streak
+
+async def handle_stats(request):
+    """
+    GET /api/stats?period=day|week|month&from=YYYY-MM-DD&to=YYYY-MM-DD
+    Nutrition totals per day, week or month from the structured columns and rollups.
+    `to` defaults to today (the client should pass its local date), `from` to a range
+    of 30 days, 12 weeks or 12 months. Averages are per logged day.
+    Headers: X-Telegram-Init-Data
+    """
+    # initData уже проверен в auth_middleware
+    user_id = request["user_id"]
+
+    try:
+        period = request.query.get('period', 'day')
+        if period not in STATS_DEFAULT_RANGE:
+            raise ValueError(f"Unknown period: {period}")
+        end = date_type.fromisoformat(request.query['to']) if 'to' in request.query else date_type.today()
+        start = (date_type.fromisoformat(request.query['from']) if 'from' in request.query
+                 else end - STATS_DEFAULT_RANGE[period])
+        if start > end or end - start > STATS_MAX_RANGE:
+            raise ValueError("Invalid date range")
+    except ValueError as e:
+        return web.json_response(
+            {"error": f"Invalid request: {e}"},
+            status=400,
+            headers={"Access-Control-Allow-Origin": "*"}
+        )
+
+    try:
+        if period == "day":
+            rows = [(day, 1, *totals) for day, *totals in await get_daily_totals(user_id, start.isoformat(), end.isoformat())]
+        else:
+            # Период, в который попадает `from`, тоже включаем
+            first = start - timedelta(days=start.weekday()) if period == "week" else start.replace(day=1)
+            rows = await get_rollups(user_id, period, first.isoformat(), end.isoformat())
+
+        items = []
+        for period_start, days, calories, protein, carbs, fats in rows:
+            items.append({
+                "start": period_start,
+                "days": days,
+                "calories": round(calories),
+                "protein": round(protein, 1),
+                "carbs": round(carbs, 1),
+                "fats": round(fats, 1),
+                "avg_calories": round(calories / days),
+            })
+
+        logged_days = sum(item["days"] for item in items)
+        summary = {"days": logged_days}
+        for name in ("calories", "protein", "carbs", "fats"):
+            total = sum(item[name] for item in items)
+            summary[f"avg_{name}"] = round(total / logged_days, 1) if logged_days else 0
+
+        streak = count_streak(await get_logged_dates(user_id, end.isoformat()), end)
+        return web.json_response({
+            "period": period,
+            "from": start.isoformat(),
+            "to": end.isoformat(),
+            "items": items,
+            "summary": summary,
+            "streak": streak,
+        }, headers={"Access-Control-Allow-Origin": "*"})
     except Exception as e:
-        logging.error(f"Error in /api/sync/load: {e}")
+        logging.error(f"Error in /api/stats: {e}")
         return web.json_response(
             {"error": str(e)},
             status=500,
             headers={"Access-Control-Allow-Origin": "*"}
         )
 
-async def init_web():
-    app = web.Application(client_max_size=20*1024*1024)
+def create_app():
+    """Собирает aiohttp-приложение со всеми API и (в режиме webhook) обработчиком Telegram."""
+    app = web.Application(client_max_size=20*1024*1024, middlewares=[metrics_middleware, auth_middleware, quota_middleware])
     app.router.add_post('/api/analyze', handle_analyze)
     app.router.add_options('/api/analyze', handle_options)
+    app.router.add_post('/api/analyze/stream', handle_analyze_stream)
+    app.router.add_options('/api/analyze/stream', handle_options)
+    app.router.add_post('/api/analyze/batch', handle_analyze_batch)
+    app.router.add_options('/api/analyze/batch', handle_options)
     app.router.add_post('/api/sync/save', handle_sync_save)
     app.router.add_get('/api/sync/load', handle_sync_load)
     app.router.add_options('/api/sync/save', handle_options)
     app.router.add_options('/api/sync/load', handle_options)
-    runner = web.AppRunner(app)
+    app.router.add_get('/api/stats', handle_stats)
+    app.router.add_options('/api/stats', handle_options)
+    app.router.add_post('/api/settings/reminders', handle_reminder_settings)
+    app.router.add_options('/api/settings/reminders', handle_options)
+    if METRICS_TOKEN:
+        # Основной порт публичный: без токена метрики доступны только на METRICS_HOST:METRICS_PORT
+        app.router.add_get('/metrics', handle_metrics)
+    setup_webhook(app, dp, bot)
+    return app
+
+async def start_web(app, port: int = 8080):
+    runner = web.AppRunner(app, shutdown_timeout=SHUTDOWN_TIMEOUT)
     await runner.setup()
-    site = web.TCPSite(runner, '0.0.0.0', 8080)
+    # Несколько воркеров слушают один порт, ядро распределяет соединения между ними
+    site = web.TCPSite(runner, '0.0.0.0', port, reuse_port=WORKERS > 1)
     await site.start()
-    print("🚀 Web server started on port 8080")
+    print(f"🚀 Web server started on port {port}")
     print("📊 Sync endpoints: /api/sync/save, /api/sync/load")
+    return runner
 
 def schedule_reminders():
     """Настраивает расписание для умных напоминаний"""
     scheduler = AsyncIOScheduler()
     
-    # Завтрак: 09:00 - 10:00 (выбираем середину - 09:30)
+    # Раз в минуту рассылаем напоминания тем, у кого по местному времени
+    # наступил их слот (окна по умолчанию: 09:00-10:00, 14:00-15:00, 19:00-20:00)
     scheduler.add_job(
-        send_meal_reminder,
-        CronTrigger(hour=9, minute=30),
-        args=["breakfast"],
-        id="breakfast_reminder"
-    )
-    
-    # Обед: 14:00 - 15:00 (выбираем середину - 14:30)
-    scheduler.add_job(
-        send_meal_reminder,
-        CronTrigger(hour=14, minute=30),
-        args=["lunch"],
-        id="lunch_reminder"
-    )
-    
-    # Ужин: 19:00 - 20:00 (выбираем середину - 19:30)
-    scheduler.add_job(
-        send_meal_reminder,
-        CronTrigger(hour=19, minute=30),
-        args=["dinner"],
-        id="dinner_reminder"
+        run_due_reminders,
+        CronTrigger(second=0),
+        args=[send_meal_reminder],
+        id="meal_reminders",
+        max_instances=1,
+        coalesce=True
     )
     
     scheduler.start()
     print("⏰ Умные напоминания настроены!")
-    print("   🍳 Завтрак: 09:30")
-    print("   🍲 Обед: 14:30")
-    print("   🥗 Ужин: 19:30")
+    print("   🍳 Завтрак: 09:00-10:00")
+    print("   🍲 Обед: 14:00-15:00")
+    print("   🥗 Ужин: 19:00-20:00")
+    print("   🌍 По местному времени каждого пользователя")
     
     return scheduler
 
-async def main():
+COLD_STORAGE_STATE_KEY = "cold_storage_report"
+
+async def run_cold_storage():
+    """Ночная задача: сжимаем старые дни дневника и запоминаем, сколько места сэкономили."""
+    started = time.monotonic()
+    rows, before, after = await compact_food_logs()
+    report = {
+        "rows": rows,
+        "saved_bytes": before - after,
+        "ratio": round(before / after, 1) if after else None,
+        "seconds": round(time.monotonic() - started, 1),
+    }
+    logging.info(
+        f"🧊 Cold storage: {rows} rows compacted, {before // 1024} KB -> {after // 1024} KB "
+        f"in {report['seconds']}s"
+    )
+    await set_state(COLD_STORAGE_STATE_KEY, json.dumps(report))
+
+async def run_queued_broadcasts():
+    """Рассылки из очереди (команду /broadcast мог принять любой воркер)."""
+    for chat_id, text in await take_broadcast_jobs():
+        try:
+            await run_broadcast(chat_id, text)
+        except Exception as e:
+            logging.error(f"❌ Broadcast failed: {e}")
+
+async def run_leader_duties():
+    """Работа, которая должна идти ровно в одном воркере: напоминания, рассылки, ночные задачи и приём апдейтов."""
+    # Настраиваем расписание напоминаний
+    scheduler = schedule_reminders()
+    scheduler.add_job(run_cold_storage, CronTrigger(hour=4, minute=30), id="cold_storage", max_instances=1)
+    scheduler.add_job(run_queued_broadcasts, "interval", seconds=2, id="broadcasts", max_instances=1, coalesce=True)
+    if BACKUP_INTERVAL_HOURS > 0:
+        # Плановые бэкапы с ротацией в BACKUP_DIR
+        scheduler.add_job(run_scheduled_backup, "interval", hours=BACKUP_INTERVAL_HOURS, id="backup", max_instances=1)
+    try:
+        # Бот получает апдейты через webhook на нашем же веб-сервере или через polling
+        if await start_webhook(dp, bot):
+            await asyncio.Event().wait()
+        else:
+            await start_polling(dp, bot)
+    finally:
+        scheduler.shutdown(wait=False)
+
+async def main(worker: int = 0):
     logging.basicConfig(level=logging.INFO)
+    configure_metrics(worker, WORKERS)
+    
+    # Процессы для обработки фото создаём до запуска потоков БД
+    init_image_pool()
     
     # Initialize database
     await init_database()
+    await init_nutrition_index()
+    await init_reminders()
+    await init_models()
+    await init_quotas(worker, WORKERS)
+    init_food_cache(WORKERS)
     
-    # Настраиваем расписание напоминаний
-    scheduler = schedule_reminders()
+    # Счётчики в памяти есть у каждого воркера, сохраняет их каждый сам
+    scheduler = AsyncIOScheduler()
+    # Счётчики индекса КБЖУ сохраняем в БД раз в 5 минут
+    scheduler.add_job(flush_nutrition_hits, "interval", minutes=5, id="nutrition_hits_flush")
+    # Счётчики квот сохраняем раз в минуту, чтобы перезапуск их не сбрасывал
+    scheduler.add_job(flush_quotas, "interval", minutes=1, id="quota_flush")
+    scheduler.start()
+    
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
     
+    runner = await start_web(create_app())
+    # С несколькими воркерами /metrics на общем порту отвечает случайный из них, поэтому у каждого свой порт
+    metrics_runner = await start_metrics_server(METRICS_PORT + worker) if METRICS_PORT else None
+    lag_monitor = asyncio.create_task(monitor_event_loop())
     try:
-        # Запускаем и бота, и веб-сервер
-        await asyncio.gather(
-            dp.start_polling(bot),
-            init_web()
-        )
+        await run_as_leader(run_leader_duties, stop)
     finally:
-        # Останавливаем scheduler при завершении
+        lag_monitor.cancel()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        # Перестаём принимать соединения и ждём незавершённые запросы (до SHUTDOWN_TIMEOUT)
+        await runner.cleanup()
+        await bot.session.close()
         scheduler.shutdown()
+        await flush_nutrition_hits()
+        await flush_quotas()
+        await close_database()
+        shutdown_image_pool()
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        run_workers(lambda worker: asyncio.run(main(worker)))
     except (KeyboardInterrupt, SystemExit):
         pass
\ No newline at end of file
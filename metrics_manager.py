@@ -0,0 +1,201 @@
+import asyncio
+import functools
+import hmac
+import logging
+import os
+import time
+from bisect import bisect_left
+from aiohttp import web
+
+# Отдельный порт для /metrics каждого воркера (METRICS_PORT + номер); 0 - не поднимать
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# Адрес этого порта: по умолчанию только локальный, метрики раскрывают модели, квоты и трафик
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# Если задан, /metrics отдаётся и на основном порту, но только с "Authorization: Bearer <токен>"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+# Как часто меряем задержку event loop, секунды
+LOOP_LAG_INTERVAL = float(os.getenv("METRICS_LOOP_LAG_INTERVAL", "0.5"))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1, 5)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_metrics = []
+# Функции, обновляющие Gauge перед каждой выдачей метрик
+_collectors = []
+# Метки, добавляемые ко всем рядам (например, номер воркера)
+_common_labels = {}
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple, extra: dict = None) -> str:
+    pairs = [*_common_labels.items(), *zip(names, values), *(extra or {}).items()]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._series = {}
+        _metrics.append(self)
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self):
+        lines = self._header()
+        for values, value in self._series.items():
+            lines.append(f"{self.name}{_format_labels(self.labels, values)} {value}")
+        return lines
+
+
+class Counter(_Metric):
+    """Monotonic counter, one series per combination of label values."""
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1):
+        self._series[labels] = self._series.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    """Current value, usually set by a collector right before a scrape."""
+    kind = "gauge"
+
+    def set(self, value: float, *labels):
+        self._series[labels] = value
+
+    def clear(self):
+        self._series.clear()
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in fixed buckets, as Prometheus expects."""
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            # [счётчики по корзинам (последняя - +Inf), сумма, количество]
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        lines = self._header()
+        for values, (counts, total, count) in self._series.items():
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labels, values, {"le": bound})
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+def timed(histogram: Histogram, *labels):
+    """Decorator observing the duration of an async function in histogram (also on errors)."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, *labels)
+        return wrapper
+    return decorator
+
+
+def register_collector(collector):
+    """Call collector() before every scrape, e.g. to copy in-memory stats into gauges."""
+    _collectors.append(collector)
+
+
+def configure_metrics(worker: int = 0, workers: int = 1):
+    """Label every series with the worker index when several workers serve the app."""
+    _common_labels.clear()
+    if workers > 1:
+        _common_labels["worker"] = str(worker)
+
+
+def render_metrics() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    for collector in _collectors:
+        try:
+            collector()
+        except Exception as e:
+            logging.warning(f"⚠️ Metrics collector failed: {e}")
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+HTTP_REQUESTS = Counter("diet_http_requests_total", "HTTP requests by route and status", ("route", "method", "status"))
+HTTP_LATENCY = Histogram("diet_http_request_duration_seconds", "HTTP request duration", ("route", "method"))
+LOOP_LAG = Histogram(
+    "diet_event_loop_lag_seconds", "Delay of event loop wake-ups", buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+)
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    """Count requests and observe their duration per route pattern (not per URL, to keep series few)."""
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource is not None else "unmatched"
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        HTTP_LATENCY.observe(time.perf_counter() - started, route, request.method)
+        HTTP_REQUESTS.inc(route, request.method, str(status))
+
+
+async def handle_metrics(request):
+    """GET /metrics (Authorization: Bearer METRICS_TOKEN when the token is set)"""
+    if METRICS_TOKEN and not hmac.compare_digest(
+        request.headers.get("Authorization", "").encode(), f"Bearer {METRICS_TOKEN}".encode()
+    ):
+        return web.Response(status=401, headers={"WWW-Authenticate": "Bearer"})
+    return web.Response(body=render_metrics().encode(), headers={"Content-Type": CONTENT_TYPE})
+
+
+async def monitor_event_loop(interval: float = LOOP_LAG_INTERVAL):
+    """Measure how late the event loop wakes up after a sleep; long callbacks show up as lag."""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0.0, time.perf_counter() - started - interval))
+
+
+async def start_metrics_server(port: int, host: str = METRICS_HOST):
+    """Serve /metrics of this process on its own port (workers share the main port)."""
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"📈 Metrics on {host}:{port}")
+    return runner
@@ -0,0 +1,164 @@
+import logging
+import os
+import re
+import time
+from collections import Counter
+from db_manager import load_nutrition_index, save_nutrition_entry, add_nutrition_hits
+import metrics_manager
+
+# Максимум продуктов в индексе
+MAX_ENTRIES = int(os.getenv("NUTRITION_INDEX_MAX", "50000"))
+
+NUTRIENT_KEYS = ("calories", "protein", "carbs", "fats", "fat")
+NAME_KEYS = ("name", "product_name")
+
+# Единицы измерения -> (каноническая единица, множитель)
+UNITS = {
+    "г": ("g", 1), "гр": ("g", 1), "грамм": ("g", 1), "грамма": ("g", 1), "граммов": ("g", 1),
+    "g": ("g", 1), "gr": ("g", 1),
+    "кг": ("g", 1000), "kg": ("g", 1000),
+    "мл": ("ml", 1), "ml": ("ml", 1),
+    "л": ("ml", 1000), "литр": ("ml", 1000), "литра": ("ml", 1000), "l": ("ml", 1000),
+    "шт": ("pcs", 1), "штук": ("pcs", 1), "штуки": ("pcs", 1), "штука": ("pcs", 1), "pcs": ("pcs", 1),
+}
+
+_QUANTITY_RE = re.compile(
+    r"(?<![\w.,])(\d+(?:[.,]\d+)?)\s*(" + "|".join(sorted(UNITS, key=len, reverse=True)) + r")?(?![\w%])"
+)
+_JUNK_RE = re.compile(r"[^\w\s]")
+
+# (product, unit) -> (base_qty, result)
+_index = {}
+# (product, unit) -> число попаданий, ещё не записанное в БД
+_pending_hits = Counter()
+# (product, unit) -> число попаданий за всё время
+_total_hits = Counter()
+stats = {"hits": 0, "misses": 0}
+INDEX_REQUESTS = metrics_manager.Counter(
+    "diet_nutrition_index_requests_total", "Text queries answered from the local index (hit) or sent to Gemini (miss)", ("result",)
+)
+
+
+def normalize_query(text: str):
+    """
+    Split a free-form food query into canonical product and quantity.
+
+    "Гречка  100 гр." -> ("гречка", 100.0, "g")
+    "2 банана"        -> ("банана", 2.0, "pcs")
+    "банан"           -> ("банан", None, "")
+
+    Returns:
+        tuple: (product, quantity or None, unit)
+    """
+    text = text.lower().replace("ё", "е")
+    quantity, unit = None, ""
+    match = _QUANTITY_RE.search(text)
+    if match:
+        quantity = float(match.group(1).replace(",", "."))
+        unit, factor = UNITS.get(match.group(2) or "шт")
+        quantity *= factor
+        text = text[:match.start()] + " " + text[match.end():]
+    product = " ".join(_JUNK_RE.sub(" ", text).split())
+    return product, quantity, unit
+
+
+def _scale(result: dict, factor: float, name: str) -> dict:
+    scaled = dict(result)
+    for key in NUTRIENT_KEYS:
+        if key in scaled:
+            try:
+                value = float(scaled[key]) * factor
+            except (TypeError, ValueError):
+                continue
+            scaled[key] = round(value) if key == "calories" else round(value, 1)
+    for key in NAME_KEYS:
+        if key in scaled:
+            scaled[key] = name
+    return scaled
+
+
+def total_nutrients(results) -> dict:
+    """
+    Sum calories and macronutrients over several analysis results.
+    Results without numeric values (errors, raw_text replies) are skipped.
+    """
+    totals = {"calories": 0, "protein": 0.0, "carbs": 0.0, "fats": 0.0}
+    for result in results:
+        if not isinstance(result, dict):
+            continue
+        for key in totals:
+            value = result.get(key, result.get("fat")) if key == "fats" else result.get(key)
+            try:
+                totals[key] += float(value)
+            except (TypeError, ValueError):
+                continue
+    return {key: round(value) if key == "calories" else round(value, 1) for key, value in totals.items()}
+
+
+async def init_nutrition_index():
+    """Load the persisted index into memory."""
+    for product, unit, base_qty, result, hits in await load_nutrition_index():
+        _index[(product, unit)] = (base_qty, result)
+        _total_hits[(product, unit)] = hits
+    logging.info(f"✅ Nutrition index loaded: {len(_index)} products")
+
+
+def lookup_nutrition(text_query: str):
+    """
+    Answer a text query from the local index.
+
+    Returns:
+        dict: Nutrition facts scaled to the requested quantity or None on miss
+    """
+    product, quantity, unit = normalize_query(text_query)
+    entry = _index.get((product, unit))
+    if entry is None or (quantity is not None and not entry[0]):
+        stats["misses"] += 1
+        INDEX_REQUESTS.inc("miss")
+        return None
+    stats["hits"] += 1
+    INDEX_REQUESTS.inc("hit")
+    _pending_hits[(product, unit)] += 1
+    _total_hits[(product, unit)] += 1
+    base_qty, result = entry
+    factor = quantity / base_qty if quantity is not None else 1
+    return _scale(result, factor, text_query.strip())
+
+
+async def remember_nutrition(text_query: str, result):
+    """Store a model answer for a text query in the index."""
+    if not isinstance(result, dict):
+        return
+    try:
+        float(result.get("calories"))
+    except (TypeError, ValueError):
+        return
+    product, quantity, unit = normalize_query(text_query)
+    if not product or quantity == 0:
+        return
+    if (product, unit) not in _index and len(_index) >= MAX_ENTRIES:
+        return
+    _index[(product, unit)] = (quantity, result)
+    await save_nutrition_entry(product, unit, quantity, result, time.time())
+
+
+async def flush_nutrition_hits():
+    """Persist hit counters accumulated since the last flush."""
+    if not _pending_hits:
+        return
+    hits = [(delta, product, unit) for (product, unit), delta in _pending_hits.items()]
+    _pending_hits.clear()
+    await add_nutrition_hits(hits)
+
+
+def top_products(limit: int = 10):
+    """
+    Most requested products.
+
+    Returns:
+        list: Tuples (product with quantity unit, hits)
+    """
+    return [
+        (f"{product} [{unit}]" if unit else product, hits)
+        for (product, unit), hits in _total_hits.most_common(limit)
+    ]
@@ -0,0 +1,276 @@
+import ipaddress
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from aiohttp import web
+from db_manager import load_quota_counters, save_quota_counters
+from metrics_manager import Counter, Gauge, register_collector
+
+# Все лимиты ниже - на весь сервис: с WORKERS > 1 счётчики у воркеров свои, и каждый получает 1/WORKERS лимита.
+# Клиент, чьи запросы расходятся по всем воркерам, получает весь лимит, попавший на один воркер - его долю
+# (но запас и дневной лимит не меньше одного запроса)
+# Запросов в минуту и размер "запаса" для пользователя с валидным initData
+USER_RATE = float(os.getenv("QUOTA_USER_PER_MINUTE", "10")) / 60
+USER_BURST = float(os.getenv("QUOTA_USER_BURST", "5"))
+# То же для запросов без initData (ключ - IP-адрес)
+IP_RATE = float(os.getenv("QUOTA_IP_PER_MINUTE", "4")) / 60
+IP_BURST = float(os.getenv("QUOTA_IP_BURST", "3"))
+# Дневные лимиты запросов (UTC-сутки)
+USER_DAILY = int(os.getenv("QUOTA_USER_DAILY", "200"))
+IP_DAILY = int(os.getenv("QUOTA_IP_DAILY", "30"))
+# Общий бюджет под квоту Gemini: запросов в минуту и в сутки (0 - без дневного лимита)
+GLOBAL_RATE = float(os.getenv("QUOTA_GLOBAL_PER_MINUTE", "1000")) / 60
+GLOBAL_BURST = float(os.getenv("QUOTA_GLOBAL_BURST", "50"))
+GLOBAL_DAILY = int(os.getenv("QUOTA_GLOBAL_DAILY", "0"))
+# Брать IP клиента из CF-Connecting-IP / X-Forwarded-For: 1 - всегда, 0 - никогда,
+# auto - если запрос пришёл с localhost (cloudflared-туннель из script.js работает на той же машине)
+TRUST_PROXY = os.getenv("QUOTA_TRUST_PROXY", "auto")
+
+# Эндпоинты, которые расходуют квоту
+QUOTA_PREFIXES = ("/api/analyze",)
+# Ответы, после которых квота возвращается: запрос отклонён, не дойдя до Gemini
+REFUND_STATUSES = (400, 413, 415, 429)
+GLOBAL_KEY = "global"
+
+EXPOSED_HEADERS = "Retry-After, X-RateLimit-Limit, X-RateLimit-Remaining, X-RateLimit-Reset"
+
+# key -> [daily used, bucket tokens, bucket updated_at (unix time)]
+_counters = {}
+_day = None
+# С несколькими воркерами каждый получает свою долю всех лимитов и хранит счётчики под своим префиксом
+_worker_share = 1.0
+_key_prefix = ""
+
+QUOTA_REJECTED = Counter("diet_quota_rejected_total", "Requests refused with 429 by scope (user, ip, global)", ("scope",))
+QUOTA_KEYS = Gauge("diet_quota_tracked_keys", "Quota counters kept in memory")
+GLOBAL_USED = Gauge("diet_quota_global_used", "Global analysis units spent today by this process")
+# Ключи, изменённые с последнего сохранения
+_dirty = set()
+
+
+class QuotaExceededError(Exception):
+    """Raised when a client or the whole service is out of quota."""
+
+    def __init__(self, message: str, retry_after: int, headers: dict):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.headers = headers
+
+
+def _today() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+
+def _seconds_to_reset(now: float) -> int:
+    return int(86400 - now % 86400)
+
+
+def _limits(key: str):
+    """(rate, burst, daily cap) for a counter key."""
+    if key == GLOBAL_KEY:
+        rate, burst, daily = GLOBAL_RATE, GLOBAL_BURST, GLOBAL_DAILY
+    elif key.startswith("user:"):
+        rate, burst, daily = USER_RATE, USER_BURST, USER_DAILY
+    else:
+        rate, burst, daily = IP_RATE, IP_BURST, IP_DAILY
+    if _worker_share == 1:
+        return rate, burst, daily
+    # 0 в дневном лимите - "без лимита", его не делим
+    return rate * _worker_share, max(1.0, burst * _worker_share), daily and max(1, int(daily * _worker_share))
+
+
+def _counter(key: str, now: float):
+    global _day
+    day = _today()
+    if day != _day:
+        # Новые сутки: дневные счётчики обнуляются, ведра оставляем
+        for counter in _counters.values():
+            counter[0] = 0
+        _day = day
+    counter = _counters.get(key)
+    if counter is None:
+        counter = _counters[key] = [0, _limits(key)[1], now]
+    rate, burst, _ = _limits(key)
+    counter[1] = min(burst, counter[1] + (now - counter[2]) * rate)
+    counter[2] = now
+    return counter
+
+
+def _check(key: str, cost: int, now: float):
+    """Seconds to wait before key can spend cost (0 if it can now), and the reason."""
+    used, tokens, _ = _counter(key, now)
+    rate, _, daily = _limits(key)
+    if daily and used + cost > daily:
+        return _seconds_to_reset(now), "Daily limit reached"
+    if tokens < cost:
+        return int((cost - tokens) / rate) + 1, "Too many requests"
+    return 0, None
+
+
+def _trust_proxy(remote) -> bool:
+    if TRUST_PROXY != "auto":
+        return TRUST_PROXY == "1"
+    try:
+        return ipaddress.ip_address(remote).is_loopback
+    except ValueError:
+        return False
+
+
+def client_key(request) -> str:
+    """
+    Quota key of the caller: validated Telegram user, or IP for anonymous calls.
+    Behind a local proxy every call comes from 127.0.0.1, so the client IP is taken
+    from its CF-Connecting-IP / X-Forwarded-For header (see TRUST_PROXY).
+    """
+    if request.get("user_id"):
+        return f"user:{request['user_id']}"
+    ip = request.remote
+    if _trust_proxy(ip):
+        forwarded = request.headers.get("CF-Connecting-IP") or request.headers.get("X-Forwarded-For", "")
+        ip = forwarded.split(",")[0].strip() or ip
+    return f"ip:{ip}"
+
+
+def quota_headers(key: str, now: float = None) -> dict:
+    """
+    X-RateLimit-* headers describing the daily quota of key,
+    or its per-minute bucket if the daily quota is unlimited.
+    """
+    now = now or time.time()
+    used, tokens, _ = _counter(key, now)
+    rate, burst, daily = _limits(key)
+    if daily:
+        limit, remaining, reset = daily, max(0, daily - used), _seconds_to_reset(now)
+    else:
+        limit, remaining, reset = int(burst), int(tokens), int((burst - tokens) / rate) + 1 if tokens < burst else 0
+    return {
+        "X-RateLimit-Limit": str(limit),
+        "X-RateLimit-Remaining": str(remaining),
+        "X-RateLimit-Reset": str(reset),
+        "Access-Control-Expose-Headers": EXPOSED_HEADERS,
+    }
+
+
+def consume(key: str, cost: int = 1) -> dict:
+    """
+    Spend cost units of the client's and the global quota.
+    Nothing is spent if either of them is exhausted.
+
+    Returns:
+        dict: Rate limit headers for the response
+
+    Raises:
+        QuotaExceededError: The client or the whole service is out of quota
+    """
+    now = time.time()
+    for counter_key in (key, GLOBAL_KEY):
+        retry_after, reason = _check(counter_key, cost, now)
+        if retry_after:
+            QUOTA_REJECTED.inc(counter_key.split(":")[0])
+            if counter_key == GLOBAL_KEY:
+                logging.warning(f"⚠️ Global analysis budget exhausted ({reason})")
+                reason = f"Service is busy: {reason.lower()}"
+            headers = quota_headers(key, now)
+            headers["Retry-After"] = str(retry_after)
+            raise QuotaExceededError(reason, retry_after, headers)
+
+    for counter_key in (key, GLOBAL_KEY):
+        counter = _counters[counter_key]
+        counter[0] += cost
+        counter[1] -= cost
+        _dirty.add(counter_key)
+    return quota_headers(key, now)
+
+
+def refund(key: str, cost: int = 1):
+    """Give back units spent by consume() for a request that was rejected before any analysis."""
+    now = time.time()
+    for counter_key in (key, GLOBAL_KEY):
+        counter = _counter(counter_key, now)
+        counter[0] = max(0, counter[0] - cost)
+        counter[1] = min(_limits(counter_key)[1], counter[1] + cost)
+        _dirty.add(counter_key)
+
+
+def consume_for_request(request, cost: int = 1) -> dict:
+    """consume() for the caller of an aiohttp request; the cost is refunded if the request is rejected."""
+    headers = consume(client_key(request), cost)
+    request["quota_cost"] = request.get("quota_cost", 0) + cost
+    return headers
+
+
+async def init_quotas(worker: int = 0, workers: int = 1):
+    """
+    Restore today's counters so a restart does not reset quotas.
+
+    Workers do not share counters, so every limit (global and per client) is
+    split between them evenly. A client whose requests reach all workers gets
+    the configured limit; one that sticks to a single worker gets 1/workers of it.
+
+    Args:
+        worker: Index of this worker process
+        workers: Number of worker processes
+    """
+    global _day, _worker_share, _key_prefix
+    _day = _today()
+    _worker_share = 1 / max(1, workers)
+    _key_prefix = f"w{worker}:" if workers > 1 else ""
+    for key, used, tokens, updated_at in await load_quota_counters(_day):
+        if key.startswith(_key_prefix):
+            _counters[key[len(_key_prefix):]] = [used, tokens, updated_at]
+    logging.info(f"✅ Quota counters loaded: {len(_counters)}")
+
+
+async def flush_quotas():
+    """Persist counters changed since the last flush and forget idle ones."""
+    if _dirty:
+        keys = list(_dirty)
+        _dirty.clear()
+        counters = [(_key_prefix + key, *_counters[key]) for key in keys if key in _counters]
+        if not await save_quota_counters(_day or _today(), counters):
+            _dirty.update(keys)
+
+    # Клиенты без расхода за сутки и с полным ведром не нужны в памяти
+    now = time.time()
+    for key in [key for key, counter in _counters.items() if counter[0] == 0 and key not in _dirty]:
+        if _counter(key, now)[1] >= _limits(key)[1]:
+            del _counters[key]
+
+
+def _collect_metrics():
+    QUOTA_KEYS.set(len(_counters))
+    GLOBAL_USED.set(_counters[GLOBAL_KEY][0] if GLOBAL_KEY in _counters else 0)
+
+
+register_collector(_collect_metrics)
+
+
+@web.middleware
+async def quota_middleware(request, handler):
+    """
+    Charge one unit of quota for every call to QUOTA_PREFIXES and add X-RateLimit-* headers.
+    Units are refunded if the handler rejects the request (REFUND_STATUSES), e.g. an unsupported image.
+    Must run after auth_middleware, which identifies the user.
+    """
+    if request.method == "OPTIONS" or not request.path.startswith(QUOTA_PREFIXES):
+        return await handler(request)
+
+    try:
+        request["quota_headers"] = consume_for_request(request)
+    except QuotaExceededError as e:
+        return web.json_response(
+            {"error": str(e)},
+            status=429,
+            headers={"Access-Control-Allow-Origin": "*", **e.headers}
+        )
+
+    response = await handler(request)
+    if response.status in REFUND_STATUSES:
+        key = client_key(request)
+        refund(key, request["quota_cost"])
+        request["quota_headers"] = quota_headers(key)
+    if not response.prepared:
+        # Батч мог потратить больше одной единицы, показываем актуальный остаток
+        response.headers.update(request["quota_headers"])
+    return response
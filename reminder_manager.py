@@ -0,0 +1,173 @@
+import logging
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from db_manager import (
+    save_reminder_slots, set_reminder_timezone, get_users_without_reminder_slots, get_reminder_timezones,
+    get_due_reminders, mark_reminders_sent, prune_reminder_deliveries, get_state, set_state
+)
+from metrics_manager import Histogram, timed
+
+DEFAULT_TIMEZONE = os.getenv("DEFAULT_TIMEZONE", "Europe/Moscow")
+# Сколько минут пропущенного расписания догоняем после перезапуска
+CATCHUP_MINUTES = int(os.getenv("REMINDER_CATCHUP_MINUTES", "30"))
+# Напоминания, не доставленные из-за сбоя на нашей стороне (сеть, 5xx, перезапуск), повторяем столько минут
+RETRY_MINUTES = int(os.getenv("REMINDER_RETRY_MINUTES", "5"))
+# Сколько дней храним отметки о доставке
+DELIVERY_RETENTION_DAYS = 3
+
+# Окна приёмов пищи по умолчанию: meal -> (начало, конец) в минутах локального дня
+DEFAULT_MEAL_WINDOWS = {
+    "breakfast": (9 * 60, 10 * 60),
+    "lunch": (14 * 60, 15 * 60),
+    "dinner": (19 * 60, 20 * 60),
+}
+
+STATE_KEY = "reminders_last_minute"
+
+REMINDER_RUN = Histogram("diet_reminder_run_seconds", "Duration of the per-minute reminder job")
+
+
+def parse_time(value: str) -> int:
+    """"HH:MM" -> minute of the day."""
+    hours, minutes = value.split(":")
+    minute = int(hours) * 60 + int(minutes)
+    if not 0 <= minute < 24 * 60:
+        raise ValueError(f"Invalid time: {value}")
+    return minute
+
+
+def slot_minute(user_id: int, window: tuple) -> int:
+    """
+    Minute inside the meal window at which the user is reminded.
+    Users are spread evenly over the window instead of all at its start.
+    """
+    start, end = window
+    span = (end - start) % (24 * 60) or 1
+    return (start + user_id % span) % (24 * 60)
+
+
+def validate_timezone(name: str) -> str:
+    try:
+        ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f"Unknown timezone: {name}")
+    return name
+
+
+async def ensure_reminder_slots(user_ids: list):
+    """Give users without settings the default timezone and meal windows."""
+    slots = [
+        (user_id, meal, DEFAULT_TIMEZONE, slot_minute(user_id, window))
+        for user_id in user_ids
+        for meal, window in DEFAULT_MEAL_WINDOWS.items()
+    ]
+    if slots:
+        await save_reminder_slots(slots, only_missing=True)
+
+
+async def set_reminder_settings(user_id: int, tz_name: str, windows: dict = None):
+    """
+    Store the user's timezone and (optionally) meal windows.
+
+    Args:
+        user_id: Telegram user ID
+        tz_name: IANA timezone name, e.g. "Asia/Yekaterinburg"
+        windows: meal -> {"start": "HH:MM", "end": "HH:MM"}; missing meals keep their current window
+
+    Raises:
+        ValueError: Unknown timezone, meal or malformed time
+    """
+    validate_timezone(tz_name)
+    if windows and set(windows) - set(DEFAULT_MEAL_WINDOWS):
+        raise ValueError(f"Unknown meal: {', '.join(set(windows) - set(DEFAULT_MEAL_WINDOWS))}")
+    slots = [
+        (user_id, meal, tz_name, slot_minute(user_id, (parse_time(window["start"]), parse_time(window["end"]))))
+        for meal, window in (windows or {}).items()
+    ]
+    await ensure_reminder_slots([user_id])
+    await set_reminder_timezone(user_id, tz_name)
+    if slots:
+        await save_reminder_slots(slots)
+
+
+async def init_reminders():
+    """Create default reminder slots for users registered before per-user scheduling."""
+    user_ids = await get_users_without_reminder_slots()
+    await ensure_reminder_slots(user_ids)
+    if user_ids:
+        logging.info(f"⏰ Default reminder slots created for {len(user_ids)} users")
+
+
+def due_local_minutes(minute: datetime, tz) -> dict:
+    """
+    Local reminder buckets due at a UTC minute, together with the previous
+    RETRY_MINUTES (undelivered reminders are retried).
+
+    The window is built from aware datetimes, so it crosses local midnight,
+    and local minutes skipped when clocks jump forward are due at the first
+    minute after the jump. Minutes repeated when clocks go back come up twice,
+    but reminder_deliveries keeps a slot from being sent twice a day.
+
+    Returns:
+        dict: Local date (YYYY-MM-DD) -> sorted minutes of that day
+    """
+    due = defaultdict(set)
+    previous = (minute - timedelta(minutes=RETRY_MINUTES + 1)).astimezone(tz).replace(tzinfo=None)
+    for step in range(RETRY_MINUTES, -1, -1):
+        local = (minute - timedelta(minutes=step)).astimezone(tz).replace(tzinfo=None)
+        # Если часы перевели вперёд, между previous и local есть минуты, которых не было
+        wall = previous + timedelta(minutes=1) if local > previous else local
+        while wall <= local:
+            due[wall.strftime("%Y-%m-%d")].add(wall.hour * 60 + wall.minute)
+            wall += timedelta(minutes=1)
+        previous = max(previous, local)
+    return {local_date: sorted(minutes) for local_date, minutes in due.items()}
+
+
+async def _process_minute(minute: datetime, send_reminders):
+    for tz_name in await get_reminder_timezones():
+        try:
+            tz = ZoneInfo(tz_name)
+        except (ZoneInfoNotFoundError, ValueError):
+            continue
+        for local_date, local_minutes in due_local_minutes(minute, tz).items():
+            by_meal = defaultdict(list)
+            for user_id, meal in await get_due_reminders(tz_name, local_date, local_minutes):
+                by_meal[meal].append(user_id)
+            for meal, user_ids in by_meal.items():
+                async def on_done(done_ids, meal=meal, local_date=local_date):
+                    await mark_reminders_sent(meal, local_date, done_ids)
+                await send_reminders(meal, user_ids, on_done)
+
+
+@timed(REMINDER_RUN)
+async def run_due_reminders(send_reminders):
+    """
+    Send reminders for every per-minute bucket that is due.
+
+    Runs every minute. Progress is persisted, so after a restart missed
+    minutes (up to CATCHUP_MINUTES) are processed, and users that already
+    got a reminder today are skipped. Reminders not marked as done (transient
+    send errors, a crash mid-run) are retried for RETRY_MINUTES.
+
+    Args:
+        send_reminders: Coroutine function send_reminders(meal, user_ids, on_done)
+    """
+    now = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+    last = await get_state(STATE_KEY)
+    start = now - timedelta(minutes=CATCHUP_MINUTES)
+    if last:
+        start = max(start, datetime.fromisoformat(last) + timedelta(minutes=1))
+
+    minute = start
+    while minute <= now:
+        await _process_minute(minute, send_reminders)
+        await set_state(STATE_KEY, minute.isoformat())
+        minute += timedelta(minutes=1)
+
+    if now.minute == 0:
+        await prune_reminder_deliveries(
+            (now - timedelta(days=DELIVERY_RETENTION_DAYS)).strftime("%Y-%m-%d")
+        )
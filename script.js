@@ -2,8 +2,11 @@ const CONFIG_LOCAL = {
     VERSION: "FINAL_1.0"
 };
 
+// Бэкенд доступен через cloudflared-туннель: запросы приходят на сервер с localhost,
+// поэтому лимиты анонимных вызовов считаются по CF-Connecting-IP (QUOTA_TRUST_PROXY=auto)
 const API_URL = "https://warriors-delegation-heard-compliance.trycloudflare.com/api/analyze";
 const SYNC_API_URL = "https://warriors-delegation-heard-compliance.trycloudflare.com/api/sync";
+const SETTINGS_API_URL = "https://warriors-delegation-heard-compliance.trycloudflare.com/api/settings";
 
 /**
  * Get Telegram initData for authentication
@@ -17,6 +20,16 @@ function getTelegramInitData() {
     return '';
 }
 
+/**
+ * Add Telegram initData to request headers (analysis quota is counted per user)
+ * @param {Object} headers - Other request headers
+ * @returns {Object} headers with X-Telegram-Init-Data when available
+ */
+function withInitData(headers = {}) {
+    const initData = getTelegramInitData();
+    return initData ? { ...headers, 'X-Telegram-Init-Data': initData } : headers;
+}
+
 /**
  * Sync food data to server
  * @param {string} date - Date in YYYY-MM-DD format
@@ -56,7 +69,9 @@ async function syncToServer(date, foodData) {
 }
 
 /**
- * Load all food data from server
+ * Load food data from server.
+ * The first load fetches the whole history; later loads send the saved
+ * cursor and receive only the days changed since then.
  * @returns {object} Object with dates as keys and food data as values
  */
 async function loadFromServer() {
@@ -67,16 +82,32 @@ async function loadFromServer() {
             return {};
         }
 
-        const response = await fetch(`${SYNC_API_URL}/load`, {
+        const cursor = localStorage.getItem('dietApp_syncCursor');
+        const etag = localStorage.getItem('dietApp_syncEtag');
+        const headers = { 'X-Telegram-Init-Data': initData };
+        if (cursor && etag) headers['If-None-Match'] = etag;
+
+        const url = cursor
+            ? `${SYNC_API_URL}/load?since=${encodeURIComponent(cursor)}`
+            : `${SYNC_API_URL}/load`;
+        const response = await fetch(url, {
             method: 'GET',
-            headers: {
-                'X-Telegram-Init-Data': initData
-            }
+            headers: headers
         });
 
+        if (response.status === 304) {
+            console.log('[Sync] ✅ Server data unchanged');
+            return {};
+        }
+
         if (response.ok) {
             const result = await response.json();
-            console.log('[Sync] ✅ Data loaded from server');
+            if (result.cursor) {
+                localStorage.setItem('dietApp_syncCursor', result.cursor);
+                const newEtag = response.headers.get('ETag');
+                if (newEtag) localStorage.setItem('dietApp_syncEtag', newEtag);
+            }
+            console.log(`[Sync] ✅ Data loaded from server (${cursor ? 'delta' : 'full'})`);
             return result.allData || {};
         } else {
             const error = await response.json();
@@ -89,6 +120,36 @@ async function loadFromServer() {
     }
 }
 
+/**
+ * Send the device timezone to the server so meal reminders arrive at local time.
+ * Only sent when it differs from the last successfully sent value.
+ */
+async function syncTimezone() {
+    try {
+        const initData = getTelegramInitData();
+        const timezone = Intl.DateTimeFormat().resolvedOptions().timeZone;
+        if (!initData || !timezone || localStorage.getItem('dietApp_syncedTimezone') === timezone) {
+            return;
+        }
+
+        const response = await fetch(`${SETTINGS_API_URL}/reminders`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'X-Telegram-Init-Data': initData
+            },
+            body: JSON.stringify({ timezone: timezone })
+        });
+
+        if (response.ok) {
+            localStorage.setItem('dietApp_syncedTimezone', timezone);
+            console.log(`[Sync] ✅ Timezone saved: ${timezone}`);
+        }
+    } catch (error) {
+        console.error('[Sync] ❌ Network error during timezone sync:', error);
+    }
+}
+
 /**
  * Triggers haptic feedback using Telegram WebApp API or browser fallback.
  * @param {string} style - 'light', 'medium', 'heavy', 'success', 'error', 'warning'
@@ -926,9 +987,10 @@ async function analyzeTextFood(foodName, userCalories) {
     try {
         const response = await fetchWithRetry(API_URL, {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
+            headers: withInitData({ 'Content-Type': 'application/json' }),
             body: JSON.stringify({
                 text: foodName,
+                calories: userCalories || undefined,
                 prompt: prompt
             })
         });
@@ -1348,10 +1410,13 @@ function loadSavedData() {
  */
 async function performServerSync() {
     console.log('[Sync] Starting background sync...');
+    syncTimezone();
+    // An empty delta only means "nothing changed", not "server is empty"
+    const hadCursor = !!localStorage.getItem('dietApp_syncCursor');
     const serverData = await loadFromServer();
     if (Object.keys(serverData).length > 0) {
         mergeSyncData(serverData);
-    } else {
+    } else if (!hadCursor) {
         // If server is empty but we have local data, upload it
         const today = getTodayString();
         if (currentMacros.calories > 0 || currentMacros.foodHistory.length > 0) {
@@ -2000,8 +2065,10 @@ async function fetchWithRetry(url, options, maxRetries = 3, delay = 2000) {
             const response = await fetch(url, options);
             if (response.status === 429) {
                 console.warn(`Quota exceeded (429). Retry attempt ${i + 1} of ${maxRetries}...`);
-                if (i < maxRetries - 1) {
-                    await new Promise(resolve => setTimeout(resolve, delay));
+                // Server tells how long to wait; daily limits are not worth retrying
+                const retryAfter = Number(response.headers.get('Retry-After')) * 1000 || delay;
+                if (i < maxRetries - 1 && retryAfter <= 60000) {
+                    await new Promise(resolve => setTimeout(resolve, retryAfter));
                     continue;
                 }
             }
@@ -2034,7 +2101,7 @@ async function fetchGeminiTips(userData, calories, carbs, protein, fats) {
     try {
         const response = await fetchWithRetry(API_URL, {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
+            headers: withInitData({ 'Content-Type': 'application/json' }),
             body: JSON.stringify({
                 prompt: prompt
             })
@@ -2317,8 +2384,21 @@ async function startAnalysis(imageData, thumbnailDataUrl) {
     let progress = 0;
     const circ = 2 * Math.PI * 52; // New radius r=52
 
+    const statusEl = document.querySelector('#analysis-overlay .analysis-status');
+    if (statusEl) statusEl.innerText = "Распознаем еду и считаем калории";
+
+    // Start the request right away so it runs while the progress ring animates
+    const hash = getImageHash(imageData) + "_" + cameraMode;
+    const analysis = imageAnalysisCache[hash]
+        ? Promise.resolve(imageAnalysisCache[hash])
+        : requestImageAnalysis(imageData, getAnalysisPrompt(cameraMode), showPartialAnalysis);
+    let resultReady = false;
+    analysis.then(() => { resultReady = true; }, () => { resultReady = true; });
+
     const interval = setInterval(() => {
-        progress += Math.floor(Math.random() * 5) + 3;
+        progress += resultReady ? 15 : Math.floor(Math.random() * 5) + 3;
+        // Hold the ring below 100% until the server has answered
+        if (!resultReady && progress > 95) progress = 95;
         if (progress > 100) progress = 100;
 
         // Update new UI elements
@@ -2333,32 +2413,81 @@ async function startAnalysis(imageData, thumbnailDataUrl) {
             setTimeout(() => {
                 document.getElementById('analysis-overlay').classList.add('hidden');
                 closeCamera(); // Now fully close the camera screen
-                finishAnalysis(imageData, thumbnailDataUrl);
+                finishAnalysis(imageData, thumbnailDataUrl, analysis);
             }, 500);
         }
     }, 150);
 }
 
-async function finishAnalysis(imageData, thumbnailDataUrl) {
-    const hash = getImageHash(imageData) + "_" + cameraMode;
-    if (imageAnalysisCache[hash]) {
-        console.log("Using cached analysis result");
-        if (cameraMode === 'cook') {
-            showRecipeModal(imageAnalysisCache[hash]);
-        } else if (cameraMode === 'check') {
-            showCheckResult(imageAnalysisCache[hash]);
-        } else {
-            addFoodToHome(imageAnalysisCache[hash], thumbnailDataUrl);
+// Show fields streamed by the server (product name first) while the analysis is running
+function showPartialAnalysis(fields) {
+    const name = fields.product_name || fields.recipeName;
+    const statusEl = document.querySelector('#analysis-overlay .analysis-status');
+    if (name && statusEl) statusEl.innerText = name;
+}
+
+// POST the photo to the streaming endpoint and resolve with the final result.
+// The server answers with Server-Sent Events: "partial" (fields known so far), then "result" or "error".
+async function requestImageAnalysis(imageData, prompt, onPartial) {
+    // Send the photo as binary multipart instead of base64 JSON (~33% smaller)
+    const imageBlob = await (await fetch(imageData)).blob();
+    const formData = new FormData();
+    formData.append('image', imageBlob, 'photo.jpg');
+    formData.append('prompt', prompt);
+
+    const response = await fetchWithRetry(`${API_URL}/stream`, {
+        method: 'POST',
+        headers: withInitData(),
+        body: formData
+    });
+
+    const contentType = response.headers.get('Content-Type') || '';
+    if (!contentType.startsWith('text/event-stream')) {
+        const result = await response.json();
+        throw new Error(result.error || `HTTP ${response.status}`);
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        let end;
+        while ((end = buffer.indexOf('\n\n')) !== -1) {
+            const block = buffer.slice(0, end);
+            buffer = buffer.slice(end + 2);
+
+            let event = 'message';
+            let data = '';
+            block.split('\n').forEach(line => {
+                if (line.startsWith('event:')) event = line.slice(6).trim();
+                else if (line.startsWith('data:')) data += line.slice(5).trim();
+            });
+            if (!data) continue;
+
+            const payload = JSON.parse(data);
+            if (event === 'partial') {
+                if (onPartial) onPartial(payload);
+            } else if (event === 'result') {
+                return payload;
+            } else if (event === 'error') {
+                throw new Error(payload.error);
+            }
         }
-        return;
     }
+    throw new Error("Analysis stream ended without a result");
+}
 
+function getAnalysisPrompt(mode) {
     let prompt;
-    if (cameraMode === 'cook') {
+    if (mode === 'cook') {
         prompt = `Analyze the image for available ingredients. Suggest ONE simple, appetizing recipe in RUSSIAN language (name and instructions).
         If the image is blurry, make your best guess based on colors and shapes.
         Return ONLY a JSON object: { "recipeName": "Название блюда", "calories": 500, "protein": 20, "fat": 15, "carbs": 60, "instructions": "Шаг 1: ...\\nШаг 2: ..." }`;
-    } else if (cameraMode === 'check') {
+    } else if (mode === 'check') {
         prompt = `Ты — эксперт по питанию. Проанализируй фото состава продукта.
         Будь лоялен и реалистичен. Не штрафуй сильно за обычные ингредиенты, такие как подсолнечное масло, мука или сахар в умеренных количествах.
         Уменьши штрафы за "Е-добавки" в 2-3 раза, так как многие из них безопасны.
@@ -2385,19 +2514,25 @@ async function finishAnalysis(imageData, thumbnailDataUrl) {
         3. Общее описание (короткий текст до 150 символов), в поле "description".
         Always return JSON: {"product_name": "Название", "calories": 100, "protein": 10, "carbs": 10, "fats": 10, "description": "Описание"}`;
     }
+    return prompt;
+}
 
-    try {
-        const response = await fetchWithRetry(API_URL, {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({
-                image: imageData.split(',')[1],
-                mime_type: "image/jpeg",
-                prompt: prompt
-            })
-        });
+async function finishAnalysis(imageData, thumbnailDataUrl, analysis) {
+    const hash = getImageHash(imageData) + "_" + cameraMode;
+    if (imageAnalysisCache[hash]) {
+        console.log("Using cached analysis result");
+        if (cameraMode === 'cook') {
+            showRecipeModal(imageAnalysisCache[hash]);
+        } else if (cameraMode === 'check') {
+            showCheckResult(imageAnalysisCache[hash]);
+        } else {
+            addFoodToHome(imageAnalysisCache[hash], thumbnailDataUrl);
+        }
+        return;
+    }
 
-        const result = await response.json();
+    try {
+        const result = await analysis;
 
         if (result.error) {
             console.error("Proxy API error:", result.error);
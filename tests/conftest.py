@@ -0,0 +1,25 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+# Модули бота лежат в корне репозитория
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db_manager
+import food_cache_manager
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    monkeypatch.setattr(db_manager, "DB_PATH", str(tmp_path / "diet.db"))
+    monkeypatch.setattr(db_manager, "FLUSH_INTERVAL", 60)
+    # Каждый тест идёт в своём event loop, а примитивы asyncio привязываются к первому
+    monkeypatch.setattr(db_manager, "_write_lock", asyncio.Lock())
+    monkeypatch.setattr(db_manager, "_flush_wakeup", asyncio.Event())
+    monkeypatch.setattr(db_manager, "_pending_food", {})
+    monkeypatch.setattr(db_manager, "_flushing", {})
+    monkeypatch.setattr(db_manager, "_last_version", "")
+    monkeypatch.setattr(food_cache_manager, "_users", food_cache_manager.OrderedDict())
+    monkeypatch.setattr(food_cache_manager, "_bytes", 0)
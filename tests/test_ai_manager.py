@@ -0,0 +1,54 @@
+import pytest
+
+import ai_manager
+from ai_manager import JsonExtractor, parse_result
+
+
+@pytest.mark.parametrize("reply, expected", [
+    ('{"calories": 100}', {"calories": 100}),
+    ('Вот ответ:\n```json\n{"calories": 100}\n```', {"calories": 100}),
+    ('[note] ```json\n{"calories": 100}\n```', {"calories": 100}),
+    ('[1] пример\n```json\n[{"calories": 1}, {"calories": 2}]\n```', [{"calories": 1}, {"calories": 2}]),
+    ('{"calories": 100} и ещё [сноска]', {"calories": 100}),
+    ('```\n{"text": "в строке ``` и ]"}\n```', {"text": "в строке ``` и ]"}),
+])
+def test_parse_result(reply, expected):
+    assert parse_result(reply) == expected
+
+
+def test_parse_result_falls_back_to_raw_text():
+    assert parse_result("Не могу распознать [еду] на фото") == {"raw_text": "Не могу распознать [еду] на фото"}
+
+
+def test_fields_are_reported_while_streaming():
+    extractor = JsonExtractor()
+    chunks = ['```json\n{"product_', 'name": "Плов", "calo', 'ries": 610}\n```']
+    reported = [extractor.feed(chunk) for chunk in chunks]
+    assert reported == [{}, {"product_name": "Плов"}, {}]
+    assert extractor.result() == {"product_name": "Плов", "calories": 610}
+
+
+@pytest.fixture
+def models(monkeypatch):
+    health = {name: ai_manager.ModelHealth(name) for name in ("primary", "fast", "new", "broken")}
+    monkeypatch.setattr(ai_manager, "_health", health)
+    return health
+
+
+def test_route_prefers_expected_fastest_success(models):
+    for _ in range(ai_manager.MIN_LATENCY_SAMPLES):
+        models["primary"].record_success(3.0)
+        models["fast"].record_success(1.0)
+    # Без замеров - типичная задержка, а не нулевая
+    for _ in range(ai_manager.BREAKER_FAILURES - 1):
+        models["broken"].record_failure(throttled=False)
+    assert [h.name for h in ai_manager._route()] == ["fast", "new", "primary", "broken"]
+
+
+def test_route_fails_fast_when_every_breaker_is_open(models):
+    for health in models.values():
+        health.record_failure(throttled=True)
+    with pytest.raises(ai_manager.ModelsUnavailableError) as error:
+        ai_manager._route()
+    assert 1 <= error.value.retry_after <= ai_manager.BREAKER_COOLDOWN
+    assert isinstance(error.value, ai_manager.InferenceBusyError)
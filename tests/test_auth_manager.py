@@ -0,0 +1,81 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import time
+from urllib.parse import urlencode
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+import auth_manager
+
+BOT_TOKEN = "123456:TEST"
+
+
+def init_data(user_id: int, auth_date: int = None, token: str = BOT_TOKEN) -> str:
+    fields = {"auth_date": str(auth_date or int(time.time())), "user": json.dumps({"id": user_id})}
+    data_check_string = "\n".join(f"{key}={value}" for key, value in sorted(fields.items()))
+    secret = hmac.new(b"WebAppData", token.encode(), hashlib.sha256).digest()
+    fields["hash"] = hmac.new(secret, data_check_string.encode(), hashlib.sha256).hexdigest()
+    return urlencode(fields)
+
+
+@pytest.fixture(autouse=True)
+def configured():
+    auth_manager.configure_auth(BOT_TOKEN)
+
+
+def test_valid_init_data_returns_user_id():
+    assert auth_manager.validate_init_data(init_data(42)) == 42
+    # Повторная проверка отвечается из кэша
+    assert auth_manager.validate_init_data(init_data(42)) == 42
+
+
+@pytest.mark.parametrize("value", [
+    init_data(42, token="654321:OTHER"),
+    init_data(42, auth_date=int(time.time()) - auth_manager.INIT_DATA_MAX_AGE - 60),
+    init_data(42).replace("42", "43"),
+    "user=%7B%22id%22%3A42%7D",
+])
+def test_invalid_init_data_is_rejected(value):
+    with pytest.raises(ValueError):
+        auth_manager.validate_init_data(value)
+
+
+def test_cached_init_data_still_expires_by_auth_date(monkeypatch):
+    issued = int(time.time()) - auth_manager.INIT_DATA_MAX_AGE + 5
+    value = init_data(42, auth_date=issued)
+    assert auth_manager.validate_init_data(value) == 42
+    # Кэш не продлевает initData дольше INIT_DATA_MAX_AGE
+    monkeypatch.setattr(auth_manager.time, "time", lambda: issued + auth_manager.INIT_DATA_MAX_AGE + 1)
+    with pytest.raises(ValueError):
+        auth_manager.validate_init_data(value)
+
+
+def test_verified_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(auth_manager, "INIT_DATA_CACHE_SIZE", 3)
+    for user_id in range(1, 11):
+        auth_manager.validate_init_data(init_data(user_id))
+    assert len(auth_manager._verified) == 3
+
+
+async def echo_user(request):
+    return web.json_response({"user_id": request["user_id"]})
+
+
+def call_middleware(path: str, value: str = None):
+    headers = {"X-Telegram-Init-Data": value} if value else {}
+    return asyncio.run(auth_manager.auth_middleware(make_mocked_request("POST", path, headers=headers), echo_user))
+
+
+def test_protected_endpoints_require_valid_init_data():
+    assert call_middleware("/api/sync/save").status == 401
+    assert call_middleware("/api/sync/save", init_data(42, token="654321:OTHER")).status == 401
+    assert json.loads(call_middleware("/api/sync/save", init_data(42)).body) == {"user_id": 42}
+
+
+def test_init_data_is_optional_for_analysis():
+    assert json.loads(call_middleware("/api/analyze").body) == {"user_id": None}
+    assert json.loads(call_middleware("/api/analyze", "hash=bad").body) == {"user_id": None}
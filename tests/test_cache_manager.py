@@ -0,0 +1,62 @@
+import asyncio
+
+import pytest
+
+import cache_manager
+
+
+@pytest.fixture(autouse=True)
+def no_storage(monkeypatch):
+    async def lookup(key, scope, phash, now):
+        return None
+
+    async def store(key, scope, phash, result):
+        pass
+
+    monkeypatch.setattr(cache_manager, "_lookup", lookup)
+    monkeypatch.setattr(cache_manager, "_store", store)
+    monkeypatch.setattr(cache_manager, "_inflight", {})
+
+
+def test_concurrent_calls_share_one_upstream_call():
+    calls = []
+
+    async def analyze():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"calories": 100}
+
+    async def scenario():
+        return await asyncio.gather(*[
+            cache_manager.get_or_analyze(b"photo", "prompt", "model", analyze) for _ in range(5)
+        ])
+
+    assert asyncio.run(scenario()) == [{"calories": 100}] * 5
+    assert len(calls) == 1
+
+
+def test_waiting_call_takes_over_when_leader_is_cancelled():
+    calls = []
+
+    async def analyze():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return {"calories": 100}
+
+    async def scenario():
+        leader = asyncio.create_task(cache_manager.get_or_analyze(b"photo", "prompt", "model", analyze))
+        await asyncio.sleep(0.01)
+        followers = [
+            asyncio.create_task(cache_manager.get_or_analyze(b"photo", "prompt", "model", analyze)) for _ in range(3)
+        ]
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        results = await asyncio.gather(*followers)
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return results
+
+    assert asyncio.run(scenario()) == [{"calories": 100}] * 3
+    # Отменённый ведущий и один перехвативший работу ожидающий
+    assert len(calls) == 2
+    assert cache_manager._inflight == {}
@@ -0,0 +1,192 @@
+import asyncio
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+import db_manager
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def save_durably(user_id, date, food_json):
+    # FLUSH_INTERVAL в тестах большой: сбрасываем буфер сами
+    save = asyncio.ensure_future(db_manager.queue_food_data(user_id, date, food_json, durable=True))
+    await asyncio.sleep(0)
+    await db_manager.flush_food_data()
+    return await save
+
+
+def test_close_database_stops_flush_loop_and_drains_buffer(database):
+    async def scenario():
+        await db_manager.init_database()
+        flush_task = db_manager._flush_task
+        assert flush_task is not None
+        await db_manager.queue_food_data(1, "2026-01-01", json.dumps({"a": 1}))
+        await db_manager.close_database()
+        assert flush_task.done()
+        assert db_manager._flush_task is None
+
+        await db_manager.init_database()
+        try:
+            return await db_manager.get_food_json(1, "2026-01-01")
+        finally:
+            await db_manager.close_database()
+
+    assert json.loads(run(scenario())) == {"a": 1}
+
+
+def test_older_buffered_save_does_not_overwrite_newer_row(database):
+    async def scenario():
+        await db_manager.init_database()
+        try:
+            # Two workers buffered the same day; the newer save is flushed first
+            db_manager._pending_food[(1, "2026-01-01")] = ('{"v":"new"}', "2026-01-01T10:00:02")
+            await db_manager.flush_food_data()
+            db_manager._pending_food[(1, "2026-01-01")] = ('{"v":"old"}', "2026-01-01T10:00:01")
+            await db_manager.flush_food_data()
+            return await db_manager.get_food_json(1, "2026-01-01"), await db_manager.get_food_log_version(1)
+        finally:
+            await db_manager.close_database()
+
+    food_json, version = run(scenario())
+    assert json.loads(food_json) == {"v": "new"}
+    assert version == ("2026-01-01T10:00:02", 1)
+
+
+def test_save_after_clock_steps_back_still_wins(database, monkeypatch):
+    class EarlierClock(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return datetime.now(tz) - timedelta(hours=1)
+
+    async def scenario():
+        await db_manager.init_database()
+        try:
+            await save_durably(1, "2026-01-01", '{"v":1}')
+            monkeypatch.setattr(db_manager, "datetime", EarlierClock)
+            await save_durably(1, "2026-01-01", '{"v":2}')
+            return await db_manager.get_food_json_since(1, "")
+        finally:
+            await db_manager.close_database()
+
+    (row,), cursor = run(scenario())
+    assert row[:2] == ("2026-01-01", '{"v":2}')
+    assert cursor == row[2]
+
+
+def test_durable_save_older_than_stored_row_is_rejected(database):
+    async def scenario():
+        await db_manager.init_database()
+        try:
+            # Другой воркер уже записал более новую версию дня
+            db_manager._pending_food[(1, "2026-01-01")] = ('{"v":"other"}', "2999-01-01T00:00:00.000000")
+            await db_manager.flush_food_data()
+            with pytest.raises(db_manager.StaleWriteError):
+                await save_durably(1, "2026-01-01", '{"v":"stale"}')
+            stored = await db_manager.get_food_json(1, "2026-01-01")
+            # The rejected save taught this process the newer version
+            await save_durably(1, "2026-01-01", '{"v":"next"}')
+            return stored, await db_manager.get_food_json(1, "2026-01-01")
+        finally:
+            await db_manager.close_database()
+
+    assert run(scenario()) == ('{"v":"other"}', '{"v":"next"}')
+
+
+def test_reads_see_rows_while_their_flush_is_committing(database, monkeypatch):
+    refresh_rollups = db_manager._refresh_rollups
+
+    async def scenario():
+        await db_manager.init_database()
+        try:
+            await db_manager.queue_food_data(1, "2026-01-01", '{"v":1}')
+            in_transaction, release = asyncio.Event(), asyncio.Event()
+
+            async def slow_refresh(db, days):
+                in_transaction.set()
+                await release.wait()
+                await refresh_rollups(db, days)
+
+            monkeypatch.setattr(db_manager, "_refresh_rollups", slow_refresh)
+            flush = asyncio.create_task(db_manager.flush_food_data())
+            await in_transaction.wait()
+            during = (
+                await db_manager.get_all_food_json(1),
+                await db_manager.get_food_json_since(1, ""),
+                await db_manager.get_food_json(1, "2026-01-01"),
+            )
+            release.set()
+            await flush
+            return during, await db_manager.get_all_food_json(1), db_manager._flushing
+        finally:
+            await db_manager.close_database()
+
+    during, after, flushing = run(scenario())
+    assert [row[:2] for row in during[0]] == [("2026-01-01", '{"v":1}')]
+    assert [row[:2] for row in during[1][0]] == [("2026-01-01", '{"v":1}')]
+    assert during[2] == '{"v":1}'
+    assert after == during[0]
+    assert flushing == {}
+
+
+def test_similar_photo_found_in_persistent_cache_by_hamming_distance(database):
+    phash = -0x0123456789ABCDEF
+    near = phash ^ 0b1011  # 3 bits differ
+    far = phash ^ 0x0101010101010101  # 8 bits differ, one in every band
+
+    async def scenario():
+        await db_manager.init_database()
+        try:
+            await db_manager.save_cached_analysis("key", "scope", phash, {"calories": 100}, 1000.0)
+            return (
+                await db_manager.find_cached_analysis_by_phash("scope", near, 0, 4),
+                await db_manager.find_cached_analysis_by_phash("scope", near, 0, 2),
+                await db_manager.find_cached_analysis_by_phash("scope", far, 0, 7),
+                await db_manager.find_cached_analysis_by_phash("other", phash, 0, 4),
+                await db_manager.find_cached_analysis_by_phash("scope", phash, 2000.0, 4),
+            )
+        finally:
+            await db_manager.close_database()
+
+    assert run(scenario()) == ({"calories": 100}, None, None, None, None)
+
+
+def test_phash_bands_are_backfilled_and_pruned(database):
+    phash = 0x7EDCBA9876543210
+
+    async def scenario():
+        await db_manager.init_database()
+        await db_manager.save_cached_analysis("key", "scope", phash, {"calories": 100}, 1000.0)
+        # База из версии без таблицы полос
+        async with db_manager._write() as db:
+            await db.execute("DELETE FROM analysis_phash_bands")
+        await db_manager.close_database()
+
+        await db_manager.init_database()
+        try:
+            found = await db_manager.find_cached_analysis_by_phash("scope", phash ^ 1, 0, 4)
+            await db_manager.prune_analysis_cache(2000.0, 10)
+            async with db_manager._read() as db:
+                async with db.execute("SELECT COUNT(*) FROM analysis_phash_bands") as cursor:
+                    bands_left = (await cursor.fetchone())[0]
+            return found, bands_left
+        finally:
+            await db_manager.close_database()
+
+    assert run(scenario()) == ({"calories": 100}, 0)
+
+
+def test_queued_broadcasts_are_taken_once_in_order(database):
+    async def scenario():
+        await db_manager.init_database()
+        try:
+            await db_manager.queue_broadcast(1, "first")
+            await db_manager.queue_broadcast(2, "second")
+            return await db_manager.take_broadcast_jobs(), await db_manager.take_broadcast_jobs()
+        finally:
+            await db_manager.close_database()
+
+    assert run(scenario()) == ([(1, "first"), (2, "second")], [])
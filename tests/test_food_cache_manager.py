@@ -0,0 +1,71 @@
+import random
+from datetime import date, timedelta
+
+import pytest
+
+import food_cache_manager as fc
+
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+    monkeypatch.setattr(fc, "CACHE_MAX_BYTES", 10_000)
+    monkeypatch.setattr(fc, "_users", fc.OrderedDict())
+    monkeypatch.setattr(fc, "_bytes", 0)
+    monkeypatch.setattr(fc, "_ttl", None)
+
+
+def assert_accounted():
+    assert fc._bytes == sum(entry.size for entry in fc._users.values())
+    assert fc._bytes <= fc.CACHE_MAX_BYTES
+
+
+def test_size_stays_bounded_after_churn():
+    rng = random.Random(0)
+    today = date.today()
+    for step in range(20_000):
+        user_id = rng.randrange(500)
+        day = (today - timedelta(days=rng.randrange(fc.CACHE_RECENT_DAYS + 3))).isoformat()
+        action = rng.random()
+        if action < 0.5:
+            fc.put_day(user_id, day, "x" * rng.randrange(300), str(step), written=rng.random() < 0.5)
+        elif action < 0.7:
+            fc.get_day(user_id, day)
+        elif action < 0.9:
+            token = fc.history_token(user_id)
+            fc.put_history(user_id, token, (str(step), 1), rng.choice(["br", "gzip"]), ("br", b"x" * rng.randrange(800)))
+        else:
+            fc.invalidate_user(user_id)
+    assert_accounted()
+    assert len(fc._users) < 500
+
+
+def test_write_replaces_day_and_drops_history():
+    today = date.today().isoformat()
+    fc.put_day(1, today, '{"a":1}', "2")
+    token = fc.history_token(1)
+    fc.put_history(1, token, ("2", 1), "br", ("br", b"body"))
+    assert fc.get_history(1, ("2", 1), "br") == ("br", b"body")
+
+    fc.put_day(1, today, '{"a":2}', "3", written=True)
+    assert fc.get_day(1, today) == (True, '{"a":2}')
+    assert fc.history_version(1) is None
+    assert_accounted()
+
+
+def test_stale_read_does_not_replace_newer_version():
+    today = date.today().isoformat()
+    fc.put_day(1, today, '{"new":1}', "2026-01-02", written=True)
+    fc.put_day(1, today, '{"old":1}', "2026-01-01")
+    assert fc.get_day(1, today) == (True, '{"new":1}')
+
+
+def test_history_built_during_a_write_is_not_cached():
+    token = fc.history_token(1)
+    fc.put_day(1, date.today().isoformat(), "{}", "1", written=True)
+    fc.put_history(1, token, ("1", 1), "gzip", ("gzip", b"stale"))
+    assert fc.get_history(1, ("1", 1), "gzip") is None
+
+
+def test_old_days_are_not_cached():
+    fc.put_day(1, "2000-01-01", "{}", "1")
+    assert fc.get_day(1, "2000-01-01") == (False, None)
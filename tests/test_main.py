@@ -0,0 +1,210 @@
+import asyncio
+import base64
+import json
+import os
+
+import pytest
+
+from aiohttp.test_utils import make_mocked_request
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+
+import db_manager
+import food_cache_manager
+import main
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def load(query: str = "", etag: str = None):
+    headers = {"If-None-Match": etag} if etag else {}
+    request = make_mocked_request("GET", "/api/sync/load" + query, headers=headers)
+    request["user_id"] = 1
+    response = await main.handle_sync_load(request)
+    body = json.loads(response.body) if response.status == 200 else None
+    return response.status, response.headers["ETag"], body
+
+
+class JsonRequest:
+    content_type = "application/json"
+
+    def __init__(self, body):
+        self.body = body
+
+    async def json(self):
+        return self.body
+
+
+@pytest.mark.parametrize("body", [
+    {"items": ["x"]},
+    {"items": "x"},
+    ["x"],
+    {"items": [{"image": 1}]},
+    {"items": [{"image": "not base64!"}]},
+])
+def test_malformed_batch_json_is_a_bad_request(body):
+    with pytest.raises(ValueError):
+        run(main.read_batch_request(JsonRequest(body)))
+
+
+def test_batch_json_images_are_sniffed_like_uploads():
+    png = b"\x89PNG\r\n\x1a\n" + b"\0" * 16
+    items, _, _ = run(main.read_batch_request(JsonRequest(
+        {"items": [{"image": base64.b64encode(png).decode(), "mime_type": "image/jpeg"}, {"text": "apple"}]}
+    )))
+    assert [item["mime_type"] for item in items] == ["image/png", None]
+    with pytest.raises(main.UnsupportedImageError):
+        run(main.read_batch_request(JsonRequest({"items": [{"image": base64.b64encode(b"plain text").decode()}]})))
+
+
+def test_delta_load_returns_only_days_saved_after_cursor(database):
+    async def scenario():
+        await db_manager.init_database()
+        try:
+            await db_manager.queue_food_data(1, "2026-01-01", '{"v":1}')
+            _, _, first = await load()
+            await db_manager.queue_food_data(1, "2026-01-02", '{"v":2}')
+            await db_manager.flush_food_data()
+            _, _, delta = await load(f"?since={first['cursor']}")
+            _, _, empty = await load(f"?since={delta['cursor']}")
+            _, _, full = await load()
+            return first, delta, empty, full
+        finally:
+            await db_manager.close_database()
+
+    first, delta, empty, full = run(scenario())
+    assert first["allData"] == {"2026-01-01": {"v": 1}}
+    assert delta["allData"] == {"2026-01-02": {"v": 2}}
+    assert delta["cursor"] > first["cursor"]
+    assert empty == {"allData": {}, "cursor": delta["cursor"]}
+    assert full["cursor"] == delta["cursor"]
+    assert list(full["allData"]) == ["2026-01-02", "2026-01-01"]
+
+
+def test_unchanged_history_gets_304(database):
+    async def scenario():
+        await db_manager.init_database()
+        try:
+            await db_manager.queue_food_data(1, "2026-01-01", '{"v":1}')
+            first = await load()
+            # Buffered row flushed in between: same history, same ETag
+            await db_manager.flush_food_data()
+            again = await load(etag=first[1])
+            delta = await load(f"?since={first[2]['cursor']}")
+            delta_again = await load(f"?since={first[2]['cursor']}", etag=delta[1])
+            await db_manager.queue_food_data(1, "2026-01-01", '{"v":2}')
+            changed = await load(etag=first[1])
+            return first, again, delta_again, changed
+        finally:
+            await db_manager.close_database()
+
+    first, again, delta_again, changed = run(scenario())
+    assert first[0] == 200
+    assert again[:2] == (304, first[1])
+    assert delta_again[0] == 304
+    assert changed[0] == 200
+    assert changed[1] != first[1]
+    assert changed[2]["allData"] == {"2026-01-01": {"v": 2}}
+
+
+def test_history_body_is_cached_under_version_of_rows_it_holds(database, monkeypatch):
+    async def scenario():
+        await db_manager.init_database()
+        try:
+            await db_manager.queue_food_data(1, "2026-01-01", '{"v":1}')
+            # A day is saved between the version check and the read
+            version_before_save = await db_manager.get_food_log_version(1)
+            await db_manager.queue_food_data(1, "2026-01-02", '{"v":2}')
+
+            async def stale_version(user_id):
+                return version_before_save
+
+            monkeypatch.setattr(main, "get_food_log_version", stale_version)
+            _, _, body = await load()
+            return version_before_save, body, food_cache_manager.history_version(1), await db_manager.get_food_log_version(1)
+        finally:
+            await db_manager.close_database()
+
+    version_before_save, body, cached_version, current_version = run(scenario())
+    assert len(body["allData"]) == 2
+    assert cached_version == current_version == (body["cursor"], 2)
+    assert cached_version != version_before_save
+
+
+def test_compacted_history_loads_with_same_order_and_cursor(database):
+    day = json.dumps({"meals": [{"name": "овсянка", "calories": 300, "protein": 10}] * 20}, ensure_ascii=False)
+
+    async def scenario():
+        await db_manager.init_database()
+        try:
+            for date in ("2020-01-02", "2020-01-01", "2020-01-03"):
+                await db_manager.queue_food_data(1, date, day)
+            await db_manager.flush_food_data()
+            _, etag, before = await load()
+            compacted, _, _ = await db_manager.compact_food_logs(min_age_days=30)
+            food_cache_manager._users.clear()
+            status, _, _ = await load(etag=etag)
+            _, _, after = await load()
+            _, _, delta = await load(f"?since={before['cursor']}")
+            return compacted, before, status, after, delta, await db_manager.get_food_json(1, "2020-01-01")
+        finally:
+            await db_manager.close_database()
+
+    compacted, before, status, after, delta, old_day = run(scenario())
+    assert compacted == 3
+    assert status == 304
+    assert after == before
+    assert list(after["allData"]) == ["2020-01-03", "2020-01-02", "2020-01-01"]
+    assert delta["allData"] == {}
+    assert old_day == day
+
+
+@pytest.mark.parametrize("dates, streak", [
+    ([], 0),
+    (["2026-03-10", "2026-03-09", "2026-03-08"], 3),
+    # Сегодня ещё не записано - серия считается со вчера
+    (["2026-03-09", "2026-03-08"], 2),
+    (["2026-03-08", "2026-03-07"], 0),
+    (["2026-03-10", "2026-03-08"], 1),
+])
+def test_count_streak(dates, streak):
+    assert main.count_streak(dates, main.date_type(2026, 3, 10)) == streak
+
+
+async def stats(query: str):
+    request = make_mocked_request("GET", "/api/stats" + query)
+    request["user_id"] = 1
+    response = await main.handle_stats(request)
+    return response.status, json.loads(response.body)
+
+
+def test_stats_ranges(database):
+    async def scenario():
+        await db_manager.init_database()
+        try:
+            for date, calories in (("2026-02-28", 100), ("2026-03-01", 200), ("2026-03-02", 300), ("2026-03-04", 400)):
+                await db_manager.queue_food_data(1, date, json.dumps({"calories": calories}))
+            return [
+                await stats("?from=2026-03-01&to=2026-03-04"),
+                await stats("?period=week&from=2026-03-04&to=2026-03-04"),
+                await stats("?to=2026-03-04"),
+                await stats("?from=2026-03-05&to=2026-03-04"),
+                await stats("?from=2020-01-01&to=2026-03-04"),
+                await stats("?period=year"),
+            ]
+        finally:
+            await db_manager.close_database()
+
+    day, week, default, reversed_range, too_long, unknown = run(scenario())
+    assert day[0] == 200
+    # Обе границы включены
+    assert [item["start"] for item in day[1]["items"]] == ["2026-03-01", "2026-03-02", "2026-03-04"]
+    assert day[1]["summary"]["days"] == 3
+    assert day[1]["streak"] == 1
+    # Неделя, в которую попадает from, целиком (2026-03-02 - понедельник)
+    assert [(item["start"], item["days"], item["calories"]) for item in week[1]["items"]] == [("2026-03-02", 2, 700)]
+    assert default[1]["from"] == "2026-02-03"
+    assert default[1]["summary"]["days"] == 4
+    assert reversed_range[0] == too_long[0] == unknown[0] == 400
@@ -0,0 +1,38 @@
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import metrics_manager
+
+
+def fetch_metrics(headers=None):
+    async def scenario():
+        app = web.Application()
+        app.router.add_get("/metrics", metrics_manager.handle_metrics)
+        async with TestClient(TestServer(app)) as client:
+            response = await client.get("/metrics", headers=headers or {})
+            return response.status, await response.text()
+
+    return asyncio.run(scenario())
+
+
+def test_metrics_require_token_when_set(monkeypatch):
+    monkeypatch.setattr(metrics_manager, "METRICS_TOKEN", "secret")
+    assert fetch_metrics()[0] == 401
+    assert fetch_metrics({"Authorization": "Bearer wrong"})[0] == 401
+    assert fetch_metrics({"Authorization": "Bearer secret"})[0] == 200
+
+
+def test_histogram_renders_cumulative_buckets(monkeypatch):
+    monkeypatch.setattr(metrics_manager, "_metrics", [])
+    monkeypatch.setattr(metrics_manager, "_common_labels", {"worker": "1"})
+    histogram = metrics_manager.Histogram("test_seconds", "Test", ("route",), buckets=(0.1, 1))
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value, "/a")
+
+    lines = metrics_manager.render_metrics().splitlines()
+    assert 'test_seconds_bucket{worker="1",route="/a",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{worker="1",route="/a",le="1"} 2' in lines
+    assert 'test_seconds_bucket{worker="1",route="/a",le="+Inf"} 3' in lines
+    assert 'test_seconds_count{worker="1",route="/a"} 3' in lines
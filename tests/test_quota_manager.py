@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+import quota_manager
+
+
+@pytest.fixture(autouse=True)
+def fresh_counters(monkeypatch):
+    monkeypatch.setattr(quota_manager, "_counters", {})
+    monkeypatch.setattr(quota_manager, "_dirty", set())
+    monkeypatch.setattr(quota_manager, "_day", None)
+    monkeypatch.setattr(quota_manager, "_worker_share", 1.0)
+
+
+def spend_until_rejected(key: str, attempts: int = 100) -> int:
+    for spent in range(attempts):
+        try:
+            quota_manager.consume(key)
+        except quota_manager.QuotaExceededError:
+            return spent
+    return attempts
+
+
+def test_client_burst_then_retry_after():
+    assert spend_until_rejected("user:1") == int(quota_manager.USER_BURST)
+    with pytest.raises(quota_manager.QuotaExceededError) as error:
+        quota_manager.consume("user:1")
+    assert int(error.value.headers["Retry-After"]) > 0
+
+
+def test_client_limits_are_split_between_workers(monkeypatch):
+    monkeypatch.setattr(quota_manager, "USER_BURST", 8.0)
+    monkeypatch.setattr(quota_manager, "_worker_share", 1 / 4)
+    # Четыре воркера вместе дают клиенту не больше настроенного запаса
+    assert spend_until_rejected("user:1") == 2
+
+
+def test_split_limits_never_lock_a_client_out(monkeypatch):
+    monkeypatch.setattr(quota_manager, "_worker_share", 1 / 8)
+    rate, burst, daily = quota_manager._limits("ip:127.0.0.1")
+    assert burst >= 1 and daily >= 1
+    assert spend_until_rejected("ip:127.0.0.1") >= 1
+
+
+def test_unlimited_global_daily_stays_unlimited(monkeypatch):
+    monkeypatch.setattr(quota_manager, "GLOBAL_DAILY", 0)
+    monkeypatch.setattr(quota_manager, "_worker_share", 1 / 4)
+    assert quota_manager._limits(quota_manager.GLOBAL_KEY)[2] == 0
+
+
+def anonymous_request(peer: str, headers: dict):
+    request = make_mocked_request("POST", "/api/analyze", headers=headers)
+    request._transport_peername = (peer, 12345)
+    return request
+
+
+def test_proxy_headers_trusted_only_from_local_tunnel():
+    headers = {"CF-Connecting-IP": "203.0.113.7"}
+    assert quota_manager.client_key(anonymous_request("127.0.0.1", headers)) == "ip:203.0.113.7"
+    assert quota_manager.client_key(anonymous_request("198.51.100.1", headers)) == "ip:198.51.100.1"
+
+
+def test_unlimited_daily_quota_reports_the_bucket(monkeypatch):
+    monkeypatch.setattr(quota_manager, "USER_DAILY", 0)
+    headers = quota_manager.consume("user:1")
+    assert headers["X-RateLimit-Limit"] == str(int(quota_manager.USER_BURST))
+    assert headers["X-RateLimit-Remaining"] == str(int(quota_manager.USER_BURST) - 1)
+    assert int(headers["X-RateLimit-Reset"]) > 0
+
+
+def test_rejected_upload_gets_its_unit_back():
+    async def unsupported(request):
+        return web.json_response({"error": "Unsupported image"}, status=415)
+
+    async def analyzed(request):
+        return web.json_response({})
+
+    async def scenario():
+        request = anonymous_request("198.51.100.1", {})
+        rejected = await quota_manager.quota_middleware(request, unsupported)
+        request = anonymous_request("198.51.100.1", {})
+        accepted = await quota_manager.quota_middleware(request, analyzed)
+        return rejected, accepted
+
+    rejected, accepted = asyncio.run(scenario())
+    assert rejected.headers["X-RateLimit-Remaining"] == str(quota_manager.IP_DAILY)
+    assert accepted.headers["X-RateLimit-Remaining"] == str(quota_manager.IP_DAILY - 1)
+    assert quota_manager._counters["ip:198.51.100.1"][0] == 1
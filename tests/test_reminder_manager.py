@@ -0,0 +1,108 @@
+import asyncio
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+
+import pytest
+
+import broadcast_manager
+import db_manager
+import reminder_manager
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    monkeypatch.setattr(db_manager, "DB_PATH", str(tmp_path / "diet.db"))
+    monkeypatch.setattr(db_manager, "_write_lock", asyncio.Lock())
+    monkeypatch.setattr(db_manager, "_flush_wakeup", asyncio.Event())
+    monkeypatch.setattr(broadcast_manager, "bucket", broadcast_manager.TokenBucket(1000, 1000))
+
+
+def test_reminder_with_transient_error_is_retried_next_minute(database):
+    sent = []
+    failing = {2}
+
+    async def send_reminders(meal, user_ids, on_done):
+        async def send(user_id):
+            if user_id in failing:
+                failing.discard(user_id)
+                raise RuntimeError("network is down")
+            sent.append((meal, user_id))
+        await broadcast_manager.broadcast(user_ids, send, on_done=on_done, kind="reminder")
+
+    async def scenario():
+        await db_manager.init_database()
+        try:
+            for user_id in (1, 2):
+                await db_manager.add_user(user_id)
+            await db_manager.save_reminder_slots([(1, "lunch", "UTC", 14 * 60), (2, "lunch", "UTC", 14 * 60)])
+            for minute in (0, 1, 2):
+                await reminder_manager._process_minute(datetime(2026, 5, 1, 14, minute, tzinfo=timezone.utc), send_reminders)
+        finally:
+            await db_manager.close_database()
+
+    asyncio.run(scenario())
+    assert sent == [("lunch", 1), ("lunch", 2)]
+
+
+def test_retry_window_crosses_midnight_and_clock_changes():
+    def due(utc, tz_name):
+        return reminder_manager.due_local_minutes(utc, ZoneInfo(tz_name))
+
+    assert due(datetime(2026, 5, 1, 0, 1, tzinfo=timezone.utc), "UTC") == {
+        "2026-04-30": [1436, 1437, 1438, 1439], "2026-05-01": [0, 1],
+    }
+    # 2026-03-29 в Берлине часы переводят с 02:00 на 03:00: слоты 02:00-02:59 наступают в 03:00
+    spring = due(datetime(2026, 3, 29, 1, 0, tzinfo=timezone.utc), "Europe/Berlin")["2026-03-29"]
+    assert 2 * 60 + 30 in spring and 3 * 60 in spring
+    # 2026-10-25 с 03:00 обратно на 02:00: повтор часа не даёт отрицательных минут
+    autumn = due(datetime(2026, 10, 25, 1, 2, tzinfo=timezone.utc), "Europe/Berlin")["2026-10-25"]
+    assert autumn == [120, 121, 122, 177, 178, 179]
+
+
+def test_reminder_missed_before_midnight_is_retried_after_it(database):
+    sent = []
+    failing = {1}
+
+    async def send_reminders(meal, user_ids, on_done):
+        async def send(user_id):
+            if user_id in failing:
+                failing.discard(user_id)
+                raise RuntimeError("network is down")
+            sent.append((meal, user_id))
+        await broadcast_manager.broadcast(user_ids, send, on_done=on_done, kind="reminder")
+
+    async def scenario():
+        await db_manager.init_database()
+        try:
+            await db_manager.add_user(1)
+            await db_manager.save_reminder_slots([(1, "dinner", "UTC", 23 * 60 + 59)])
+            for minute in (datetime(2026, 4, 30, 23, 59), datetime(2026, 5, 1, 0, 0), datetime(2026, 5, 1, 0, 1)):
+                await reminder_manager._process_minute(minute.replace(tzinfo=timezone.utc), send_reminders)
+        finally:
+            await db_manager.close_database()
+
+    asyncio.run(scenario())
+    assert sent == [("dinner", 1)]
+
+
+def test_outcomes_are_recorded_at_least_every_interval(monkeypatch):
+    recorded = []
+    done = []
+
+    async def record_deliveries(sent, failed, blocked):
+        recorded.append((list(sent), list(failed), list(blocked)))
+
+    async def on_done(user_ids):
+        done.extend(user_ids)
+
+    monkeypatch.setattr(broadcast_manager, "record_deliveries", record_deliveries)
+    monkeypatch.setattr(broadcast_manager, "RECORD_INTERVAL", 0)
+
+    async def scenario():
+        stats = broadcast_manager.BroadcastStats(on_done=on_done)
+        await stats.record(1, "sent")
+        await stats.record(2, "blocked")
+
+    asyncio.run(scenario())
+    assert recorded == [([1], [], []), ([], [], [2])]
+    assert done == [1, 2]
@@ -0,0 +1,55 @@
+import asyncio
+
+import db_manager
+import worker_manager
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_leader_lease_has_one_holder_until_released_or_expired(database):
+    async def scenario():
+        await db_manager.init_database()
+        try:
+            return [
+                await db_manager.acquire_lease("leader", "a", 30),
+                await db_manager.acquire_lease("leader", "b", 30),
+                await db_manager.acquire_lease("leader", "a", 30),
+                await db_manager.release_lease("leader", "a") is not False,
+                await db_manager.acquire_lease("leader", "b", 0.01),
+                await asyncio.sleep(0.05),
+                await db_manager.acquire_lease("leader", "a", 30),
+            ]
+        finally:
+            await db_manager.close_database()
+
+    assert run(scenario()) == [True, False, True, True, True, None, True]
+
+
+def test_leader_runs_duties_and_releases_lease_on_stop(database, monkeypatch):
+    monkeypatch.setattr(worker_manager, "LEASE_TTL", 0.3)
+
+    async def scenario():
+        await db_manager.init_database()
+        try:
+            started, cancelled = asyncio.Event(), asyncio.Event()
+
+            async def duties():
+                started.set()
+                try:
+                    await asyncio.Event().wait()
+                finally:
+                    cancelled.set()
+
+            stop = asyncio.Event()
+            leader = asyncio.create_task(worker_manager.run_as_leader(duties, stop))
+            await asyncio.wait_for(started.wait(), 5)
+            taken_while_leading = await db_manager.acquire_lease(worker_manager.LEADER_LEASE, "other", 30)
+            stop.set()
+            await leader
+            return taken_while_leading, cancelled.is_set(), await db_manager.acquire_lease(worker_manager.LEADER_LEASE, "other", 30)
+        finally:
+            await db_manager.close_database()
+
+    assert run(scenario()) == (False, True, True)
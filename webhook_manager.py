@@ -0,0 +1,92 @@
+import asyncio
+import hashlib
+import logging
+import os
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+
+# Публичный HTTPS-адрес сервера (например, https://bot.example.com); без него бот работает через polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+# Секрет для заголовка X-Telegram-Bot-Api-Secret-Token; по умолчанию выводится из токена бота,
+# чтобы все воркеры знали его без настройки
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# Сколько апдейтов обрабатывается одновременно в одном процессе
+MAX_CONCURRENT_UPDATES = int(os.getenv("WEBHOOK_MAX_CONCURRENT_UPDATES", "32"))
+# Сколько одновременных соединений Telegram открывает к серверу (1-100)
+MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+
+def webhook_secret(bot_token: str) -> str:
+    return WEBHOOK_SECRET or hashlib.sha256(bot_token.encode()).hexdigest()
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """
+    Webhook handler that answers Telegram right away and processes updates in background
+    tasks, at most `limit` at a time. When every slot is busy the HTTP response waits
+    for a free one, so Telegram slows down instead of piling up tasks.
+    """
+
+    def __init__(self, dispatcher, bot, limit: int, **kwargs):
+        super().__init__(dispatcher, bot, handle_in_background=True, **kwargs)
+        self._slots = asyncio.Semaphore(limit)
+
+    async def _handle_request_background(self, bot, request):
+        await self._slots.acquire()
+        try:
+            return await super()._handle_request_background(bot=bot, request=request)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    async def _background_feed_update(self, bot, update):
+        try:
+            await super()._background_feed_update(bot=bot, update=update)
+        except Exception as e:
+            logging.error(f"❌ Failed to process update: {e}")
+        finally:
+            self._slots.release()
+
+    async def close(self):
+        # Бот общий для всего процесса, сессию закрывает main()
+        pass
+
+
+def setup_webhook(app, dispatcher, bot):
+    """Mount the Telegram webhook handler on the aiohttp application (if webhook mode is configured)."""
+    if not WEBHOOK_URL:
+        return
+    handler = BoundedRequestHandler(
+        dispatcher, bot, limit=MAX_CONCURRENT_UPDATES, secret_token=webhook_secret(bot.token)
+    )
+    handler.register(app, path=WEBHOOK_PATH)
+
+
+async def start_webhook(dispatcher, bot) -> bool:
+    """
+    Point Telegram at WEBHOOK_URL + WEBHOOK_PATH.
+
+    Returns:
+        bool: True if webhook mode is active, False if the caller should fall back to polling
+    """
+    if not WEBHOOK_URL:
+        return False
+    try:
+        await bot.set_webhook(
+            WEBHOOK_URL + WEBHOOK_PATH,
+            secret_token=webhook_secret(bot.token),
+            max_connections=MAX_CONNECTIONS,
+            allowed_updates=dispatcher.resolve_used_update_types(),
+        )
+    except Exception as e:
+        logging.error(f"❌ Failed to set webhook, falling back to polling: {e}")
+        return False
+    logging.info(f"✅ Webhook set: {WEBHOOK_URL}{WEBHOOK_PATH}")
+    return True
+
+
+async def start_polling(dispatcher, bot):
+    """Long polling fallback: Telegram does not deliver updates to getUpdates while a webhook is set."""
+    await bot.delete_webhook()
+    # Сигналы обрабатывает main(), polling останавливается отменой задачи
+    await dispatcher.start_polling(bot, handle_signals=False)
@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import time
+from db_manager import acquire_lease, release_lease
+
+# Сколько процессов обслуживают порт 8080 (SO_REUSEPORT); 1 - всё в одном процессе, как раньше
+WORKERS = int(os.getenv("WORKERS", "1"))
+# Аренда лидера: срок в секундах и продление каждые LEASE_TTL / 3
+LEASE_TTL = float(os.getenv("LEADER_LEASE_TTL", "30"))
+# Сколько секунд при остановке ждём незавершённые запросы (в том числе /api/analyze)
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "30"))
+
+LEADER_LEASE = "leader"
+# Пауза перед перезапуском упавшего воркера и запас сверх SHUTDOWN_TIMEOUT до SIGKILL
+RESTART_DELAY = 1
+KILL_GRACE = 10
+
+
+def _run_worker(worker, index: int):
+    # Обработчики сигналов супервизора не нужны воркеру, он ставит свои в event loop
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    worker(index)
+
+
+def run_workers(worker, count: int = WORKERS):
+    """
+    Run worker(index) in count forked processes and restart the ones that crash.
+    SIGTERM/SIGINT are forwarded to the workers, which finish in-flight requests
+    and exit; stragglers are killed after SHUTDOWN_TIMEOUT + KILL_GRACE seconds.
+    With count <= 1 the worker runs in this process.
+
+    Call before any threads or event loops are started.
+    """
+    if count <= 1:
+        worker(0)
+        return
+
+    logging.basicConfig(level=logging.INFO)
+    context = multiprocessing.get_context("fork")
+    processes = {}
+    stopping_since = None
+
+    def start(index):
+        process = context.Process(target=_run_worker, args=(worker, index), name=f"worker-{index}")
+        process.start()
+        processes[index] = process
+
+    def stop(signum, frame):
+        nonlocal stopping_since
+        if stopping_since is not None:
+            return
+        stopping_since = time.monotonic()
+        logging.info(f"🛑 Stopping {len(processes)} workers")
+        for process in processes.values():
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for index in range(count):
+        start(index)
+    logging.info(f"🚀 Started {count} workers")
+
+    while processes:
+        time.sleep(0.5)
+        for index, process in list(processes.items()):
+            if process.is_alive():
+                if stopping_since is not None and time.monotonic() - stopping_since > SHUTDOWN_TIMEOUT + KILL_GRACE:
+                    logging.warning(f"⚠️ Worker {index} did not stop in time, killing it")
+                    process.kill()
+                continue
+            del processes[index]
+            if stopping_since is None:
+                logging.warning(f"⚠️ Worker {index} exited with code {process.exitcode}, restarting")
+                time.sleep(RESTART_DELAY)
+                start(index)
+
+
+async def _cancel(task):
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        logging.error(f"❌ Leader duties failed: {e}")
+
+
+async def run_as_leader(duties, stop: asyncio.Event):
+    """
+    Compete for the leader lease until stop is set and run duties() while holding it.
+
+    Exactly one process sharing the database holds the lease, so duties
+    (reminders, nightly jobs, Telegram polling) never run twice. duties is
+    cancelled as soon as the lease cannot be renewed, restarted if it fails,
+    and the lease is released on stop so another worker takes over at once.
+
+    Args:
+        duties: Coroutine function with the leader-only work
+        stop: Set to step down and return
+    """
+    holder = f"{socket.gethostname()}:{os.getpid()}"
+    task = None
+    try:
+        while not stop.is_set():
+            leader = await acquire_lease(LEADER_LEASE, holder, LEASE_TTL)
+            if leader and (task is None or task.done()):
+                if task is not None:
+                    await _cancel(task)
+                    logging.warning("⚠️ Leader duties stopped, restarting them")
+                else:
+                    logging.info(f"👑 Process {os.getpid()} is the leader")
+                task = asyncio.create_task(duties())
+            elif not leader and task is not None:
+                logging.warning("⚠️ Leader lease lost, stopping leader duties")
+                await _cancel(task)
+                task = None
+            try:
+                await asyncio.wait_for(stop.wait(), LEASE_TTL / 3)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        if task is not None:
+            await _cancel(task)
+            await release_lease(LEADER_LEASE, holder)